@@ -5,3 +5,73 @@ load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Logs older than this many days are moved to the archive database (0 disables archiving)
+LOG_ARCHIVE_AFTER_DAYS = int(os.getenv("LOG_ARCHIVE_AFTER_DAYS", "180"))
+
+# Group-commit log writer: flush after this many ms or this many rows, whichever comes first
+LOG_WRITER_FLUSH_MS = int(os.getenv("LOG_WRITER_FLUSH_MS", "5"))
+LOG_WRITER_MAX_ROWS = int(os.getenv("LOG_WRITER_MAX_ROWS", "500"))
+# NORMAL (default, like every other connection): a batch survives a crash of the bot but may be lost on power loss.
+# FULL: fsync on every batch commit, durable across power loss at a higher p99 write latency.
+LOG_WRITER_SYNCHRONOUS = os.getenv("LOG_WRITER_SYNCHRONOUS", "NORMAL").upper()
+
+# Text-message response cache (in-memory LRU in front of a SQLite store)
+RESPONSE_CACHE_TTL_HOURS = float(os.getenv("RESPONSE_CACHE_TTL_HOURS", "168"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "50000"))
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "1000"))
+
+# Near-duplicate photo cache (per user, matched by perceptual hash)
+IMAGE_CACHE_MAX_DISTANCE = int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "10")) # Hamming distance out of 64 bits
+IMAGE_CACHE_MAX_COLOR_DISTANCE = float(os.getenv("IMAGE_CACHE_MAX_COLOR_DISTANCE", "0.065")) # Share of the plate's pixels whose colour changed
+IMAGE_CACHE_TTL_DAYS = float(os.getenv("IMAGE_CACHE_TTL_DAYS", "30"))
+IMAGE_CACHE_PER_USER = int(os.getenv("IMAGE_CACHE_PER_USER", "200"))
+
+# Photo preprocessing before the vision call
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "80"))
+
+# OpenAI request scheduling (0 disables the RPM/TPM limit)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "30000"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+
+# Stream LLM replies into the chat by editing one message (at most one edit per interval)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+TELEGRAM_EDIT_INTERVAL_MS = int(os.getenv("TELEGRAM_EDIT_INTERVAL_MS", "1000"))
+
+# Answer simple text logs ("200g chicken breast, 1 apple") from the bundled food table instead of the LLM
+LOCAL_FOOD_RESOLVER = os.getenv("LOCAL_FOOD_RESOLVER", "1") == "1"
+
+# Model tiers: the full model handles photos and meal descriptions, the fast one small talk
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06")
+OPENAI_FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini")
+# Classify text messages locally (food log / chat / command) and route them to a tier
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1") == "1"
+
+# Where offline re-analysis jobs keep their batch input/output files (python -m src.services.batch_service)
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "batches"))
+
+# LLM usage metering: Telegram ids allowed to run /usage (comma-separated), Prometheus /metrics port (0 disables)
+ADMIN_USER_IDS = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if i}
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "60"))
+
+# Photos of one Telegram album are analyzed together once no new photo arrived for this long
+MEDIA_GROUP_WAIT_MS = int(os.getenv("MEDIA_GROUP_WAIT_MS", "500"))
+
+# Open Food Facts client: pooled connections and per-request timeout
+OFF_MAX_CONNECTIONS = int(os.getenv("OFF_MAX_CONNECTIONS", "20"))
+OFF_TIMEOUT_SECONDS = float(os.getenv("OFF_TIMEOUT_SECONDS", "8"))
+
+# Barcode product cache (SQLite + in-memory LRU): fresh for the TTL, then served stale for up to
+# PRODUCT_CACHE_STALE_DAYS while refreshed in the background; unknown barcodes are remembered for the negative TTL
+PRODUCT_CACHE_TTL_DAYS = float(os.getenv("PRODUCT_CACHE_TTL_DAYS", "7"))
+PRODUCT_CACHE_STALE_DAYS = float(os.getenv("PRODUCT_CACHE_STALE_DAYS", "30"))
+PRODUCT_CACHE_NEGATIVE_TTL_HOURS = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL_HOURS", "6"))
+PRODUCT_CACHE_MEMORY_ENTRIES = int(os.getenv("PRODUCT_CACHE_MEMORY_ENTRIES", "2000"))
+
+# Offline barcode index built from an Open Food Facts dump (python -m src.services.off_index import ...);
+# consulted before the product cache and the API when the file exists
+OFF_INDEX_PATH = os.getenv("OFF_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "off_index.bin"))
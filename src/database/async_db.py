@@ -0,0 +1,164 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from src.database import db
+
+# One worker per pooled connection, so a worker never waits on the pool.
+# Blocking SQLite calls run here instead of on the aiogram event loop.
+_executor = ThreadPoolExecutor(max_workers=db.POOL_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """
+    Runs a blocking database function on the DB thread pool and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+async def init_db():
+    return await run_db(db.init_db)
+
+async def rebuild_daily_totals():
+    return await run_db(db.rebuild_daily_totals)
+
+async def register_user(user_id: int, username: str):
+    return await run_db(db.register_user, user_id, username)
+
+async def set_daily_calorie_goal(user_id: int, calories: int):
+    return await run_db(db.set_daily_calorie_goal, user_id, calories)
+
+async def update_user_profile(user_id: int, age, gender, weight, height, activity_level):
+    return await run_db(db.update_user_profile, user_id, age, gender, weight, height, activity_level)
+
+async def get_logs_by_group(meal_group_id: str):
+    return await run_db(db.get_logs_by_group, meal_group_id)
+
+async def get_today_snapshot(user_id: int):
+    return await run_db(db.get_today_snapshot, user_id)
+
+async def get_daily_summary(user_id: int):
+    return await run_db(db.get_daily_summary, user_id)
+
+async def get_daily_logs(user_id: int):
+    return await run_db(db.get_daily_logs, user_id)
+
+async def insert_meal_logs(user_id: int, rows: list):
+    return await run_db(db.insert_meal_logs, user_id, rows)
+
+async def get_history(user_id: int, start, end, granularity: str = 'day'):
+    return await run_db(db.get_history, user_id, start, end, granularity)
+
+async def export_logs(user_id: int, start, end):
+    return await run_db(db.export_logs, user_id, start, end)
+
+async def archive_old_logs(max_age_days: int, batch_size: int = 5000):
+    return await run_db(db.archive_old_logs, max_age_days, batch_size)
+
+async def compact_db(pages_per_step: int = 2000):
+    return await run_db(db.compact_db, pages_per_step)
+
+async def get_cached_response(cache_key: str, ttl_seconds: float):
+    return await run_db(db.get_cached_response, cache_key, ttl_seconds)
+
+async def put_cached_response(cache_key: str, value: str):
+    return await run_db(db.put_cached_response, cache_key, value)
+
+async def evict_cached_responses(max_entries: int, ttl_seconds: float):
+    return await run_db(db.evict_cached_responses, max_entries, ttl_seconds)
+
+async def find_similar_image(user_id: int, dhash: int, colors: bytes, caption: str, max_distance: int,
+                             max_color_distance: float, ttl_seconds: float, limit: int):
+    return await run_db(db.find_similar_image, user_id, dhash, colors, caption, max_distance, max_color_distance, ttl_seconds, limit)
+
+async def put_image_analysis(user_id: int, dhash: int, colors: bytes, caption: str, log_data: str, reply: str,
+                             max_per_user: int, ttl_seconds: float):
+    return await run_db(db.put_image_analysis, user_id, dhash, colors, caption, log_data, reply, max_per_user, ttl_seconds)
+
+async def get_cached_product(barcode: str):
+    return await run_db(db.get_cached_product, barcode)
+
+async def put_cached_product(barcode: str, product: str = None):
+    return await run_db(db.put_cached_product, barcode, product)
+
+async def evict_cached_products(max_age_seconds: float, negative_max_age_seconds: float):
+    return await run_db(db.evict_cached_products, max_age_seconds, negative_max_age_seconds)
+
+async def upsert_products(rows: list):
+    return await run_db(db.upsert_products, rows)
+
+async def search_products(match: str, limit: int = 10, offset: int = 0):
+    return await run_db(db.search_products, match, limit, offset)
+
+async def optimize_product_search():
+    return await run_db(db.optimize_product_search)
+
+async def add_llm_usage(rows: list):
+    return await run_db(db.add_llm_usage, rows)
+
+async def get_llm_usage(start_day: str, group_by: str = "endpoint", limit: int = 20):
+    return await run_db(db.get_llm_usage, start_day, group_by, limit)
+
+async def delete_log(log_id: int):
+    return await run_db(db.delete_log, log_id)
+
+async def clear_daily_logs(user_id: int):
+    return await run_db(db.clear_daily_logs, user_id)
+
+def close_db():
+    """
+    Waits for queued DB work to finish, then closes the connection pool (used on shutdown).
+    """
+    _executor.shutdown(wait=True)
+    db.close_db_pool()
+
+if __name__ == "__main__":
+    # Event loop responsiveness check: python -m src.database.async_db [delay_ms] [calls]
+    # A 10 ms ticker runs while slow database calls are in flight, once through run_db and
+    # once called directly on the loop (what the handlers did before this module).
+    import sys
+    import time
+
+    delay = (int(sys.argv[1]) if len(sys.argv) > 1 else 200) / 1000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    def slow_query(user_id: int):
+        # Stands in for a query that holds the database for `delay` seconds
+        time.sleep(delay)
+        return user_id
+
+    async def measure(label: str, call) -> float:
+        gaps, stop = [], asyncio.Event()
+
+        async def ticker():
+            last = time.perf_counter()
+            while not stop.is_set():
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(call(i) for i in range(calls)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await tick
+        assert results == list(range(calls))
+        print(f"{label:>14}: {calls} calls of {delay * 1000:.0f} ms in {elapsed * 1000:.0f} ms, "
+              f"longest ticker gap {max(gaps) * 1000:.0f} ms")
+        return max(gaps)
+
+    async def on_loop(user_id: int):
+        return slow_query(user_id)
+
+    async def main():
+        blocked = await measure("on the loop", on_loop)
+        offloaded = await measure("run_db", lambda user_id: run_db(slow_query, user_id))
+        assert blocked >= delay, "the direct calls should have blocked the ticker"
+        # A tick may be late by scheduling noise, never by a query
+        assert offloaded < min(0.05, delay / 2), f"event loop stalled for {offloaded * 1000:.0f} ms"
+        print("OK")
+
+    asyncio.run(main())
+    _executor.shutdown(wait=True)
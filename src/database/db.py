@@ -1,17 +1,255 @@
 import sqlite3
 import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "nutrition.db")
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Connection pool settings
+POOL_SIZE = 4
+POOL_TIMEOUT = 10.0 # Seconds to wait for a free connection
+STATEMENT_CACHE_SIZE = 256 # Prepared statements cached per connection
+
+# Applied once to every new pooled connection
+CONNECTION_PRAGMAS = [
+    "PRAGMA auto_vacuum = INCREMENTAL", # Only takes effect on new databases (see compact_db)
+    "PRAGMA journal_mode = WAL", # Readers no longer block behind writers
+    "PRAGMA synchronous = NORMAL", # Safe with WAL, avoids an fsync per commit
+    "PRAGMA busy_timeout = 5000", # Wait on locks instead of failing immediately
+    "PRAGMA cache_size = -16000", # ~16MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Old logs are moved to a separate database file, attached to every connection as "archive".
+# Keeps the hot logs table (and its index, backups and vacuums) small.
+ARCHIVE_SCHEMA = [
+    "PRAGMA archive.auto_vacuum = INCREMENTAL",
+    "PRAGMA archive.journal_mode = WAL",
+    '''
+    CREATE TABLE IF NOT EXISTS archive.logs (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        food_name TEXT,
+        calories INTEGER,
+        protein REAL,
+        carbs REAL,
+        fats REAL,
+        micronutrients TEXT,
+        health_score INTEGER,
+        meal_period TEXT,
+        meal_group_id TEXT,
+        timestamp DATETIME
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_logs_user_timestamp ON logs (user_id, timestamp)",
+]
+LOG_COLUMNS = "id, user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_period, meal_group_id, timestamp"
+
+def get_archive_path(db_path: str) -> str:
+    return os.path.splitext(db_path)[0] + "_archive.db"
+
+def open_connection(path: str):
+    """
+    Opens a tuned connection with the archive attached (used by the pool and the log writer).
+    """
+    conn = sqlite3.connect(
+        path,
+        timeout=POOL_TIMEOUT,
+        check_same_thread=False, # Connections move between threads via the pool
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("ATTACH DATABASE ? AS archive", (get_archive_path(path),))
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
     return conn
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+class ConnectionPool:
+    """
+    Keeps a small set of long-lived SQLite connections open and hands them out.
+    Connections are created lazily up to `size`; callers block when all are busy.
+    """
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        return open_connection(self.path)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection.")
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self):
+        with self._lock:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
+
+class PooledConnection:
+    """
+    Wraps a pooled sqlite3 connection.
+    Behaves like sqlite3.Connection, but close() returns it to the pool.
+    """
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        # Same semantics as sqlite3.Connection: commit on success, rollback on error
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __del__(self):
+        # Safety net for call sites that forget to close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+def get_db_connection():
+    """
+    Returns a connection from the shared pool.
+    Call close() when done to hand it back.
+    """
+    pool = get_pool()
+    return PooledConnection(pool.acquire(), pool)
+
+def close_db_pool():
+    """
+    Closes all idle pooled connections (used on shutdown).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+# Per-user, per-day rollup of logs, kept current by the triggers below
+DAILY_TOTALS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS daily_totals (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        calories INTEGER NOT NULL DEFAULT 0,
+        protein REAL NOT NULL DEFAULT 0,
+        carbs REAL NOT NULL DEFAULT 0,
+        fats REAL NOT NULL DEFAULT 0,
+        health_score_sum INTEGER NOT NULL DEFAULT 0,
+        health_score_count INTEGER NOT NULL DEFAULT 0,
+        item_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID
+'''
+
+# Adds one log row to its day (used by the insert and update triggers)
+_ADD_TO_TOTALS = '''
+    INSERT INTO daily_totals (user_id, day, calories, protein, carbs, fats, health_score_sum, health_score_count, item_count)
+    VALUES (
+        NEW.user_id, date(NEW.timestamp),
+        COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0), COALESCE(NEW.carbs, 0), COALESCE(NEW.fats, 0),
+        COALESCE(NEW.health_score, 0), NEW.health_score IS NOT NULL, 1
+    )
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        calories = calories + excluded.calories,
+        protein = protein + excluded.protein,
+        carbs = carbs + excluded.carbs,
+        fats = fats + excluded.fats,
+        health_score_sum = health_score_sum + excluded.health_score_sum,
+        health_score_count = health_score_count + excluded.health_score_count,
+        item_count = item_count + 1;
+'''
+
+# Removes one log row from its day (used by the delete and update triggers)
+_SUBTRACT_FROM_TOTALS = '''
+    UPDATE daily_totals SET
+        calories = calories - COALESCE(OLD.calories, 0),
+        protein = protein - COALESCE(OLD.protein, 0),
+        carbs = carbs - COALESCE(OLD.carbs, 0),
+        fats = fats - COALESCE(OLD.fats, 0),
+        health_score_sum = health_score_sum - COALESCE(OLD.health_score, 0),
+        health_score_count = health_score_count - (OLD.health_score IS NOT NULL),
+        item_count = item_count - 1
+    WHERE user_id = OLD.user_id AND day = date(OLD.timestamp);
+    DELETE FROM daily_totals
+    WHERE user_id = OLD.user_id AND day = date(OLD.timestamp) AND item_count <= 0;
+'''
+
+DAILY_TOTALS_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS trg_logs_totals_insert AFTER INSERT ON logs BEGIN {_ADD_TO_TOTALS} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_logs_totals_delete AFTER DELETE ON logs BEGIN {_SUBTRACT_FROM_TOTALS} END",
+    (
+        "CREATE TRIGGER IF NOT EXISTS trg_logs_totals_update "
+        "AFTER UPDATE OF user_id, timestamp, calories, protein, carbs, fats, health_score ON logs "
+        f"BEGIN {_SUBTRACT_FROM_TOTALS} {_ADD_TO_TOTALS} END"
+    ),
+]
+
+# While this row is in maintenance_flags, deleting logs leaves daily_totals alone (see archive_old_logs)
+ARCHIVING_FLAG = "archiving"
+
+def _get_columns(cursor, table: str):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row['name'] for row in cursor.fetchall()}
+
+def _migration_1_base_schema(cursor):
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -39,42 +277,347 @@ def init_db():
             micronutrients TEXT,
             health_score INTEGER,
             meal_period TEXT DEFAULT 'Snack',
+            meal_group_id TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
     ''')
-    
-    # Migration: Add new columns if they don't exist (for existing DBs)
-    try:
-        cursor.execute("ALTER TABLE logs ADD COLUMN micronutrients TEXT")
-    except sqlite3.OperationalError:
-        pass # Column likely exists
-        
-    try:
-        cursor.execute("ALTER TABLE logs ADD COLUMN health_score INTEGER")
-    except sqlite3.OperationalError:
-        pass # Column likely exists
 
-    try:
-        cursor.execute("ALTER TABLE logs ADD COLUMN meal_period TEXT DEFAULT 'Snack'")
-    except sqlite3.OperationalError:
-        pass # Column likely exists
+    # Databases created before versioning may be missing later columns
+    log_columns = _get_columns(cursor, "logs")
+    for col, definition in [
+        ('micronutrients', "TEXT"),
+        ('health_score', "INTEGER"),
+        ('meal_period', "TEXT DEFAULT 'Snack'"),
+        ('meal_group_id', "TEXT")
+    ]:
+        if col not in log_columns:
+            cursor.execute(f"ALTER TABLE logs ADD COLUMN {col} {definition}")
+
+    user_columns = _get_columns(cursor, "users")
+    for col in ['age', 'gender', 'weight', 'height', 'activity_level']:
+        if col not in user_columns:
+            cursor.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT") # Using TEXT for simplicity/flexibility or REAL/INTEGER
+
+def _migration_2_logs_user_timestamp_index(cursor):
+    # Index for per-user day-range lookups (journal, sync, delete)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_timestamp ON logs (user_id, timestamp)")
+
+def _migration_3_daily_totals(cursor):
+    # Daily rollup table + triggers, backfilled from existing logs
+    cursor.execute(DAILY_TOTALS_TABLE)
+    for trigger in DAILY_TOTALS_TRIGGERS:
+        cursor.execute(trigger)
+    _backfill_daily_totals(cursor)
+
+def _migration_4_llm_cache(cursor):
+    # Persistent store behind the in-memory LLM response cache
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+
+def _migration_5_image_cache(cursor):
+    # Perceptual hashes of analyzed photos, to answer near-duplicates without a vision call
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_cache (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            dhash INTEGER NOT NULL,
+            caption TEXT NOT NULL DEFAULT '',
+            log_data TEXT NOT NULL,
+            reply TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_user_created ON image_cache (user_id, created_at)")
+
+def _migration_6_batch_jobs(cursor):
+    # Offline re-analysis jobs submitted to the batch API (see src/services/batch_service.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            batch_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            backend TEXT NOT NULL,
+            input_path TEXT NOT NULL,
+            output_path TEXT,
+            prompt_version TEXT NOT NULL,
+            request_count INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            applied_count INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_7_llm_usage_daily(cursor):
+    # Daily per-user, per-endpoint rollup of LLM calls (see src/services/metrics_service.py); user 0 = unknown
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage_daily (
+            day TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            model TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            image_bytes INTEGER NOT NULL DEFAULT 0,
+            cost_usd REAL NOT NULL DEFAULT 0,
+            latency_ms_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, endpoint, model, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_8_product_cache(cursor):
+    # Open Food Facts lookups by barcode; product is NULL when OFF does not know the code
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_cache (
+            barcode TEXT PRIMARY KEY,
+            product TEXT,
+            fetched_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_9_product_search(cursor):
+    # Products known by name (see src/services/product_search.py), with an FTS5 index kept in sync by triggers.
+    # unicode61 folds case and diacritics ("creme" finds "Crème"); prefix indexes speed up as-you-type matching.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            barcode TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            calories REAL,
+            protein REAL,
+            carbs REAL,
+            fats REAL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    # One statement per execute: executescript() would COMMIT the migration's transaction first
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+        END
+    ''')
+    # Seed from barcodes already looked up
+    cursor.execute('''
+        INSERT OR IGNORE INTO products (barcode, name, calories, protein, carbs, fats, updated_at)
+        SELECT barcode, json_extract(product, '$.name'), json_extract(product, '$.calories'),
+               json_extract(product, '$.protein'), json_extract(product, '$.carbs'),
+               json_extract(product, '$.fats'), fetched_at
+        FROM product_cache
+        WHERE product IS NOT NULL AND coalesce(json_extract(product, '$.name'), '') NOT IN ('', 'Unknown')
+    ''')
+
+def _migration_10_archive_without_ddl(cursor):
+    # Archiving deletes rows without touching daily_totals by setting a flag row inside its own
+    # transaction, instead of dropping and re-creating the delete trigger (a schema change that
+    # invalidates every connection's prepared statements)
+    cursor.execute("CREATE TABLE IF NOT EXISTS maintenance_flags (name TEXT PRIMARY KEY) WITHOUT ROWID")
+    cursor.execute("DROP TRIGGER IF EXISTS trg_logs_totals_delete")
+    cursor.execute(
+        "CREATE TRIGGER trg_logs_totals_delete AFTER DELETE ON logs "
+        f"WHEN NOT EXISTS (SELECT 1 FROM maintenance_flags WHERE name = '{ARCHIVING_FLAG}') "
+        f"BEGIN {_SUBTRACT_FROM_TOTALS} END"
+    )
+    # Lets the archiver find old rows (and see there are none left) without a table scan
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+
+def _migration_11_image_cache_colors(cursor):
+    # Colour histogram next to the dHash (see src/services/image_service.py); older rows have none and never match
+    cursor.execute("ALTER TABLE image_cache ADD COLUMN colors BLOB")
+
+# Numbered schema migrations. Append new ones; never edit or reorder applied ones.
+# The last applied number is stored in PRAGMA user_version.
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_logs_user_timestamp_index),
+    (3, _migration_3_daily_totals),
+    (4, _migration_4_llm_cache),
+    (5, _migration_5_image_cache),
+    (6, _migration_6_batch_jobs),
+    (7, _migration_7_llm_usage_daily),
+    (8, _migration_8_product_cache),
+    (9, _migration_9_product_search),
+    (10, _migration_10_archive_without_ddl),
+    (11, _migration_11_image_cache_colors),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
+def get_schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    """
+    Brings the schema up to SCHEMA_VERSION.
+    On an up-to-date database this is a single PRAGMA read.
+    """
+    conn = get_db_connection()
     try:
-        cursor.execute("ALTER TABLE logs ADD COLUMN meal_group_id TEXT")
-    except sqlite3.OperationalError:
-        pass # Column likely exists
+        if get_schema_version(conn) < SCHEMA_VERSION:
+            _apply_migrations(conn)
+    finally:
+        conn.close()
+    print("Database initialized.")
 
-    # Migration for users table
-    for col in ['age', 'gender', 'weight', 'height', 'activity_level']:
+def _apply_migrations(conn):
+    for number, migration in MIGRATIONS:
+        # Each migration runs in its own write transaction.
+        # The version is re-read under the lock in case another process migrated first.
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            cursor.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT") # Using TEXT for simplicity/flexibility or REAL/INTEGER
-        except sqlite3.OperationalError:
-            pass
-    
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied database migration {number}: {migration.__name__}")
+
+def _backfill_daily_totals(cursor):
+    # Archived days count too; rows caught mid-archive (in both tables) are counted once
+    cursor.execute("DELETE FROM daily_totals")
+    cursor.execute('''
+        INSERT INTO daily_totals (user_id, day, calories, protein, carbs, fats, health_score_sum, health_score_count, item_count)
+        SELECT
+            user_id,
+            date(timestamp),
+            COALESCE(SUM(calories), 0),
+            COALESCE(SUM(protein), 0),
+            COALESCE(SUM(carbs), 0),
+            COALESCE(SUM(fats), 0),
+            COALESCE(SUM(health_score), 0),
+            COUNT(health_score),
+            COUNT(*)
+        FROM (
+            SELECT user_id, timestamp, calories, protein, carbs, fats, health_score FROM main.logs
+            UNION ALL
+            SELECT user_id, timestamp, calories, protein, carbs, fats, health_score FROM archive.logs
+            WHERE id NOT IN (SELECT id FROM main.logs)
+        )
+        GROUP BY user_id, date(timestamp)
+    ''')
+
+def rebuild_daily_totals():
+    """
+    Recomputes the daily_totals rollup from the raw logs table.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            cursor = conn.cursor()
+            _backfill_daily_totals(cursor)
+            cursor.execute("SELECT COUNT(*) FROM daily_totals")
+            count = cursor.fetchone()[0]
+    finally:
+        conn.close()
+    print(f"Rebuilt daily totals ({count} user-days).")
+    return count
+
+WRITER_SYNCHRONOUS_MODES = ("NORMAL", "FULL")
+
+def open_writer_connection(synchronous: str = "NORMAL"):
+    """
+    Opens the dedicated connection used by the group-commit log writer.
+    With synchronous=FULL a commit is fsynced before the writer reports it as done;
+    NORMAL matches the pooled connections (WAL: durable across crashes, not power loss).
+    """
+    if synchronous not in WRITER_SYNCHRONOUS_MODES:
+        raise ValueError(f"synchronous must be one of {WRITER_SYNCHRONOUS_MODES}, not {synchronous!r}")
+    conn = open_connection(DB_PATH)
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    return conn
+
+def insert_meal_log_batch(conn, batch: list):
+    """
+    Inserts several meals (possibly from different users) in one transaction.
+    `batch` is a list of (user_id, rows) with rows as in insert_meal_logs.
+    Returns today's snapshot (see get_today_snapshot) for each entry, read inside that same transaction.
+    """
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(user_id, *row) for user_id, rows in batch for row in rows])
+
+        snapshots = {}
+        for user_id, _ in batch:
+            if user_id not in snapshots:
+                snapshots[user_id] = _fetch_today_snapshot(cursor, user_id)
+    return [snapshots[user_id] for user_id, _ in batch]
+
+def register_user(user_id: int, username: str):
+    """
+    Creates the user row if it does not exist yet.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
     conn.commit()
     conn.close()
-    print("Database initialized.")
+
+def set_daily_calorie_goal(user_id: int, calories: int):
+    """
+    Updates the user's daily calorie goal.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET daily_calorie_goal = ? WHERE user_id = ?", (calories, user_id))
+    conn.commit()
+    conn.close()
+
+def update_user_profile(user_id: int, age, gender, weight, height, activity_level):
+    """
+    Saves the profile answers collected by the goal setup flow.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE users 
+        SET age = ?, gender = ?, weight = ?, height = ?, activity_level = ?
+        WHERE user_id = ?
+    ''', (age, gender, weight, height, activity_level, user_id))
+    conn.commit()
+    conn.close()
+
+def get_day_bounds(day=None):
+    """
+    Returns the half-open [start, end) timestamp range for a UTC day (today by default).
+    Formatted like CURRENT_TIMESTAMP so `timestamp >= ? AND timestamp < ?` can seek the index.
+    """
+    if day is None:
+        day = datetime.now(timezone.utc).date()
+    start = datetime(day.year, day.month, day.day)
+    end = start + timedelta(days=1)
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
 
 def get_logs_by_group(meal_group_id: str):
     """
@@ -87,36 +630,119 @@ def get_logs_by_group(meal_group_id: str):
     conn.close()
     return rows
 
-def get_daily_summary(user_id: int):
-    """
-    Retrieves the total nutrition for the current day for a specific user.
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def _fetch_daily_summary(cursor, user_id: int):
     # Get Goal
     cursor.execute("SELECT daily_calorie_goal FROM users WHERE user_id = ?", (user_id,))
     user_row = cursor.fetchone()
     goal = user_row['daily_calorie_goal'] if user_row else 2000
 
+    today = datetime.now(timezone.utc).date()
     cursor.execute('''
-        SELECT 
-            SUM(calories) as total_calories,
-            SUM(protein) as total_protein,
-            SUM(carbs) as total_carbs,
-            SUM(fats) as total_fats,
-            AVG(health_score) as avg_health_score,
-            GROUP_CONCAT(food_name, ', ') as food_items
+        SELECT calories, protein, carbs, fats, health_score_sum, health_score_count
+        FROM daily_totals
+        WHERE user_id = ? AND day = ?
+    ''', (user_id, today.isoformat()))
+    totals = cursor.fetchone()
+
+    result = {
+        'total_calories': None,
+        'total_protein': None,
+        'total_carbs': None,
+        'total_fats': None,
+        'avg_health_score': None,
+        'food_items': None
+    }
+    if totals:
+        result['total_calories'] = totals['calories']
+        result['total_protein'] = totals['protein']
+        result['total_carbs'] = totals['carbs']
+        result['total_fats'] = totals['fats']
+        if totals['health_score_count']:
+            result['avg_health_score'] = totals['health_score_sum'] / totals['health_score_count']
+
+        # Item names still come from the raw rows (index range seek on today only)
+        day_start, day_end = get_day_bounds(today)
+        cursor.execute('''
+            SELECT GROUP_CONCAT(food_name, ', ') as food_items
+            FROM logs
+            WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+        ''', (user_id, day_start, day_end))
+        result['food_items'] = cursor.fetchone()['food_items']
+
+    # Add goal
+    result['daily_calorie_goal'] = goal
+    return result
+
+def _fetch_daily_logs(cursor, user_id: int):
+    day_start, day_end = get_day_bounds()
+    cursor.execute('''
+        SELECT * 
         FROM logs 
-        WHERE user_id = ? AND date(timestamp) = date('now')
-    ''', (user_id,))
-    
-    row = cursor.fetchone()
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp DESC, id DESC
+    ''', (user_id, day_start, day_end))
+    return cursor.fetchall()
+
+def _fetch_today_snapshot(cursor, user_id: int):
+    # Get Goal
+    cursor.execute("SELECT daily_calorie_goal FROM users WHERE user_id = ?", (user_id,))
+    user_row = cursor.fetchone()
+    goal = user_row['daily_calorie_goal'] if user_row else 2000
+
+    logs = _fetch_daily_logs(cursor, user_id)
+
+    # Totals in a single pass over the rows
+    total_cals = 0
+    total_prot = 0
+    total_carbs = 0
+    total_fats = 0
+    score_sum = 0
+    score_count = 0
+    names = []
+    for log in logs:
+        total_cals += log['calories'] or 0
+        total_prot += log['protein'] or 0
+        total_carbs += log['carbs'] or 0
+        total_fats += log['fats'] or 0
+        if log['health_score'] is not None:
+            score_sum += log['health_score']
+            score_count += 1
+        names.append(log['food_name'] or "")
+
+    return {
+        'daily_calorie_goal': goal,
+        'total_calories': total_cals if logs else None,
+        'total_protein': total_prot if logs else None,
+        'total_carbs': total_carbs if logs else None,
+        'total_fats': total_fats if logs else None,
+        'avg_health_score': score_sum / score_count if score_count else None,
+        'food_items': ", ".join(reversed(names)) if logs else None, # Oldest first
+        'logs': logs # Newest first
+    }
+
+def get_today_snapshot(user_id: int):
+    """
+    Returns today's goal, totals and rows (newest first) for a user from one read transaction.
+    Has the same keys as get_daily_summary plus 'logs'.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN") # Both reads see the same snapshot
+        snapshot = _fetch_today_snapshot(conn.cursor(), user_id)
+        conn.commit()
+    finally:
+        conn.close()
+    return snapshot
+
+def get_daily_summary(user_id: int):
+    """
+    Retrieves the total nutrition for the current day for a specific user.
+    Totals come from the daily_totals rollup (a single primary-key lookup).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    result = _fetch_daily_summary(cursor, user_id)
     conn.close()
-    
-    # Convert Row to Dict and add goal
-    result = dict(row) if row else {}
-    result['daily_calorie_goal'] = goal
     return result
 
 def get_daily_logs(user_id: int):
@@ -125,16 +751,581 @@ def get_daily_logs(user_id: int):
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * 
-        FROM logs 
-        WHERE user_id = ? AND date(timestamp) = date('now')
-        ORDER BY timestamp DESC
-    ''', (user_id,))
+    rows = _fetch_daily_logs(cursor, user_id)
+    conn.close()
+    return rows
+
+def insert_meal_logs(user_id: int, rows: list):
+    """
+    Inserts a meal's log rows in a single transaction.
+    Each row is (food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period).
+    Returns today's snapshot (see get_today_snapshot) as seen by that same transaction.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(user_id, *row) for row in rows])
+            snapshot = _fetch_today_snapshot(cursor, user_id)
+    finally:
+        conn.close()
+    return snapshot
+
+# How daily_totals days are bucketed for each history granularity
+HISTORY_PERIODS = {
+    'day': "day",
+    'week': "date(day, 'weekday 0', '-6 days')", # Monday of the week
+    'month': "strftime('%Y-%m-01', day)"
+}
+GOAL_TOLERANCE = 0.10 # A day is "on target" within ±10% of the calorie goal
+
+def get_history(user_id: int, start, end, granularity: str = 'day'):
+    """
+    Aggregates calorie/macro totals per day, week or month between two dates (inclusive).
+    Reads the daily_totals rollup with one grouped query, so cost grows with days, not rows.
+    """
+    if granularity not in HISTORY_PERIODS:
+        raise ValueError(f"Unknown granularity: {granularity}")
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT daily_calorie_goal FROM users WHERE user_id = ?", (user_id,))
+    user_row = cursor.fetchone()
+    goal = (user_row['daily_calorie_goal'] if user_row else None) or 2000
+
+    cursor.execute(f'''
+        SELECT
+            {HISTORY_PERIODS[granularity]} AS period_start,
+            COUNT(*) AS days_logged,
+            SUM(calories) AS total_calories,
+            SUM(protein) AS total_protein,
+            SUM(carbs) AS total_carbs,
+            SUM(fats) AS total_fats,
+            SUM(health_score_sum) AS health_score_sum,
+            SUM(health_score_count) AS health_score_count,
+            SUM(item_count) AS item_count,
+            SUM(calories BETWEEN ? AND ?) AS days_on_target
+        FROM daily_totals
+        WHERE user_id = ? AND day >= ? AND day <= ?
+        GROUP BY period_start
+        ORDER BY period_start
+    ''', (goal * (1 - GOAL_TOLERANCE), goal * (1 + GOAL_TOLERANCE), user_id, str(start), str(end)))
+    rows = cursor.fetchall()
+    conn.close()
+
+    periods = []
+    for row in rows:
+        days = row['days_logged']
+        periods.append({
+            'period_start': row['period_start'],
+            'days_logged': days,
+            'total_calories': row['total_calories'],
+            'total_protein': row['total_protein'],
+            'total_carbs': row['total_carbs'],
+            'total_fats': row['total_fats'],
+            'avg_calories': row['total_calories'] / days,
+            'avg_protein': row['total_protein'] / days,
+            'avg_carbs': row['total_carbs'] / days,
+            'avg_fats': row['total_fats'] / days,
+            'avg_health_score': (row['health_score_sum'] / row['health_score_count']) if row['health_score_count'] else None,
+            'item_count': row['item_count'],
+            'days_on_target': row['days_on_target'],
+            'goal_pct': row['total_calories'] / days / goal * 100
+        })
+
+    # Averages over every logged day in the range
+    days_logged = sum(p['days_logged'] for p in periods)
+    averages = {
+        'days_logged': days_logged,
+        'days_on_target': sum(p['days_on_target'] for p in periods),
+        'avg_calories': 0,
+        'avg_protein': 0,
+        'avg_carbs': 0,
+        'avg_fats': 0,
+        'adherence_pct': 0
+    }
+    if days_logged:
+        averages['avg_calories'] = sum(p['total_calories'] for p in periods) / days_logged
+        averages['avg_protein'] = sum(p['total_protein'] for p in periods) / days_logged
+        averages['avg_carbs'] = sum(p['total_carbs'] for p in periods) / days_logged
+        averages['avg_fats'] = sum(p['total_fats'] for p in periods) / days_logged
+        averages['adherence_pct'] = averages['days_on_target'] / days_logged * 100
+
+    return {
+        'granularity': granularity,
+        'start': str(start),
+        'end': str(end),
+        'daily_calorie_goal': goal,
+        'periods': periods,
+        'averages': averages
+    }
+
+def export_logs(user_id: int, start, end):
+    """
+    Returns every log of a user between two dates (inclusive), oldest first.
+    Reads both the hot table and the archive.
+    """
+    range_start, _ = get_day_bounds(start)
+    _, range_end = get_day_bounds(end)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # UNION (not UNION ALL) also drops rows that are briefly in both tables mid-archive
+    cursor.execute(f'''
+        SELECT {LOG_COLUMNS} FROM main.logs
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+        UNION
+        SELECT {LOG_COLUMNS} FROM archive.logs
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp, id
+    ''', (user_id, range_start, range_end, user_id, range_start, range_end))
     rows = cursor.fetchall()
     conn.close()
     return rows
 
+def archive_old_logs(max_age_days: int, batch_size: int = 5000):
+    """
+    Moves logs older than `max_age_days` from the hot table into the archive database.
+    Works in small batches so the bot keeps writing in between. daily_totals is left untouched,
+    so history keeps covering archived days. Returns the number of rows moved.
+    """
+    cutoff, _ = get_day_bounds(datetime.now(timezone.utc).date() - timedelta(days=max_age_days))
+    moved = 0
+    conn = get_db_connection()
+    try:
+        while True:
+            # A range on idx_logs_timestamp: the last (empty) batch costs one index probe
+            cursor = conn.execute(
+                "SELECT id FROM main.logs WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (cutoff, batch_size)
+            )
+            ids = [row['id'] for row in cursor.fetchall()]
+            if not ids:
+                break
+            placeholders = ",".join("?" * len(ids))
+
+            # 1. Copy into the archive and commit (re-running after a crash is harmless)
+            with conn:
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO archive.logs ({LOG_COLUMNS})
+                    SELECT {LOG_COLUMNS} FROM main.logs WHERE id IN ({placeholders})
+                ''', ids)
+
+            # 2. Delete from the hot table without touching daily_totals: the flag row silences
+            # the delete trigger and is gone again before anyone else can see it
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR IGNORE INTO maintenance_flags (name) VALUES (?)", (ARCHIVING_FLAG,))
+                conn.execute(f"DELETE FROM main.logs WHERE id IN ({placeholders})", ids)
+                conn.execute("DELETE FROM maintenance_flags WHERE name = ?", (ARCHIVING_FLAG,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            moved += len(ids)
+    finally:
+        conn.close()
+    if moved:
+        print(f"Archived {moved} logs older than {cutoff}.")
+    return moved
+
+def compact_db(pages_per_step: int = 2000):
+    """
+    Returns free pages to the OS in small steps so writers can interleave, then truncates the WAL.
+    Safe to run while the bot is writing. Databases created before auto_vacuum was enabled have
+    no incremental mode; they need a one-off `vacuum_db()` (python src/database/db.py vacuum).
+    """
+    conn = get_db_connection()
+    try:
+        for schema in ("main", "archive"):
+            if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == 2: # 2 = INCREMENTAL
+                free_pages = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                while free_pages > 0:
+                    conn.execute(f"PRAGMA {schema}.incremental_vacuum({pages_per_step})").fetchall()
+                    remaining = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                    if remaining >= free_pages:
+                        break # No progress (e.g. a long-running reader); try again next time
+                    free_pages = remaining
+            else:
+                print(f"{schema} database is not in incremental auto_vacuum mode; "
+                      "run `python src/database/db.py vacuum` once while the bot is stopped.")
+            conn.execute(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)").fetchall()
+    finally:
+        conn.close()
+
+def vacuum_db():
+    """
+    Switches both databases to incremental auto_vacuum with a full VACUUM.
+    Rewrites the whole file and blocks writers while it runs: an admin step, not for the running bot.
+    """
+    conn = get_db_connection()
+    try:
+        for schema in ("main", "archive"):
+            if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != 2:
+                conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+                conn.execute(f"VACUUM {schema}")
+                print(f"Vacuumed {schema}; it now compacts incrementally.")
+    finally:
+        conn.close()
+
+def get_cached_response(cache_key: str, ttl_seconds: float):
+    """
+    Returns (value, created_at) for a key, or None if missing or older than `ttl_seconds`.
+    Expired entries are deleted on the way.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            row = conn.execute("SELECT value, created_at FROM llm_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row is None:
+                return None
+            if now - row['created_at'] > ttl_seconds:
+                conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (cache_key,))
+                return None
+            conn.execute("UPDATE llm_cache SET last_used = ? WHERE cache_key = ?", (now, cache_key))
+            return row['value'], row['created_at']
+    finally:
+        conn.close()
+
+def put_cached_response(cache_key: str, value: str):
+    """
+    Stores (or refreshes) a cached value.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO llm_cache (cache_key, value, created_at, last_used) VALUES (?, ?, ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET value = excluded.value, created_at = excluded.created_at, last_used = excluded.last_used
+            ''', (cache_key, value, now, now))
+    finally:
+        conn.close()
+
+def evict_cached_responses(max_entries: int, ttl_seconds: float) -> int:
+    """
+    Drops expired entries, then the least recently used ones above `max_entries`.
+    Returns how many entries were removed.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            removed = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - ttl_seconds,)).rowcount
+            count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > max_entries:
+                removed += conn.execute('''
+                    DELETE FROM llm_cache WHERE cache_key IN (
+                        SELECT cache_key FROM llm_cache ORDER BY last_used LIMIT ?
+                    )
+                ''', (count - max_entries,)).rowcount
+    finally:
+        conn.close()
+    return removed
+
+def _to_signed_64(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def find_similar_image(user_id: int, dhash: int, colors: bytes, caption: str, max_distance: int,
+                       max_color_distance: float, ttl_seconds: float, limit: int):
+    """
+    Returns the cached analysis (log_data JSON, reply) of the closest recent photo of this user
+    within `max_distance` bits of `dhash` and `max_color_distance` of its colour histogram, or None.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT dhash, colors, log_data, reply FROM image_cache
+        WHERE user_id = ? AND caption = ? AND created_at >= ? AND colors IS NOT NULL
+        ORDER BY created_at DESC
+        LIMIT ?
+    ''', (user_id, caption, time.time() - ttl_seconds, limit))
+    rows = cursor.fetchall()
+    conn.close()
+
+    # Hamming distance between 64-bit hashes
+    best = None
+    best_distance = max_distance + 1
+    for row in rows:
+        distance = ((row['dhash'] & ((1 << 64) - 1)) ^ dhash).bit_count()
+        # Share of pixels whose colour bin changed (image_service.color_distance)
+        color_change = sum(abs(a - b) for a, b in zip(row['colors'], colors)) / (2 * 255)
+        if distance < best_distance and color_change <= max_color_distance:
+            best, best_distance = row, distance
+    return (best['log_data'], best['reply']) if best else None
+
+def put_image_analysis(user_id: int, dhash: int, colors: bytes, caption: str, log_data: str, reply: str,
+                       max_per_user: int, ttl_seconds: float):
+    """
+    Stores a photo analysis and evicts this user's expired or oldest entries above `max_per_user`.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO image_cache (user_id, dhash, colors, caption, log_data, reply, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, _to_signed_64(dhash), colors, caption, log_data, reply, now))
+            conn.execute('''
+                DELETE FROM image_cache WHERE user_id = ? AND (created_at < ? OR id NOT IN (
+                    SELECT id FROM image_cache WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
+                ))
+            ''', (user_id, now - ttl_seconds, user_id, max_per_user))
+    finally:
+        conn.close()
+
+def get_cached_product(barcode: str):
+    """
+    Returns (product JSON or None for a known miss, fetched_at) for a barcode, or None if never fetched.
+    Freshness is up to the caller.
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT product, fetched_at FROM product_cache WHERE barcode = ?", (barcode,)).fetchone()
+        return (row['product'], row['fetched_at']) if row else None
+    finally:
+        conn.close()
+
+def put_cached_product(barcode: str, product: str = None):
+    """
+    Stores a lookup result; `product` None records that OFF does not know the barcode.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO product_cache (barcode, product, fetched_at) VALUES (?, ?, ?)
+                ON CONFLICT (barcode) DO UPDATE SET product = excluded.product, fetched_at = excluded.fetched_at
+            ''', (barcode, product, time.time()))
+    finally:
+        conn.close()
+
+def evict_cached_products(max_age_seconds: float, negative_max_age_seconds: float) -> int:
+    """
+    Drops products older than `max_age_seconds` and misses older than `negative_max_age_seconds`.
+    Returns how many entries were removed.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            return conn.execute(
+                "DELETE FROM product_cache WHERE fetched_at < ? OR (product IS NULL AND fetched_at < ?)",
+                (now - max_age_seconds, now - negative_max_age_seconds)
+            ).rowcount
+    finally:
+        conn.close()
+
+def upsert_products(rows: list) -> int:
+    """
+    Adds or updates searchable products from (barcode, name, calories, protein, carbs, fats) rows.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            return conn.executemany('''
+                INSERT INTO products (barcode, name, calories, protein, carbs, fats, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (barcode) DO UPDATE SET
+                    name = excluded.name, calories = excluded.calories, protein = excluded.protein,
+                    carbs = excluded.carbs, fats = excluded.fats, updated_at = excluded.updated_at
+            ''', [(*row, now) for row in rows]).rowcount
+    finally:
+        conn.close()
+
+def search_products(match: str, limit: int = 10, offset: int = 0):
+    """
+    Returns one page of products matching an FTS5 query, best BM25 score first.
+    """
+    conn = get_db_connection()
+    try:
+        # Rank inside FTS5 and only join the page (BM25 already favours short names)
+        rows = conn.execute('''
+            SELECT p.barcode, p.name, p.calories, p.protein, p.carbs, p.fats
+            FROM (
+                SELECT rowid, rank FROM products_fts WHERE products_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?
+            ) AS hit JOIN products p ON p.id = hit.rowid
+            ORDER BY hit.rank
+        ''', (match, limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+def optimize_product_search():
+    """
+    Merges the FTS index segments (worth it after a bulk import).
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute("INSERT INTO products_fts (products_fts) VALUES ('optimize')")
+    finally:
+        conn.close()
+
+# Rows whose health score or micronutrients were never filled in
+MISSING_ENRICHMENT = "(health_score IS NULL OR micronutrients IS NULL OR micronutrients IN ('', 'N/A'))"
+
+def iter_logs_for_reanalysis(only_missing: bool = True, user_id: int = None, since=None, page_size: int = 2000):
+    """
+    Yields (schema, row) for hot and archived logs, oldest id first, one page at a time.
+    Keyset pagination keeps memory flat and never holds a connection between pages.
+    """
+    conditions, params = [], []
+    if only_missing:
+        conditions.append(MISSING_ENRICHMENT)
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        params.append(get_day_bounds(since)[0])
+    where = "".join(f" AND {c}" for c in conditions)
+
+    for schema in ("main", "archive"):
+        last_id = 0
+        while True:
+            conn = get_db_connection()
+            try:
+                rows = conn.execute(
+                    f"SELECT {LOG_COLUMNS} FROM {schema}.logs WHERE id > ?{where} ORDER BY id LIMIT ?",
+                    (last_id, *params, page_size)
+                ).fetchall()
+            finally:
+                conn.close()
+            if not rows:
+                break
+            for row in rows:
+                yield schema, row
+            last_id = rows[-1]['id']
+
+def apply_log_enrichment(updates: list) -> int:
+    """
+    Writes re-analysed health scores and micronutrients in one transaction.
+    `updates` holds (schema, log_id, health_score, micronutrients) tuples.
+    Rows that already hold those values are skipped, so re-applying a batch changes nothing.
+    Hot rows keep daily_totals current through the update trigger; archived rows (no triggers)
+    adjust their day's health score totals here. Returns the number of rows changed.
+    """
+    hot = [{'id': i, 'health_score': h, 'micronutrients': m} for schema, i, h, m in updates if schema == "main"]
+    cold = [{'id': i, 'health_score': h, 'micronutrients': m} for schema, i, h, m in updates if schema == "archive"]
+    changed_filter = "id = :id AND (health_score IS NOT :health_score OR micronutrients IS NOT :micronutrients)"
+    conn = get_db_connection()
+    try:
+        with conn:
+            changed = conn.executemany(
+                f"UPDATE main.logs SET health_score = :health_score, micronutrients = :micronutrients WHERE {changed_filter}",
+                hot
+            ).rowcount
+            if cold:
+                # Must run before the archive rows change, while the old score is still readable
+                conn.executemany('''
+                    UPDATE daily_totals SET
+                        health_score_sum = health_score_sum
+                            - COALESCE((SELECT health_score FROM archive.logs WHERE id = :id), 0) + :health_score,
+                        health_score_count = health_score_count
+                            - ((SELECT health_score FROM archive.logs WHERE id = :id) IS NOT NULL) + 1
+                    WHERE (user_id, day) = (
+                        SELECT user_id, date(timestamp) FROM archive.logs
+                        WHERE id = :id AND health_score IS NOT :health_score
+                    )
+                ''', cold)
+                changed += conn.executemany(
+                    f"UPDATE archive.logs SET health_score = :health_score, micronutrients = :micronutrients WHERE {changed_filter}",
+                    cold
+                ).rowcount
+    finally:
+        conn.close()
+    return changed
+
+def save_batch_job(batch_id: str, kind: str, backend: str, input_path: str, prompt_version: str, request_count: int):
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO batch_jobs (batch_id, kind, backend, input_path, prompt_version, request_count, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'submitted', ?, ?)
+            ''', (batch_id, kind, backend, input_path, prompt_version, request_count, now, now))
+    finally:
+        conn.close()
+
+def update_batch_job(batch_id: str, **fields):
+    """
+    Updates status / output_path / applied_count of a batch job.
+    """
+    allowed = {'status', 'output_path', 'applied_count'}
+    assignments = ", ".join(f"{name} = ?" for name in fields if name in allowed)
+    values = [value for name, value in fields.items() if name in allowed]
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute(
+                f"UPDATE batch_jobs SET {assignments}, updated_at = ? WHERE batch_id = ?",
+                (*values, time.time(), batch_id)
+            )
+    finally:
+        conn.close()
+
+def get_batch_jobs(statuses=None):
+    """
+    Returns batch jobs, newest first, optionally only those in `statuses`.
+    """
+    conn = get_db_connection()
+    try:
+        if statuses:
+            marks = ", ".join("?" for _ in statuses)
+            return conn.execute(
+                f"SELECT * FROM batch_jobs WHERE status IN ({marks}) ORDER BY created_at DESC", tuple(statuses)
+            ).fetchall()
+        return conn.execute("SELECT * FROM batch_jobs ORDER BY created_at DESC").fetchall()
+    finally:
+        conn.close()
+
+LLM_USAGE_COUNTERS = ("calls", "errors", "retries", "prompt_tokens", "completion_tokens", "image_bytes", "cost_usd", "latency_ms_sum")
+
+def add_llm_usage(rows: list):
+    """
+    Adds counters to the daily LLM usage rollup in one transaction.
+    `rows` holds dicts with day, endpoint, model, user_id and the LLM_USAGE_COUNTERS.
+    """
+    if not rows:
+        return
+    columns = ", ".join(LLM_USAGE_COUNTERS)
+    values = ", ".join(f":{c}" for c in LLM_USAGE_COUNTERS)
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in LLM_USAGE_COUNTERS)
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.executemany(f'''
+                INSERT INTO llm_usage_daily (day, endpoint, model, user_id, {columns})
+                VALUES (:day, :endpoint, :model, :user_id, {values})
+                ON CONFLICT (day, endpoint, model, user_id) DO UPDATE SET {updates}
+            ''', rows)
+    finally:
+        conn.close()
+
+def get_llm_usage(start_day: str, group_by: str = "endpoint", limit: int = 20):
+    """
+    Sums the LLM usage rollup from `start_day` (YYYY-MM-DD) on, grouped by
+    "endpoint", "model", "user_id" or "day", most expensive first.
+    """
+    if group_by not in ("endpoint", "model", "user_id", "day"):
+        raise ValueError(f"Unsupported grouping: {group_by}")
+    sums = ", ".join(f"SUM({c}) AS {c}" for c in LLM_USAGE_COUNTERS)
+    conn = get_db_connection()
+    try:
+        return conn.execute(f'''
+            SELECT {group_by} AS key, {sums} FROM llm_usage_daily
+            WHERE day >= ? GROUP BY {group_by} ORDER BY cost_usd DESC LIMIT ?
+        ''', (start_day, limit)).fetchall()
+    finally:
+        conn.close()
+
 def delete_log(log_id: int):
     """
     Deletes a specific log entry by ID.
@@ -151,9 +1342,144 @@ def clear_daily_logs(user_id: int):
     """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM logs WHERE user_id = ? AND date(timestamp) = date('now')", (user_id,))
+    day_start, day_end = get_day_bounds()
+    cursor.execute(
+        "DELETE FROM logs WHERE user_id = ? AND timestamp >= ? AND timestamp < ?",
+        (user_id, day_start, day_end)
+    )
     conn.commit()
     conn.close()
 
 if __name__ == "__main__":
+    import sys
+    # Usage: python src/database/db.py rebuild-totals
+    #        python src/database/db.py archive <max_age_days>
+    #        python src/database/db.py vacuum   (one-off, with the bot stopped, for databases created before auto_vacuum)
+    # Self-checks against a temporary database:
+    #        python src/database/db.py check-plans [users] [days]   (per-user day queries must use idx_logs_user_timestamp)
+    #        python src/database/db.py bench-pool [calls]           (connect per call vs the pool)
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command in ("check-plans", "bench-pool"):
+        import random
+        import tempfile
+        DB_PATH = os.path.join(tempfile.mkdtemp(), "check.db")
     init_db()
+
+    def fill_logs(users: int, days: int, per_day: int = 4):
+        rng = random.Random(0)
+        today = datetime.now(timezone.utc).date()
+        rows = []
+        for user_id in range(1, users + 1):
+            for day in range(days):
+                start, _ = get_day_bounds(today - timedelta(days=day))
+                for meal in range(per_day):
+                    timestamp = (datetime.fromisoformat(start) + timedelta(hours=7 + 4 * meal)).isoformat(" ")
+                    rows.append((user_id, f"food {meal}", rng.randint(100, 800), 20.0, 50.0, 15.0, rng.randint(1, 10), timestamp))
+        conn = get_db_connection()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, health_score, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+        finally:
+            conn.close()
+        return len(rows)
+
+    def timed(conn, sql: str, params, runs: int = 20) -> float:
+        start = time.perf_counter()
+        for _ in range(runs):
+            conn.execute(sql, params).fetchall()
+        return (time.perf_counter() - start) / runs * 1000
+
+    if command == "rebuild-totals":
+        rebuild_daily_totals()
+    elif command == "archive" and len(sys.argv) > 2:
+        archive_old_logs(int(sys.argv[2]))
+        compact_db()
+    elif command == "vacuum":
+        vacuum_db()
+    elif command == "check-plans":
+        users = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        days = int(sys.argv[3]) if len(sys.argv) > 3 else 90
+        print(f"{fill_logs(users, days)} logs for {users} users over {days} days")
+
+        # Record the SQL the real functions run, then ask SQLite how it plans each logs query
+        traced = []
+        pool = get_pool()
+        conns = [pool.acquire() for _ in range(pool.size)]
+        for conn in conns:
+            conn.set_trace_callback(traced.append)
+        for conn in conns:
+            pool.release(conn)
+        today = datetime.now(timezone.utc).date()
+        get_daily_logs(7)
+        get_daily_summary(7)
+        get_today_snapshot(7)
+        export_logs(7, today - timedelta(days=30), today)
+        clear_daily_logs(7)
+        for conn in conns:
+            conn.set_trace_callback(None)
+
+        conn = get_db_connection()
+        failures = 0
+        statements = [sql for sql in dict.fromkeys(traced) if "logs" in sql and "user_id =" in sql]
+        for sql in statements:
+            plan = [row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            # Every read of a logs table must be an index search, never a scan
+            bad = [step for step in plan if step.startswith("SCAN") and "logs" in step and "INDEX" not in step]
+            uses_index = any("idx_logs_user_timestamp" in step or "idx_archive_logs_user_timestamp" in step for step in plan)
+            ok = uses_index and not bad
+            failures += not ok
+            print(("ok  " if ok else "FAIL") + "  " + " ".join(sql.split())[:110])
+            for step in plan:
+                print(f"        {step}")
+
+        # What the index buys: today's rows by date() (the old filter) vs the range seek
+        day_start, day_end = get_day_bounds(today)
+        old = timed(conn, "SELECT * FROM logs NOT INDEXED WHERE user_id = ? AND date(timestamp) = date('now')", (8,))
+        new = timed(conn, "SELECT * FROM logs WHERE user_id = ? AND timestamp >= ? AND timestamp < ?", (8, day_start, day_end))
+        conn.close()
+        print(f"today's logs for one user: date() filter {old:.2f} ms, index range {new:.3f} ms")
+        assert statements, "no per-user logs queries were traced"
+        assert not failures, f"{failures} queries no longer use the (user_id, timestamp) index"
+        print("OK")
+    elif command == "bench-pool":
+        calls = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        fill_logs(50, 30)
+        query = "SELECT SUM(calories) FROM logs WHERE user_id = ? AND timestamp >= ?"
+        since, _ = get_day_bounds(datetime.now(timezone.utc).date() - timedelta(days=7))
+
+        def per_call():
+            # What get_db_connection() did before the pool: a fresh connection for every call
+            conn = sqlite3.connect(DB_PATH)
+            conn.row_factory = sqlite3.Row
+            try:
+                return conn.execute(query, (7, since)).fetchone()
+            finally:
+                conn.close()
+
+        def pooled():
+            conn = get_db_connection()
+            try:
+                return conn.execute(query, (7, since)).fetchone()
+            finally:
+                conn.close()
+
+        def threaded(func, threads: int = 8) -> float:
+            workers = [threading.Thread(target=lambda: [func() for _ in range(calls // threads)]) for _ in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            return (time.perf_counter() - start) / calls * 1e6
+
+        pooled() # open the pool's first connection outside the timing
+        for name, func in (("connect per call", per_call), ("pool", pooled)):
+            start = time.perf_counter()
+            for _ in range(calls):
+                func()
+            single = (time.perf_counter() - start) / calls * 1e6
+            print(f"{name:>16}: {single:.0f} us/call, {threaded(func):.0f} us/call across 8 threads")
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from src.config import LOG_WRITER_FLUSH_MS, LOG_WRITER_MAX_ROWS, LOG_WRITER_SYNCHRONOUS
+from src.database import db
+from src.database.async_db import insert_meal_logs
+
+@dataclass
+class _PendingWrite:
+    user_id: int
+    rows: list
+    future: asyncio.Future
+
+class LogWriter:
+    """
+    Write-behind writer for meal logs.
+    Inserts from all users are queued and committed together in one transaction
+    every `flush_ms` milliseconds or `max_rows` rows, so a lunch-time burst costs
+    one commit per batch instead of one per meal. Callers await until their batch is committed
+    (and, with synchronous="FULL", fsynced).
+    """
+    def __init__(self, flush_ms: int = LOG_WRITER_FLUSH_MS, max_rows: int = LOG_WRITER_MAX_ROWS,
+                 synchronous: str = LOG_WRITER_SYNCHRONOUS):
+        self.flush_ms = flush_ms
+        self.max_rows = max_rows
+        self.synchronous = synchronous
+        self._queue = None
+        self._task = None
+        self._conn = None
+        self._executor = None
+        self._closing = False
+        self.batches = 0
+        self.rows_written = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        # Single thread: SQLite only has one writer anyway, and the connection stays on it.
+        # Created here so the writer can be started again after close().
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-writer")
+        self._closing = False
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(self._executor, db.open_writer_connection, self.synchronous)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def write(self, user_id: int, rows: list):
+        """
+        Queues a meal's rows and waits until they are committed.
+        Returns today's snapshot for the user, like db.insert_meal_logs.
+        """
+        if not self.running or self._closing:
+            # Not started (scripts) or shutting down (nothing queued after close() is read):
+            # fall back to a direct transaction
+            return await insert_meal_logs(user_id, rows)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingWrite(user_id, rows, future))
+        return await future
+
+    async def close(self):
+        """
+        Stops accepting writes, flushes everything still queued and closes the connection
+        and the writer thread (start() creates new ones).
+        """
+        if self.running:
+            # Set before the sentinel: writes arriving from now on bypass the queue
+            self._closing = True
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            row_count = len(first.rows)
+
+            # Keep collecting until the window closes or the batch is full
+            deadline = loop.time() + self.flush_ms / 1000
+            while row_count < self.max_rows:
+                try:
+                    pending = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+                row_count += len(pending.rows)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, db.insert_meal_log_batch, self._conn, [(p.user_id, p.rows) for p in batch]
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch[0], e)
+                return
+            # One bad meal must not fail everyone else's: retry each on its own
+            logging.warning(f"Group commit of {len(batch)} meals failed ({e}); retrying individually.")
+            for pending in batch:
+                await self._flush([pending])
+            return
+
+        self.batches += 1
+        self.rows_written += sum(len(p.rows) for p in batch)
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    @staticmethod
+    def _fail(pending: _PendingWrite, error: Exception):
+        logging.error(f"Failed to write logs for user {pending.user_id}: {error}")
+        if not pending.future.done():
+            pending.future.set_exception(error)
+
+# Shared instance, started in main()
+log_writer = LogWriter()
+
+if __name__ == "__main__":
+    # Group commit vs a commit per meal: python -m src.database.log_writer [meals] [users] [seconds]
+    # Meals arrive at random over `seconds`. Each mode gets a fresh database next to the real one
+    # (a temp dir may be tmpfs, where fsync costs nothing).
+    import os
+    import random
+    import shutil
+    import sys
+    import tempfile
+    import time
+
+    meals = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    rng = random.Random(0)
+    arrivals = sorted((rng.uniform(0, seconds), rng.randint(1, users)) for _ in range(meals))
+    rows = [("Chicken breast", 280, 52.7, 0.0, 6.1, "B3, B6", 8, None, "Lunch"),
+            ("Rice", 260, 5.4, 56.0, 0.6, "N/A", 6, None, "Lunch")]
+    workdir = tempfile.mkdtemp(prefix="bench-", dir=os.path.dirname(os.path.abspath(db.DB_PATH)))
+    default_pragmas = list(db.CONNECTION_PRAGMAS)
+
+    async def replay(write) -> list:
+        start = time.perf_counter()
+        latencies = []
+
+        async def meal(at: float, user_id: int):
+            await asyncio.sleep(max(0.0, at - (time.perf_counter() - start)))
+            t = time.perf_counter()
+            await write(user_id, rows)
+            latencies.append(time.perf_counter() - t)
+
+        await asyncio.gather(*(meal(at, user_id) for at, user_id in arrivals))
+        return sorted(latencies), time.perf_counter() - start
+
+    async def run(label: str, synchronous: str, group: bool):
+        db.DB_PATH = os.path.join(workdir, f"{label.replace(' ', '-').replace(',', '')}.db")
+        db.CONNECTION_PRAGMAS[:] = default_pragmas + [f"PRAGMA synchronous = {synchronous}"]
+        db.init_db()
+        if group:
+            writer = LogWriter(synchronous=synchronous)
+            await writer.start()
+            latencies, elapsed = await replay(writer.write)
+            commits = writer.batches
+            await writer.close()
+        else:
+            latencies, elapsed = await replay(insert_meal_logs)
+            commits = meals
+        db.close_db_pool()
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        print(f"{label:>24}: {commits:5d} commits ({commits / elapsed:6.0f}/s), {meals / elapsed:5.0f} meals/s, "
+              f"p50 {p50 * 1000:6.2f} ms, p99 {p99 * 1000:6.2f} ms")
+
+    async def main():
+        print(f"{meals} two-item meals from {users} users over {seconds:g} s, in {workdir}")
+        for synchronous in db.WRITER_SYNCHRONOUS_MODES:
+            await run(f"commit per meal, {synchronous}", synchronous, group=False)
+            await run(f"group commit, {synchronous}", synchronous, group=True)
+
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
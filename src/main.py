@@ -2,9 +2,11 @@ import asyncio
 import logging
 import sys
 import os
-import uuid
 
+import csv
+import io
 import json
+from datetime import date, datetime, timedelta, timezone
 
 import base64
 
@@ -13,16 +15,28 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command, StateFilter
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, WebAppInfo
+from aiogram.types import Message, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, WebAppInfo
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from src.config import TELEGRAM_BOT_TOKEN
-from src.database.db import init_db, get_db_connection, get_daily_summary, clear_daily_logs, get_daily_logs, delete_log, get_logs_by_group
+from src.config import TELEGRAM_BOT_TOKEN, LOG_ARCHIVE_AFTER_DAYS, STREAM_REPLIES, ADMIN_USER_IDS, METRICS_PORT, METRICS_FLUSH_SECONDS
+from src.database.async_db import (
+    init_db, close_db, register_user, set_daily_calorie_goal, update_user_profile,
+    get_daily_summary, get_today_snapshot, clear_daily_logs, delete_log, get_logs_by_group, get_history,
+    export_logs, archive_old_logs, compact_db, get_llm_usage
+)
 from src.services.openai_service import process_user_message, analyze_food_image
+from src.services.metrics_service import llm_metrics, start_metrics_server
+from src.services.product_cache import product_cache
 from src.services.calculator_service import calculate_daily_goals_deterministic
-from src.services.off_service import search_product, get_product_by_barcode
+from src.services.meal_service import log_meal, current_meal_period
+from src.database.log_writer import log_writer
+from src.services.product_search import product_search
+from src.services.off_service import get_product_by_barcode, init_session as init_off_session, close_session as close_off_session
 from src.services.barcode_service import decode_barcode
 from src.utils.visualization import generate_text_progress_bar
+from src.utils.live_message import LiveMessage
+from src.utils.media_group import MediaGroupCollector
 from src.services.firebase_service import init_firebase, update_user_stats_in_firebase
 
 # Define States
@@ -49,6 +63,9 @@ dp = Dispatcher()
 # Initialize Firebase
 init_firebase()
 
+# Collects the photos of Telegram albums
+media_groups = MediaGroupCollector()
+
 # Main Menu Keyboard
 # NOTE: Replace 'https://your-webapp-url.com' with your actual hosted URL
 def get_main_menu(user_id):
@@ -74,14 +91,10 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
     username = message.from_user.username
     
     # Register user if not exists
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-    conn.commit()
-    conn.close()
+    await register_user(user_id, username)
     
     # Get Daily Summary for the Dashboard
-    summary = get_daily_summary(user_id)
+    summary = await get_daily_summary(user_id)
     total_cals = summary['total_calories'] or 0
     
     # Create a nice welcome message
@@ -107,9 +120,8 @@ async def open_dashboard(message: Message):
     user_id = message.from_user.id
     
     # Sync latest data to Firebase before opening
-    summary = get_daily_summary(user_id)
-    logs = get_daily_logs(user_id)
-    update_user_stats_in_firebase(user_id, summary, logs)
+    snapshot = await get_today_snapshot(user_id)
+    update_user_stats_in_firebase(user_id, snapshot)
     
     # Construct URL with userId param
     base_url = "https://amrani-sohaib.github.io/AI-nutrition-bot/webapp/"
@@ -126,7 +138,7 @@ async def menu_cancel(message: Message, state: FSMContext):
     await state.clear()
     
     # Get Daily Summary for the Dashboard
-    summary = get_daily_summary(message.from_user.id)
+    summary = await get_daily_summary(message.from_user.id)
     total_cals = summary['total_calories'] or 0
     
     welcome_text = (
@@ -165,7 +177,7 @@ async def menu_scan_barcode(message: Message, state: FSMContext):
 
 @dp.message(F.text == "📊 Daily Journal")
 async def menu_daily_journal(message: Message):
-    summary = get_daily_summary(message.from_user.id)
+    summary = await get_today_snapshot(message.from_user.id)
     
     if not summary or not summary['total_calories']:
         await message.answer("You haven't logged any food today yet! 🍽️")
@@ -210,8 +222,13 @@ async def manage_logs_handler(callback: CallbackQuery):
     """
     Shows a list of today's logs with delete buttons.
     """
-    logs = get_daily_logs(callback.from_user.id)
-    
+    snapshot = await get_today_snapshot(callback.from_user.id)
+    await show_manage_logs(callback, snapshot['logs'])
+
+async def show_manage_logs(callback: CallbackQuery, logs):
+    """
+    Renders the delete list for the given logs.
+    """
     if not logs:
         await callback.answer("No logs found for today.", show_alert=True)
         return
@@ -239,25 +256,24 @@ async def delete_log_item(callback: CallbackQuery):
     Deletes a specific log item.
     """
     log_id = int(callback.data.split(":")[1])
-    delete_log(log_id)
+    await delete_log(log_id)
     
     # Sync to Firebase
-    summary = get_daily_summary(callback.from_user.id)
-    logs = get_daily_logs(callback.from_user.id)
-    update_user_stats_in_firebase(callback.from_user.id, summary, logs)
+    snapshot = await get_today_snapshot(callback.from_user.id)
+    update_user_stats_in_firebase(callback.from_user.id, snapshot)
     
     await callback.answer("Item deleted.")
     
     # Refresh the list
     # Check if there are any logs left
-    logs = get_daily_logs(callback.from_user.id)
+    logs = snapshot['logs']
     if not logs:
         # If no logs left, go back to empty journal view
         await callback.message.delete()
         await callback.message.answer("📅 <b>Daily Journal (Today)</b>\n\nNo logs found for today.", parse_mode="HTML")
     else:
         # If logs remain, refresh the list
-        await manage_logs_handler(callback)
+        await show_manage_logs(callback, logs)
 
 @dp.callback_query(F.data == "delete_log_done")
 async def delete_log_done(callback: CallbackQuery):
@@ -267,7 +283,7 @@ async def delete_log_done(callback: CallbackQuery):
     await callback.message.delete()
     
     # Let's re-fetch summary and edit back
-    summary = get_daily_summary(callback.from_user.id)
+    summary = await get_today_snapshot(callback.from_user.id)
     
     # Handle empty summary gracefully
     if not summary or not summary['total_calories']:
@@ -317,12 +333,11 @@ async def confirm_clear_logs(callback: CallbackQuery):
 
 @dp.callback_query(F.data == "clear_logs_yes")
 async def clear_logs_yes(callback: CallbackQuery):
-    clear_daily_logs(callback.from_user.id)
+    await clear_daily_logs(callback.from_user.id)
     
     # Sync to Firebase (Empty)
-    summary = get_daily_summary(callback.from_user.id)
-    logs = []
-    update_user_stats_in_firebase(callback.from_user.id, summary, logs)
+    snapshot = await get_today_snapshot(callback.from_user.id)
+    update_user_stats_in_firebase(callback.from_user.id, snapshot)
     
     await callback.message.edit_text("✅ <b>Today's logs have been cleared.</b>", parse_mode="HTML")
     await callback.answer("Cleared!")
@@ -332,31 +347,348 @@ async def clear_logs_no(callback: CallbackQuery):
     await callback.message.delete() # Just remove the confirmation message
     await callback.answer("Cancelled")
 
+# /search results per page; inline results per batch (Telegram asks for more as the user scrolls)
+SEARCH_PAGE_SIZE = 5
+INLINE_RESULTS = 20
+# How long an inline query waits for Open Food Facts when nothing matches locally;
+# the search keeps running, so the next keystroke finds its results
+INLINE_OFF_WAIT_SECONDS = 2.0
+
+def format_product(product: dict) -> str:
+    return (
+        f"{product['name']}\n"
+        f"Calories: {float(product['calories'] or 0):.0f} kcal per 100g\n"
+        f"Protein: {float(product['protein'] or 0):.1f}g · Carbs: {float(product['carbs'] or 0):.1f}g · "
+        f"Fats: {float(product['fats'] or 0):.1f}g"
+    )
+
+async def render_search_page(query: str, page: int):
+    """
+    Text and pagination keyboard for one page of /search results.
+    """
+    # One extra result tells whether there is a next page
+    products = await product_search.search(query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if not products:
+        return ("Product not found." if page == 0 else "No more results."), None
+
+    lines = [f"🔍 Results for '{query}' (page {page + 1}):"]
+    for number, product in enumerate(products[:SEARCH_PAGE_SIZE], start=page * SEARCH_PAGE_SIZE + 1):
+        lines.append(f"\n{number}. {format_product(product)}")
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️ Previous", callback_data=search_callback_data(query, page - 1)))
+    if len(products) > SEARCH_PAGE_SIZE:
+        buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=search_callback_data(query, page + 1)))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+def search_callback_data(query: str, page: int) -> str:
+    # Telegram caps callback data at 64 bytes; very long queries are cut
+    prefix = f"search:{page}:"
+    return prefix + query.encode("utf-8")[:64 - len(prefix)].decode("utf-8", "ignore")
+
 @dp.message(Command("search"))
 async def search_food_handler(message: Message) -> None:
     """
-    Searches for food in Open Food Facts
+    Searches products by name (local index first, Open Food Facts if nothing matches)
     Usage: /search <product name>
     """
     query = message.text.replace("/search", "").strip()
     if not query:
         await message.answer("Please provide a product name. Example: /search Nutella")
         return
+
+    text, keyboard = await render_search_page(query, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("search:"))
+async def search_page_callback(callback: CallbackQuery):
+    _, page, query = callback.data.split(":", 2)
+    text, keyboard = await render_search_page(query, int(page))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@dp.inline_query()
+async def inline_search_handler(inline_query: InlineQuery) -> None:
+    """
+    `@bot nutella` in any chat: ranked products from the local index, with the nutrition
+    facts as the message to send.
+    """
+    query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    products = await product_search.search(query, INLINE_RESULTS, offset, wait=INLINE_OFF_WAIT_SECONDS) if query else []
+    results, seen = [], set()
+    for i, product in enumerate(products):
+        # Telegram rejects the whole answer if two results share an id, and a nameless product is useless to send
+        result_id = product["barcode"] or str(offset + i)
+        if result_id in seen or not product["name"] or product["name"] == "Unknown":
+            continue
+        seen.add(result_id)
+        results.append(InlineQueryResultArticle(
+            id=result_id,
+            title=product["name"],
+            description=f"{float(product['calories'] or 0):.0f} kcal · P {float(product['protein'] or 0):.1f}g · "
+                        f"C {float(product['carbs'] or 0):.1f}g · F {float(product['fats'] or 0):.1f}g per 100g",
+            input_message_content=InputTextMessageContent(message_text=format_product(product))
+        ))
+    await inline_query.answer(
+        results,
+        # Don't let Telegram cache "nothing found" while the Open Food Facts fallback may still fill it
+        cache_time=300 if results else 0,
+        # Paging follows the unfiltered batch, so dropped products don't end the scroll early
+        next_offset=str(offset + INLINE_RESULTS) if len(products) == INLINE_RESULTS else ""
+    )
+
+# /history options: granularity and how many of those periods to show
+HISTORY_RANGES = {
+    'day': ('day', 7),
+    'week': ('week', 8),
+    'month': ('month', 6)
+}
+
+@dp.message(Command("history"))
+async def history_handler(message: Message) -> None:
+    """
+    Shows calorie/macro totals over time.
+    Usage: /history [day|week|month]
+    """
+    arg = message.text.replace("/history", "").strip().lower() or 'day'
+    if arg not in HISTORY_RANGES:
+        await message.answer("Usage: /history [day|week|month]")
+        return
+
+    granularity, count = HISTORY_RANGES[arg]
+    end = datetime.now(timezone.utc).date()
+    if granularity == 'day':
+        start = end - timedelta(days=count - 1)
+        title = f"last {count} days"
+    elif granularity == 'week':
+        start = end - timedelta(days=end.weekday() + 7 * (count - 1))
+        title = f"last {count} weeks"
+    else:
+        month_index = end.year * 12 + end.month - 1 - (count - 1)
+        start = date(month_index // 12, month_index % 12 + 1, 1)
+        title = f"last {count} months"
+
+    history = await get_history(message.from_user.id, start, end, granularity)
+    if not history['periods']:
+        await message.answer("No logs found for this period yet! 🍽️")
+        return
+
+    goal = history['daily_calorie_goal']
+    lines = [f"📈 <b>History ({title})</b>", f"🎯 Goal: {goal} kcal/day\n"]
+    for period in history['periods']:
+        period_start = date.fromisoformat(period['period_start'])
+        if granularity == 'day':
+            label = period_start.strftime("%a %d %b")
+            cals = f"{period['total_calories']} kcal"
+        elif granularity == 'week':
+            label = f"Week of {period_start.strftime('%d %b')}"
+            cals = f"{period['avg_calories']:.0f} kcal/day"
+        else:
+            label = period_start.strftime("%B %Y")
+            cals = f"{period['avg_calories']:.0f} kcal/day"
+        lines.append(
+            f"<b>{label}</b>: {cals} ({period['goal_pct']:.0f}%)\n"
+            f"   💪 {period['avg_protein']:.0f}g | 🍞 {period['avg_carbs']:.0f}g | 🥑 {period['avg_fats']:.0f}g per day"
+        )
+
+    averages = history['averages']
+    lines.append(
+        f"\n<b>📊 Averages ({averages['days_logged']} days logged)</b>\n"
+        f"🔥 {averages['avg_calories']:.0f} kcal/day\n"
+        f"💪 Protein: {averages['avg_protein']:.1f}g\n"
+        f"🍞 Carbs: {averages['avg_carbs']:.1f}g\n"
+        f"🥑 Fats: {averages['avg_fats']:.1f}g\n"
+        f"✅ On target (±10%): {averages['days_on_target']}/{averages['days_logged']} days ({averages['adherence_pct']:.0f}%)"
+    )
+
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+# /export period in days; the cap keeps the date arithmetic (and the file) bounded
+EXPORT_DEFAULT_DAYS = 30
+EXPORT_MAX_DAYS = 3650
+
+@dp.message(Command("export"))
+async def export_handler(message: Message) -> None:
+    """
+    Sends all logs of the last N days (default 30, at most 3650, archived ones included) as a CSV file.
+    Usage: /export [days]
+    """
+    arg = message.text.replace("/export", "").strip()
+    days = EXPORT_DEFAULT_DAYS
+    if arg:
+        # isascii: str.isdigit() also accepts digits such as "²" that int() rejects
+        days = int(arg) if arg.isascii() and arg.isdigit() else 0
+    if not 1 <= days <= EXPORT_MAX_DAYS:
+        await message.answer(f"Usage: /export [days] (1 to {EXPORT_MAX_DAYS}, default {EXPORT_DEFAULT_DAYS})")
+        return
+
+    end = datetime.now(timezone.utc).date()
+    start = end - timedelta(days=days - 1)
+    rows = await export_logs(message.from_user.id, start, end)
+    if not rows:
+        await message.answer("No logs found for this period yet! 🍽️")
+        return
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(rows[0].keys())
+    writer.writerows(tuple(row) for row in rows)
+    document = BufferedInputFile(output.getvalue().encode("utf-8"), filename=f"nutrition_{start}_{end}.csv")
+    await message.answer_document(document, caption=f"📤 {len(rows)} logs from {start} to {end}")
+
+@dp.message(Command("usage"))
+async def usage_handler(message: Message) -> None:
+    """
+    Admin only: LLM calls, tokens, cost and latency.
+    Usage: /usage [days] or /usage user <id>
+    """
+    if message.from_user.id not in ADMIN_USER_IDS:
+        return
+    args = message.text.replace("/usage", "").split()
+    if len(args) == 2 and args[0] == "user" and args[1].isdigit():
+        summary = llm_metrics.user_summary(int(args[1]))
+        if summary is None:
+            await message.answer("No LLM calls from this user in the last hour.")
+            return
+        await message.answer(
+            f"👤 <b>User {args[1]}, last hour</b>\n"
+            f"{summary['calls']} calls, {summary['errors']:.0f} errors, {summary['tokens']:.0f} tokens, "
+            f"${summary['cost_usd']:.4f}\np50 {summary['p50_ms']:.0f} ms, p95 {summary['p95_ms']:.0f} ms",
+            parse_mode="HTML"
+        )
+        return
+    if args and not args[0].isdigit():
+        await message.answer("Usage: /usage [days] or /usage user <id>")
+        return
+    days = int(args[0]) if args else 7
+
+    await llm_metrics.flush()
+    start = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+    lines = ["📟 <b>LLM usage, last hour</b>"]
+    for endpoint, summary in sorted(llm_metrics.endpoint_summary().items()):
+        lines.append(
+            f"<b>{endpoint}</b>: {summary['calls']} calls, {summary['errors']:.0f} errors, "
+            f"p50 {summary['p50_ms']:.0f} ms, p95 {summary['p95_ms']:.0f} ms, ${summary['cost_usd']:.4f}"
+        )
+    if len(lines) == 1:
+        lines.append("No calls yet.")
+
+    lines.append(f"\n📅 <b>Last {days} days</b>")
+    for row in await get_llm_usage(start, "endpoint"):
+        lines.append(
+            f"<b>{row['key']}</b>: {row['calls']} calls ({row['errors']} errors, {row['retries']} retries), "
+            f"{row['prompt_tokens'] + row['completion_tokens']} tokens, "
+            f"avg {row['latency_ms_sum'] / row['calls']:.0f} ms, ${row['cost_usd']:.2f}"
+        )
+    cache = product_cache.stats
+    lines.append(
+        f"\n🏷️ <b>Barcode cache</b>: hit rate {product_cache.hit_rate:.0%} "
+        f"({cache['memory_hits'] + cache['disk_hits']} hits incl. {cache['negative_hits']} unknown and "
+        f"{cache['stale_hits']} stale, {cache['misses']} misses, {cache['fetch_errors']} OFF errors)"
+    )
+    search = product_search.stats
+    lines.append(
+        f"🔎 <b>Product search</b>: {search['searches']} searches, {search['local_hits']} answered locally, "
+        f"{search['off_searches']} sent to OFF ({search['off_timeouts']} inline timeouts)"
+    )
+    top_users = await get_llm_usage(start, "user_id", limit=5)
+    if top_users:
+        lines.append("\n👥 <b>Top users by cost</b>")
+        lines += [f"{row['key'] or 'unknown'}: {row['calls']} calls, ${row['cost_usd']:.2f}" for row in top_users]
+
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+async def analyze_and_log_photos(message: Message, state: FSMContext, paths: list, caption: str):
+    """
+    Analyzes one photo or a whole album in a single vision call, logs it as one meal and
+    sends the reply and the totals. Deletes the downloaded files.
+    """
+    live = LiveMessage(message)
+    try:
+        log_data, reply = await analyze_food_image(
+            paths, caption, user_id=message.from_user.id,
+            on_progress=live.update if STREAM_REPLIES else None
+        )
+    finally:
+        # Clean up files
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
         
-    await message.answer(f"Searching for '{query}'... 🔍")
-    product = await search_product(query)
+    # Send the conversational reply first (replaces the streamed text)
+    await live.finish(reply)
     
-    if product:
-        response = (
-            f"Found: {product['name']}\n"
-            f"Calories: {product['calories']} kcal per 100g\n"
-            f"Protein: {product['protein']}g\n"
-            f"Carbs: {product['carbs']}g\n"
-            f"Fats: {product['fats']}g"
+    # Log data if found
+    result = await log_meal(message.from_user.id, log_data, source="photo") if log_data else None
+    if result:
+        group_id = result.group_id
+        total_cals = result.total_calories
+        total_prot = result.total_protein
+        total_carbs = result.total_carbs
+        total_fats = result.total_fats
+        avg_score = result.avg_health_score
+        items_found = [
+            f"{item.name} ({item.weight_g:g}g)" if item.weight_g is not None else item.name
+            for item in result.items
+        ]
+        
+        # Sync to Firebase
+        update_user_stats_in_firebase(message.from_user.id, result.day_snapshot)
+        
+        # Generate text-based chart
+        macro_chart = generate_text_progress_bar(total_prot, total_carbs, total_fats)
+        
+        # Send SYNTHESIS (Totals + Chart)
+        synthese_text = (
+            f"✅ <b>Logged:</b> {', '.join(items_found)}\n\n"
+            f"<b>📊 Total Nutrition:</b>\n"
+            f"🔥 <b>{total_cals} Calories</b>\n"
+            f"💪 Protein: {total_prot:.1f}g\n"
+            f"🍞 Carbs: {total_carbs:.1f}g\n"
+            f"🥑 Fats: {total_fats:.1f}g\n"
+            f"🌟 Health Score: {avg_score:.1f}/10\n"
+            f"{macro_chart}"
         )
-        await message.answer(response)
-    else:
-        await message.answer("Product not found.")
+        
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📜 Show Item Details", callback_data=f"toggle_details:show:{group_id}")]
+        ])
+        
+        # Send detailed summary
+        await message.answer(synthese_text, reply_markup=keyboard, parse_mode="HTML")
+        
+        # Reset state
+        await state.set_state(None)
+
+async def download_photo(message: Message) -> str:
+    """
+    Downloads the largest size of a photo message and returns the local path.
+    """
+    photo = message.photo[-1]
+    file = await bot.get_file(photo.file_id)
+    destination = f"temp_{photo.file_id}.jpg"
+    await bot.download_file(file.file_path, destination)
+    return destination
+
+async def handle_album(album: list, state: FSMContext):
+    """
+    Handles a Telegram album collected by `media_groups` ([(message, download task), ...]):
+    all photos are analyzed together in one call and logged as one meal.
+    """
+    first = album[0][0]
+    await first.answer(f"👀 Analyzing {len(album)} photos as one meal...")
+    try:
+        # A photo that failed to download is left out rather than failing the whole album
+        results = await asyncio.gather(*(task for _, task in album), return_exceptions=True)
+        paths = [path for path in results if isinstance(path, str)]
+        if not paths:
+            raise results[0]
+        caption = "\n".join(message.caption for message, _ in album if message.caption)
+        await analyze_and_log_photos(first, state, paths, caption)
+    except Exception as e:
+        logging.error(f"Error handling album: {e}")
+        await first.answer("Sorry, I had trouble seeing those pictures.")
 
 @dp.message(F.photo)
 async def handle_photo(message: Message, state: FSMContext):
@@ -365,6 +697,11 @@ async def handle_photo(message: Message, state: FSMContext):
     """
     current_state = await state.get_state()
     
+    # Albums outside barcode mode are collected and analyzed together (see handle_album)
+    if message.media_group_id and current_state != BotStates.waiting_for_barcode:
+        media_groups.add(message, download_photo, lambda album: handle_album(album, state))
+        return
+    
     # If user is in "Barcode Mode", we ONLY look for barcodes.
     if current_state == BotStates.waiting_for_barcode:
         await message.answer("🔍 Scanning for barcode...")
@@ -372,15 +709,8 @@ async def handle_photo(message: Message, state: FSMContext):
         await message.answer("👀 Analyzing food...")
     
     try:
-        # Get the largest photo
-        photo = message.photo[-1]
-        file_id = photo.file_id
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        
-        # Download file
-        destination = f"temp_{file_id}.jpg"
-        await bot.download_file(file_path, destination)
+        # Download the largest photo
+        destination = await download_photo(message)
         
         # --- BARCODE LOGIC ---
         # Check if we should scan for barcode (Explicit state OR no state/hybrid)
@@ -431,89 +761,7 @@ async def handle_photo(message: Message, state: FSMContext):
             await message.answer("⚠️ No barcode detected. Analyzing as food image... 🍎")
 
         # Proceed with AI
-        caption = message.caption or ""
-        log_data, reply = await analyze_food_image(destination, caption)
-        
-        # Clean up file
-        if os.path.exists(destination):
-            os.remove(destination)
-            
-        # Send the conversational reply first
-        await message.answer(reply)
-        
-        # Log data if found
-        if log_data:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            total_cals = 0
-            total_prot = 0
-            total_carbs = 0
-            total_fats = 0
-            items_found = []
-            health_scores = []
-            
-            # Generate a unique group ID for this meal
-            group_id = str(uuid.uuid4())
-            
-            for item in log_data:
-                name = item.get('item')
-                cals = item.get('calories', 0)
-                prot = item.get('protein', 0)
-                carbs = item.get('carbs', 0)
-                fats = item.get('fats', 0)
-                micros = item.get('micronutrients', 'N/A')
-                score = item.get('health_score', 5)
-                weight = item.get('weight_g', 'N/A')
-                meal_period = item.get('meal_period', 'Snack')
-                
-                total_cals += cals
-                total_prot += prot
-                total_carbs += carbs
-                total_fats += fats
-                items_found.append(f"{name} ({weight}g)")
-                health_scores.append(score)
-                
-                # Save to DB with group_id
-                cursor.execute('''
-                    INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (message.from_user.id, name, cals, prot, carbs, fats, micros, score, group_id, meal_period))
-                
-            conn.commit()
-            conn.close()
-            
-            # Sync to Firebase
-            summary = get_daily_summary(message.from_user.id)
-            logs = get_daily_logs(message.from_user.id)
-            update_user_stats_in_firebase(message.from_user.id, summary, logs)
-            
-            avg_score = sum(health_scores) / len(health_scores) if health_scores else 0
-            
-            # Generate text-based chart
-            macro_chart = generate_text_progress_bar(total_prot, total_carbs, total_fats)
-            
-            # Send SYNTHESIS (Totals + Chart)
-            synthese_text = (
-                f"✅ <b>Logged:</b> {', '.join(items_found)}\n\n"
-                f"<b>📊 Total Nutrition:</b>\n"
-                f"🔥 <b>{total_cals} Calories</b>\n"
-                f"💪 Protein: {total_prot:.1f}g\n"
-                f"🍞 Carbs: {total_carbs:.1f}g\n"
-                f"🥑 Fats: {total_fats:.1f}g\n"
-                f"🌟 Health Score: {avg_score:.1f}/10\n"
-                f"{macro_chart}"
-            )
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📜 Show Item Details", callback_data=f"toggle_details:show:{group_id}")]
-            ])
-            
-            # Send detailed summary
-            await message.answer(synthese_text, reply_markup=keyboard, parse_mode="HTML")
-            
-            # Reset state
-            await state.set_state(None)
+        await analyze_and_log_photos(message, state, [destination], message.caption or "")
             
     except Exception as e:
         logging.error(f"Error handling photo: {e}")
@@ -554,37 +802,26 @@ async def process_portion_input(message: Message, state: FSMContext):
     final_carbs = round(product['carbs'] * multiplier, 1)
     final_fats = round(product['fats'] * multiplier, 1)
     
-    # Generate group ID
-    group_id = str(uuid.uuid4())
+    # Log to DB (meal period is guessed from the time of day)
+    result = await log_meal(message.from_user.id, [{
+        'item': product['name'],
+        'calories': final_cals,
+        'protein': final_prot,
+        'carbs': final_carbs,
+        'fats': final_fats,
+        'micronutrients': "From Barcode",
+        'health_score': 5,
+        'meal_period': current_meal_period()
+    }], source="barcode")
     
-    # Determine meal period based on time
-    from datetime import datetime
-    hour = datetime.now().hour
-    if 5 <= hour < 11:
-        meal_period = "Breakfast"
-    elif 11 <= hour < 15:
-        meal_period = "Lunch"
-    elif 18 <= hour < 22:
-        meal_period = "Dinner"
-    else:
-        meal_period = "Snack"
-
-    # Log to DB
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (message.from_user.id, product['name'], final_cals, final_prot, final_carbs, final_fats, "From Barcode", 5, group_id, meal_period))
-    
-    conn.commit()
-    conn.close()
+    if not result:
+        await message.answer("😕 Could not log this product. Please scan again.")
+        await state.clear()
+        return
+    group_id = result.group_id
     
     # Sync to Firebase
-    summary = get_daily_summary(message.from_user.id)
-    logs = get_daily_logs(message.from_user.id)
-    update_user_stats_in_firebase(message.from_user.id, summary, logs)
+    update_user_stats_in_firebase(message.from_user.id, result.day_snapshot)
     
     # Clear state
     await state.clear()
@@ -633,54 +870,27 @@ async def log_food_handler(message: Message, state: FSMContext) -> None:
     user_input = message.text
     
     try:
-        # Call OpenAI to process text
-        log_data, reply = await process_user_message(user_input)
+        # Call OpenAI to process text, streaming the reply into one message
+        live = LiveMessage(message)
+        log_data, reply = await process_user_message(
+            user_input, on_progress=live.update if STREAM_REPLIES else None, user_id=message.from_user.id
+        )
         
         # Send the conversational reply
-        await message.answer(reply)
+        await live.finish(reply)
         
         # Log data if found
-        if log_data:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            total_cals = 0
-            total_prot = 0
-            total_carbs = 0
-            total_fats = 0
-            item_names = []
-            
-            # Generate group ID
-            group_id = str(uuid.uuid4())
-            
-            for item in log_data:
-                name = item.get('item')
-                cals = item.get('calories', 0)
-                prot = item.get('protein', 0)
-                carbs = item.get('carbs', 0)
-                fats = item.get('fats', 0)
-                micros = item.get('micronutrients', 'N/A')
-                score = item.get('health_score', 5)
-                meal_period = item.get('meal_period', 'Snack')
-                
-                total_cals += cals
-                total_prot += prot
-                total_carbs += carbs
-                total_fats += fats
-                item_names.append(name)
-                
-                cursor.execute('''
-                    INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (message.from_user.id, name, cals, prot, carbs, fats, micros, score, group_id, meal_period))
-                
-            conn.commit()
-            conn.close()
+        result = await log_meal(message.from_user.id, log_data, source="text") if log_data else None
+        if result:
+            group_id = result.group_id
+            total_cals = result.total_calories
+            total_prot = result.total_protein
+            total_carbs = result.total_carbs
+            total_fats = result.total_fats
+            item_names = [item.name for item in result.items]
             
             # Sync to Firebase
-            summary = get_daily_summary(message.from_user.id)
-            logs = get_daily_logs(message.from_user.id)
-            update_user_stats_in_firebase(message.from_user.id, summary, logs)
+            update_user_stats_in_firebase(message.from_user.id, result.day_snapshot)
             
             # Generate text-based chart
             macro_chart = generate_text_progress_bar(total_prot, total_carbs, total_fats)
@@ -746,48 +956,23 @@ async def web_app_data_handler(message: Message, state: FSMContext):
             # This is a bit tricky because log_food_handler expects a message object
             # We can just call the logic directly here
             
-            log_data, reply = await process_user_message(text_log)
-            await message.answer(reply)
+            live = LiveMessage(message)
+            log_data, reply = await process_user_message(
+                text_log, on_progress=live.update if STREAM_REPLIES else None, user_id=message.from_user.id
+            )
+            await live.finish(reply)
             
-            if log_data:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                total_cals = 0
-                total_prot = 0
-                total_carbs = 0
-                total_fats = 0
-                item_names = []
-                group_id = str(uuid.uuid4())
-                
-                for item in log_data:
-                    name = item.get('item')
-                    cals = item.get('calories', 0)
-                    prot = item.get('protein', 0)
-                    carbs = item.get('carbs', 0)
-                    fats = item.get('fats', 0)
-                    micros = item.get('micronutrients', 'N/A')
-                    score = item.get('health_score', 5)
-                    meal_period = item.get('meal_period', 'Snack')
-                    
-                    total_cals += cals
-                    total_prot += prot
-                    total_carbs += carbs
-                    total_fats += fats
-                    item_names.append(name)
-                    
-                    cursor.execute('''
-                        INSERT INTO logs (user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, meal_group_id, meal_period)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (message.from_user.id, name, cals, prot, carbs, fats, micros, score, group_id, meal_period))
-                    
-                conn.commit()
-                conn.close()
+            result = await log_meal(message.from_user.id, log_data, source="webapp") if log_data else None
+            if result:
+                group_id = result.group_id
+                total_cals = result.total_calories
+                total_prot = result.total_protein
+                total_carbs = result.total_carbs
+                total_fats = result.total_fats
+                item_names = [item.name for item in result.items]
                 
                 # Sync to Firebase
-                summary = get_daily_summary(message.from_user.id)
-                logs = get_daily_logs(message.from_user.id)
-                update_user_stats_in_firebase(message.from_user.id, summary, logs)
+                update_user_stats_in_firebase(message.from_user.id, result.day_snapshot)
                 
                 macro_chart = generate_text_progress_bar(total_prot, total_carbs, total_fats)
                 
@@ -827,7 +1012,7 @@ async def toggle_log_details(callback: CallbackQuery):
             return
 
         # Fetch logs from DB
-        logs = get_logs_by_group(group_id)
+        logs = await get_logs_by_group(group_id)
         
         if not logs:
             await callback.answer("Logs not found (might have been deleted).", show_alert=True)
@@ -914,56 +1099,38 @@ async def toggle_daily_details(callback: CallbackQuery):
     try:
         action = callback.data.split(":")[1] # "show" or "hide"
         
-        # Fetch all logs for today
-        logs = get_daily_logs(callback.from_user.id)
+        # Fetch today's totals and logs in one read
+        snapshot = await get_today_snapshot(callback.from_user.id)
+        logs = snapshot['logs']
         
         if not logs:
             await callback.answer("No logs found for today.", show_alert=True)
             return
 
-        # Reconstruct Data
-        total_cals = 0
-        total_prot = 0
-        total_carbs = 0
-        total_fats = 0
-        items_found = []
-        health_scores = []
+        total_cals = snapshot['total_calories'] or 0
+        total_prot = snapshot['total_protein'] or 0
+        total_carbs = snapshot['total_carbs'] or 0
+        total_fats = snapshot['total_fats'] or 0
+        avg_score = snapshot['avg_health_score'] or 0
+        items = snapshot['food_items'] or ""
         
         full_details = "<b>📊 Daily Detailed Breakdown</b>\n\n"
         
         for log in logs:
-            # log keys: id, user_id, food_name, calories, protein, carbs, fats, micronutrients, health_score, created_at, meal_group_id
-            name = log['food_name']
-            cals = log['calories']
-            prot = log['protein']
-            carbs = log['carbs']
-            fats = log['fats']
-            micros = log['micronutrients']
-            score = log['health_score']
-            
-            total_cals += cals
-            total_prot += prot
-            total_carbs += carbs
-            total_fats += fats
-            items_found.append(name)
-            if score is not None:
-                health_scores.append(score)
-            
             full_details += (
-                f"🍎 <b>{name}</b>\n"
-                f"🔥 Calories: {cals}\n"
-                f"💪 Protein: {prot}g | 🍞 Carbs: {carbs}g | 🥑 Fats: {fats}g\n"
-                f"💊 Micros: {micros}\n"
-                f"🌟 Health Score: {score}/10\n\n"
+                f"🍎 <b>{log['food_name']}</b>\n"
+                f"🔥 Calories: {log['calories']}\n"
+                f"💪 Protein: {log['protein']}g | 🍞 Carbs: {log['carbs']}g | 🥑 Fats: {log['fats']}g\n"
+                f"💊 Micros: {log['micronutrients']}\n"
+                f"🌟 Health Score: {log['health_score']}/10\n\n"
             )
             
-        avg_score = sum(health_scores) / len(health_scores) if health_scores else 0
         macro_chart = generate_text_progress_bar(total_prot, total_carbs, total_fats)
         
         # Reconstruct Synthesis
         synthesis_text = (
             f"📅 <b>Daily Journal (Today)</b>\n\n"
-            f"🍽️ <b>Items:</b> {', '.join(items_found)}\n\n"
+            f"🍽️ <b>Items:</b> {items}\n\n"
             f"🔥 <b>Total Calories: {total_cals}</b>\n"
             f"💪 Protein: {total_prot:.1f}g\n"
             f"🍞 Carbs: {total_carbs:.1f}g\n"
@@ -1021,16 +1188,11 @@ async def manual_goals_start(callback: CallbackQuery, state: FSMContext):
 async def manual_goals_finish(message: Message, state: FSMContext):
     try:
         cals = int(message.text.strip())
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET daily_calorie_goal = ? WHERE user_id = ?", (cals, message.from_user.id))
-        conn.commit()
-        conn.close()
+        await set_daily_calorie_goal(message.from_user.id, cals)
         
         # Sync to Firebase
-        summary = get_daily_summary(message.from_user.id)
-        logs = get_daily_logs(message.from_user.id)
-        update_user_stats_in_firebase(message.from_user.id, summary, logs)
+        snapshot = await get_today_snapshot(message.from_user.id)
+        update_user_stats_in_firebase(message.from_user.id, snapshot)
         
         await message.answer(f"✅ Daily goal set to <b>{cals} kcal</b>!", parse_mode="HTML")
         await state.clear()
@@ -1102,14 +1264,7 @@ async def process_activity(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     
     # Save profile to DB
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users 
-        SET age = ?, gender = ?, weight = ?, height = ?, activity_level = ?
-        WHERE user_id = ?
-    ''', (data['age'], data['gender'], data['weight'], data['height'], activity, callback.from_user.id))
-    conn.commit()
+    await update_user_profile(callback.from_user.id, data['age'], data['gender'], data['weight'], data['height'], activity)
     
     await callback.message.answer("🔄 Calculating your personalized plan...")
     
@@ -1117,14 +1272,11 @@ async def process_activity(callback: CallbackQuery, state: FSMContext):
     goals = calculate_daily_goals_deterministic(data['age'], data['gender'], data['weight'], data['height'], activity)
     
     # Save Goal
-    cursor.execute("UPDATE users SET daily_calorie_goal = ? WHERE user_id = ?", (goals['calories'], callback.from_user.id))
-    conn.commit()
-    conn.close()
+    await set_daily_calorie_goal(callback.from_user.id, goals['calories'])
     
     # Sync to Firebase
-    summary = get_daily_summary(callback.from_user.id)
-    logs = get_daily_logs(callback.from_user.id)
-    update_user_stats_in_firebase(callback.from_user.id, summary, logs)
+    snapshot = await get_today_snapshot(callback.from_user.id)
+    update_user_stats_in_firebase(callback.from_user.id, snapshot)
     
     await callback.message.answer(
         f"✅ <b>Plan Created!</b>\n\n"
@@ -1142,15 +1294,54 @@ async def process_activity(callback: CallbackQuery, state: FSMContext):
 async def activity_invalid_input(message: Message):
     await message.answer("Please select an activity level from the buttons above. ⬆️")
 
+async def archive_logs_periodically():
+    """
+    Once a day, moves old logs to the archive database and compacts the hot one.
+    """
+    while True:
+        try:
+            moved = await archive_old_logs(LOG_ARCHIVE_AFTER_DAYS)
+            if moved:
+                await compact_db()
+        except Exception as e:
+            logging.error(f"Error archiving logs: {e}")
+        await asyncio.sleep(24 * 60 * 60)
+
 async def main() -> None:
     # Initialize DB
-    init_db()
+    await init_db()
     
     # Initialize Firebase
     init_firebase()
     
+    # Group-commit writer for meal logs
+    await log_writer.start()
+    
+    # Shared Open Food Facts HTTP session
+    await init_off_session()
+    
+    # Background maintenance
+    archive_task = None
+    if LOG_ARCHIVE_AFTER_DAYS > 0:
+        archive_task = asyncio.create_task(archive_logs_periodically())
+    
+    # LLM usage metering: daily rollup in SQLite, optional Prometheus endpoint
+    metrics_task = asyncio.create_task(llm_metrics.flush_periodically(METRICS_FLUSH_SECONDS))
+    metrics_runner = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+    
     # Start polling
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if archive_task:
+            archive_task.cancel()
+        metrics_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await llm_metrics.flush()
+        await close_off_session()
+        await log_writer.close() # Flush pending logs before closing the pool
+        close_db()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
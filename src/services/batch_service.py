@@ -0,0 +1,365 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+import uuid
+from typing import Iterator, List, Optional
+
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+from src.config import OPENAI_API_KEY, OPENAI_FAST_MODEL, BATCH_DIR
+from src.database import db
+
+# Batch API input limits: 50,000 requests and 200 MB per file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+APPLY_CHUNK = 1000 # Rows per update transaction
+ENDPOINT = "/v1/chat/completions"
+
+class LogEnrichment(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    health_score: int
+    micronutrients: str
+
+ENRICH_SYSTEM_PROMPT = "You are an expert nutritionist."
+ENRICH_PROMPT = """
+    Food: {food_name}
+    Nutrition for the logged portion: {calories} kcal, {protein} g protein, {carbs} g carbs, {fats} g fats.
+    Give a health score from 1-10 based on nutritional value (10 is healthiest)
+    and the key micronutrients as a short string (e.g. "High in Vit C, Iron").
+    """
+ENRICH_PROMPT_VERSION = hashlib.sha256(
+    (ENRICH_SYSTEM_PROMPT + ENRICH_PROMPT + json.dumps(LogEnrichment.model_json_schema(), sort_keys=True)).encode("utf-8")
+).hexdigest()[:12]
+# Built once: generating the JSON schema per row would dominate export time
+ENRICH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "LogEnrichment", "strict": True, "schema": LogEnrichment.model_json_schema()}
+}
+
+def _custom_id(schema: str, log_id: int) -> str:
+    return f"logs:{schema}:{log_id}"
+
+def _parse_custom_id(custom_id: str):
+    prefix, schema, log_id = custom_id.split(":")
+    if prefix != "logs" or schema not in ("main", "archive"):
+        raise ValueError(f"Unexpected custom_id {custom_id!r}")
+    return schema, int(log_id)
+
+def build_request(schema: str, row, model: str) -> dict:
+    """
+    One Batch API request line for a log row.
+    """
+    prompt = ENRICH_PROMPT.format(
+        food_name=row['food_name'], calories=row['calories'],
+        protein=row['protein'], carbs=row['carbs'], fats=row['fats']
+    )
+    return {
+        "custom_id": _custom_id(schema, row['id']),
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": ENRICH_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "response_format": ENRICH_RESPONSE_FORMAT,
+            "temperature": 0.2,
+            "max_tokens": 100
+        }
+    }
+
+def export_requests(out_dir: str, model: str = OPENAI_FAST_MODEL, only_missing: bool = True,
+                    user_id: int = None, since=None, limit: int = None) -> List[tuple]:
+    """
+    Streams the selected logs into batch input files under `out_dir`, starting a new file
+    at the API's per-file limits. Returns [(path, request_count), ...].
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    files = []
+    out, path, count, size = None, None, 0, 0
+    total = 0
+    try:
+        for schema, row in db.iter_logs_for_reanalysis(only_missing, user_id, since):
+            if limit is not None and total >= limit:
+                break
+            line = (json.dumps(build_request(schema, row, model), ensure_ascii=False) + "\n").encode("utf-8")
+            if out is None or count >= MAX_REQUESTS_PER_FILE or size + len(line) > MAX_BYTES_PER_FILE:
+                if out is not None:
+                    out.close()
+                    files.append((path, count))
+                path = os.path.join(out_dir, f"input-{len(files):04d}.jsonl")
+                out, count, size = open(path, "wb"), 0, 0
+            out.write(line)
+            count += 1
+            size += len(line)
+            total += 1
+    finally:
+        if out is not None:
+            out.close()
+            files.append((path, count))
+    return files
+
+def iter_results(output_path: str) -> Iterator[tuple]:
+    """
+    Streams a batch output file, yielding (schema, log_id, enrichment or None, error message or None).
+    """
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                schema, log_id = _parse_custom_id(record["custom_id"])
+            except (KeyError, ValueError) as e:
+                yield None, None, None, str(e)
+                continue
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                yield schema, log_id, None, json.dumps(record.get("error") or response.get("body"))
+                continue
+            try:
+                message = response["body"]["choices"][0]["message"]
+                if message.get("refusal"):
+                    yield schema, log_id, None, message["refusal"]
+                    continue
+                yield schema, log_id, LogEnrichment.model_validate_json(message["content"]), None
+            except (KeyError, IndexError, TypeError, ValidationError) as e:
+                yield schema, log_id, None, f"Unparseable response: {e}"
+
+def apply_results(output_path: str, chunk_size: int = APPLY_CHUNK) -> dict:
+    """
+    Applies a batch output file to the logs in fixed-size transactions.
+    Idempotent: applying the same file again changes nothing.
+    """
+    stats = {"results": 0, "changed": 0, "errors": 0}
+    pending = []
+    for schema, log_id, enrichment, error in iter_results(output_path):
+        stats["results"] += 1
+        if enrichment is None:
+            stats["errors"] += 1
+            continue
+        score = min(10, max(1, enrichment.health_score))
+        pending.append((schema, log_id, score, enrichment.micronutrients.strip()[:200] or "N/A"))
+        if len(pending) >= chunk_size:
+            stats["changed"] += db.apply_log_enrichment(pending)
+            pending = []
+    if pending:
+        stats["changed"] += db.apply_log_enrichment(pending)
+    return stats
+
+class OpenAIBatchBackend:
+    """
+    The real Batch API (files + batches endpoints).
+    """
+    name = "openai"
+
+    def __init__(self):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=OPENAI_API_KEY)
+
+    def submit(self, input_path: str, metadata: dict) -> str:
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window="24h", metadata=metadata
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> tuple:
+        """
+        Returns (status, output_file_id or None, error_file_id or None).
+        Failed requests go to the error file; when all of them failed there is no output file.
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        return batch.status, batch.output_file_id, batch.error_file_id
+
+    def download(self, file_id: str, dest_path: str):
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            response.stream_to_file(dest_path)
+
+class LocalBatchBackend:
+    """
+    Stand-in for the Batch API that runs entirely on disk: a batch stays in progress for
+    `delay` seconds, then its output file is produced line by line with deterministic fake
+    answers (and an occasional failed request) in the API's output format.
+    """
+    name = "local"
+
+    def __init__(self, root: str = os.path.join(BATCH_DIR, "local"), delay: float = 1.0, error_rate: float = 0.001):
+        self.root = root
+        self.delay = delay
+        self.error_rate = error_rate
+        os.makedirs(root, exist_ok=True)
+
+    def _meta_path(self, batch_id: str) -> str:
+        return os.path.join(self.root, f"{batch_id}.json")
+
+    def submit(self, input_path: str, metadata: dict) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:16]}"
+        shutil.copyfile(input_path, os.path.join(self.root, f"{batch_id}.input.jsonl"))
+        with open(self._meta_path(batch_id), "w") as f:
+            json.dump({"created_at": time.time(), "metadata": metadata, "output_file_id": None}, f)
+        return batch_id
+
+    def status(self, batch_id: str) -> tuple:
+        with open(self._meta_path(batch_id)) as f:
+            meta = json.load(f)
+        if meta.get("done"):
+            return "completed", meta["output_file_id"], meta.get("error_file_id")
+        if time.time() - meta["created_at"] < self.delay:
+            return "in_progress", None, None
+        outputs, errors = self._complete(os.path.join(self.root, f"{batch_id}.input.jsonl"),
+                                         os.path.join(self.root, f"{batch_id}.output.jsonl"),
+                                         os.path.join(self.root, f"{batch_id}.errors.jsonl"))
+        # Like the API: no file id for an empty output or error file
+        meta.update(done=True, output_file_id=f"{batch_id}.output" if outputs else None,
+                    error_file_id=f"{batch_id}.errors" if errors else None)
+        with open(self._meta_path(batch_id), "w") as f:
+            json.dump(meta, f)
+        return "completed", meta["output_file_id"], meta["error_file_id"]
+
+    def _complete(self, input_path: str, output_path: str, error_path: str) -> tuple:
+        """
+        Writes the output and error files; returns how many records went to each.
+        """
+        rng = random.Random(input_path)
+        counts = [0, 0]
+        with open(input_path, "r", encoding="utf-8") as src, \
+             open(output_path, "w", encoding="utf-8") as out, open(error_path, "w", encoding="utf-8") as err:
+            for line in src:
+                request = json.loads(line)
+                record = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"], "error": None}
+                failed = rng.random() < self.error_rate
+                if failed:
+                    record["response"] = {"status_code": 500, "body": {"error": {"message": "Simulated server error"}}}
+                else:
+                    answer = LogEnrichment(health_score=rng.randint(1, 10), micronutrients="Simulated: Iron, Vitamin C")
+                    record["response"] = {"status_code": 200, "body": {
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer.model_dump_json()}}],
+                        "usage": {"prompt_tokens": 90, "completion_tokens": 15, "total_tokens": 105}
+                    }}
+                (err if failed else out).write(json.dumps(record) + "\n")
+                counts[failed] += 1
+        return tuple(counts)
+
+    def download(self, file_id: str, dest_path: str):
+        shutil.copyfile(os.path.join(self.root, f"{file_id}.jsonl"), dest_path)
+
+def get_backend(local: bool):
+    return LocalBatchBackend() if local else OpenAIBatchBackend()
+
+def submit_files(backend, files: List[tuple]) -> List[str]:
+    batch_ids = []
+    for path, count in files:
+        batch_id = backend.submit(path, {"kind": "enrich", "prompt_version": ENRICH_PROMPT_VERSION})
+        db.save_batch_job(batch_id, "enrich", backend.name, path, ENRICH_PROMPT_VERSION, count)
+        batch_ids.append(batch_id)
+        print(f"Submitted {path} ({count} requests) as {batch_id}")
+    return batch_ids
+
+def _result_paths(job) -> tuple:
+    output_path = job['output_path'] or os.path.splitext(job['input_path'])[0].replace("input-", "output-") + ".jsonl"
+    directory, name = os.path.split(output_path)
+    return output_path, os.path.join(directory, name.replace("output-", "errors-", 1) if "output-" in name else "errors-" + name)
+
+def collect(backend, force: bool = False) -> dict:
+    """
+    Polls unfinished jobs of this backend once; downloads and applies finished ones.
+    Expired and cancelled batches still get their partial output applied. Requests in the
+    error file are counted as errors.
+    """
+    totals = {"results": 0, "changed": 0, "errors": 0, "pending": 0}
+    statuses = ("submitted", "completed", "applied") if force else ("submitted", "completed")
+    for job in db.get_batch_jobs(statuses):
+        if job['backend'] != backend.name:
+            continue
+        status, output_file_id, error_file_id = backend.status(job['batch_id'])
+        if status == "failed" or (status in ("expired", "cancelled") and not output_file_id and not error_file_id):
+            # Nothing ran (e.g. the input file was rejected)
+            db.update_batch_job(job['batch_id'], status=status)
+            print(f"{job['batch_id']}: {status}")
+            continue
+        if status not in ("completed", "expired", "cancelled"):
+            totals["pending"] += 1
+            continue
+
+        output_path, error_path = _result_paths(job)
+        stats = {"results": 0, "changed": 0, "errors": 0}
+        for file_id, path in ((output_file_id, output_path), (error_file_id, error_path)):
+            if file_id is None:
+                continue
+            if not os.path.exists(path):
+                backend.download(file_id, path)
+            # Records in the error file all count as errors
+            for key, value in apply_results(path).items():
+                stats[key] += value
+        # Expired/cancelled jobs keep their status (their remaining logs are picked up by the next export)
+        fields = {"output_path": output_path} if output_file_id else {}
+        db.update_batch_job(job['batch_id'], status="applied" if status == "completed" else status,
+                            applied_count=stats["changed"], **fields)
+        print(f"{job['batch_id']}: {status}, {stats['results']} results, {stats['changed']} rows updated, "
+              f"{stats['errors']} errors")
+        for key in ("results", "changed", "errors"):
+            totals[key] += stats[key]
+    return totals
+
+def run(local: bool, only_missing: bool, user_id: Optional[int], since, limit: Optional[int], poll_seconds: float):
+    """
+    Export -> submit -> wait -> apply, end to end.
+    """
+    backend = get_backend(local)
+    out_dir = os.path.join(BATCH_DIR, time.strftime("%Y%m%d-%H%M%S"))
+    files = export_requests(out_dir, only_missing=only_missing, user_id=user_id, since=since, limit=limit)
+    files = [(path, count) for path, count in files if count]
+    if not files:
+        print("Nothing to re-analyse.")
+        return
+    print(f"Exported {sum(c for _, c in files)} requests into {len(files)} file(s) under {out_dir}")
+    submit_files(backend, files)
+    while True:
+        totals = collect(backend)
+        if not totals["pending"]:
+            break
+        time.sleep(poll_seconds)
+
+if __name__ == "__main__":
+    # Admin entry point:
+    #   python -m src.services.batch_service run [--local] [--all] [--user ID] [--since YYYY-MM-DD] [--limit N]
+    #   python -m src.services.batch_service export [--all] ...   (write input files only)
+    #   python -m src.services.batch_service submit FILE... [--local]
+    #   python -m src.services.batch_service collect [--local] [--force]
+    #   python -m src.services.batch_service jobs
+    from datetime import date
+
+    parser = argparse.ArgumentParser(description="Bulk re-analysis of logs through the batch API")
+    parser.add_argument("command", choices=["run", "export", "submit", "collect", "jobs"])
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--local", action="store_true", help="use the on-disk stand-in instead of the Batch API")
+    parser.add_argument("--all", action="store_true", help="re-analyse every log, not only rows missing data")
+    parser.add_argument("--user", type=int)
+    parser.add_argument("--since", type=date.fromisoformat)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--force", action="store_true", help="re-apply jobs that were already applied")
+    parser.add_argument("--poll", type=float, default=60.0, help="seconds between status checks")
+    args = parser.parse_args()
+
+    db.init_db()
+    if args.command == "run":
+        run(args.local, not args.all, args.user, args.since, args.limit, 1.0 if args.local else args.poll)
+    elif args.command == "export":
+        out_dir = os.path.join(BATCH_DIR, time.strftime("%Y%m%d-%H%M%S"))
+        for path, count in export_requests(out_dir, only_missing=not args.all, user_id=args.user, since=args.since, limit=args.limit):
+            print(f"{path}: {count} requests")
+    elif args.command == "submit":
+        submit_files(get_backend(args.local), [(path, sum(1 for _ in open(path, "rb"))) for path in args.files])
+    elif args.command == "collect":
+        print(collect(get_backend(args.local), force=args.force))
+    else:
+        for job in db.get_batch_jobs():
+            print(f"{job['batch_id']}  {job['backend']:>6}  {job['status']:>9}  {job['request_count']:>6} requests  "
+                  f"{job['applied_count']:>6} applied  {job['input_path']}")
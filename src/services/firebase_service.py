@@ -26,9 +26,10 @@ def init_firebase():
     except Exception as e:
         logging.error(f"❌ Failed to initialize Firebase: {e}")
 
-def update_user_stats_in_firebase(user_id, summary_data, logs_data):
+def update_user_stats_in_firebase(user_id, snapshot):
     """
     Pushes the latest user stats to Firestore.
+    `snapshot` is today's snapshot from get_today_snapshot (totals + logs).
     Structure: users/{user_id}
     """
     if db is None:
@@ -39,7 +40,7 @@ def update_user_stats_in_firebase(user_id, summary_data, logs_data):
         
         # Format logs for Firestore
         formatted_logs = []
-        for log in logs_data:
+        for log in snapshot['logs']:
             formatted_logs.append({
                 "name": log['food_name'],
                 "cals": log['calories'],
@@ -51,12 +52,12 @@ def update_user_stats_in_firebase(user_id, summary_data, logs_data):
             })
 
         data = {
-            "total_cals": summary_data['total_calories'] or 0,
-            "goal_cals": summary_data.get('daily_calorie_goal', 2000),
+            "total_cals": snapshot['total_calories'] or 0,
+            "goal_cals": snapshot.get('daily_calorie_goal', 2000),
             "macros": {
-                "protein": summary_data['total_protein'] or 0,
-                "carbs": summary_data['total_carbs'] or 0,
-                "fats": summary_data['total_fats'] or 0
+                "protein": snapshot['total_protein'] or 0,
+                "carbs": snapshot['total_carbs'] or 0,
+                "fats": snapshot['total_fats'] or 0
             },
             "logs": formatted_logs,
             "last_updated": firestore.SERVER_TIMESTAMP
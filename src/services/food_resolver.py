@@ -0,0 +1,294 @@
+import csv
+import os
+import re
+import unicodedata
+from array import array
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from src.services.meal_service import MEAL_PERIODS, current_meal_period
+
+FOODS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "foods.csv")
+
+# Larger single items are almost always a typo or a joke ("100 eggs"); the LLM asks or estimates instead
+MAX_ITEM_GRAMS = 2000
+MAX_ITEM_COUNT = 30
+# Fuzzy matches below this trigram similarity are not trusted; the message goes to the LLM instead
+MIN_CONFIDENCE = 0.8
+# A query word counts as present in the matched name when it is this similar to one of its words (typos)
+MIN_WORD_SIMILARITY = 0.5
+# Words that never change which food is meant
+_MINOR_WORDS = {"of", "the", "some", "my", "fresh", "plain"}
+
+# Grams per unit; volume units go through the food's tablespoon weight
+MASS_UNITS = {
+    "g": 1.0, "gr": 1.0, "gram": 1.0, "grams": 1.0, "gramm": 1.0,
+    "kg": 1000.0, "kilo": 1000.0, "kilos": 1000.0,
+    "oz": 28.35, "ounce": 28.35, "ounces": 28.35,
+    "lb": 453.6, "lbs": 453.6, "pound": 453.6, "pounds": 453.6
+}
+# Volume units in tablespoons
+SPOON_UNITS = {
+    "tbsp": 1.0, "tablespoon": 1.0, "tablespoons": 1.0,
+    "tsp": 1 / 3, "teaspoon": 1 / 3, "teaspoons": 1 / 3,
+    "cup": 16.0, "cups": 16.0,
+    "ml": 1 / 15, "l": 1000 / 15, "liter": 1000 / 15, "litre": 1000 / 15, "liters": 1000 / 15, "litres": 1000 / 15
+}
+# Count units: a generic "piece", or the food's own piece unit ("slice" of bread, "glass" of milk)
+COUNT_UNITS = {"piece": "piece", "pieces": "piece", "pc": "piece", "pcs": "piece",
+               "slice": "slice", "slices": "slice", "glass": "glass", "glasses": "glass",
+               "can": "can", "cans": "can", "cup": "cup", "cups": "cup", "shot": "shot", "shots": "shot"}
+
+WORD_NUMBERS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "half": 0.5, "a half": 0.5, "half a": 0.5,
+    "half an": 0.5, "a couple of": 2, "couple of": 2, "a few": 3
+}
+
+_UNIT_RE = "|".join(sorted(set(MASS_UNITS) | set(SPOON_UNITS) | set(COUNT_UNITS), key=len, reverse=True))
+_QTY_RE = r"(?P<qty>\d+(?:[.,]\d+)?|\d+/\d+|" + "|".join(sorted(WORD_NUMBERS, key=len, reverse=True)) + ")"
+# "200g chicken breast", "2 slices of bread", "an apple"
+_LEADING_QTY = re.compile(rf"^{_QTY_RE}\s*(?:(?P<unit>{_UNIT_RE})\b\.?)?\s*(?:of\s+)?(?P<name>[a-z%][a-z0-9% '\-]*)$")
+# "chicken breast 200g", "milk 250 ml"
+_TRAILING_QTY = re.compile(rf"^(?P<name>[a-z%][a-z0-9% '\-]*?)\s+{_QTY_RE}\s*(?P<unit>{_UNIT_RE})\.?$")
+_SPLIT = re.compile(r"\s*(?:,|;|\+|&|\band\b|\bwith\b|\bplus\b)\s*")
+_FILLER = re.compile(r"^(?:i\s+)?(?:just\s+)?(?:had|ate|eaten|drank|log|logged)\s+")
+_PERIOD = re.compile(r"\s*\b(?:for|at|as)\s+(?:my\s+|a\s+)?(breakfast|lunch|dinner|snack)$")
+
+class FoodDB:
+    """
+    Bundled food-composition table (per 100 g) in column arrays, with an exact-name
+    index and a trigram index over names and aliases for fuzzy lookups.
+    """
+    def __init__(self, path: str = FOODS_CSV):
+        self.names: List[str] = []
+        self.micronutrients: List[str] = []
+        self.piece_units: List[str] = []
+        self.kcal = array("f")
+        self.protein = array("f")
+        self.carbs = array("f")
+        self.fat = array("f")
+        self.piece_g = array("f") # 0 = not countable
+        self.tbsp_g = array("f") # 0 = no volume conversion
+        self.health = array("b")
+        self._exact: Dict[str, int] = {}
+        self._keys: List[Tuple[str, int, int]] = [] # (key, food index, trigram count)
+        self._trigrams: Dict[str, List[int]] = defaultdict(list)
+
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                index = len(self.names)
+                self.names.append(row["name"])
+                self.micronutrients.append(row["micronutrients"] or "N/A")
+                self.piece_units.append(row["piece_unit"] or "piece")
+                self.kcal.append(float(row["kcal"]))
+                self.protein.append(float(row["protein"]))
+                self.carbs.append(float(row["carbs"]))
+                self.fat.append(float(row["fat"]))
+                self.piece_g.append(float(row["piece_g"] or 0))
+                self.tbsp_g.append(float(row["tbsp_g"] or 0))
+                self.health.append(int(row["health_score"]))
+                for key in [row["name"]] + [a for a in row["aliases"].split(";") if a]:
+                    self._add_key(_normalize(key), index)
+
+    def _add_key(self, key: str, index: int):
+        self._exact.setdefault(key, index)
+        grams = _trigrams(key)
+        key_id = len(self._keys)
+        self._keys.append((key, index, len(grams)))
+        for gram in grams:
+            self._trigrams[gram].append(key_id)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def knows(self, name: str) -> bool:
+        """
+        Whether `name` (or its singular) is an exact food name or alias.
+        """
+        return name in self._exact or _singular(name) in self._exact
+
+    def lookup(self, name: str) -> Tuple[Optional[int], float]:
+        """
+        Returns (food index, confidence): 1.0 for exact names/aliases (or their singular),
+        otherwise the best trigram Dice similarity. A fuzzy match scores 0 when the query has a word
+        the matched name lacks ("sweet potato fries" is not "sweet potato").
+        """
+        for candidate in (name, _singular(name)):
+            if candidate in self._exact:
+                return self._exact[candidate], 1.0
+
+        grams = _trigrams(name)
+        shared = defaultdict(int)
+        for gram in grams:
+            for key_id in self._trigrams.get(gram, ()):
+                shared[key_id] += 1
+        best, best_key, best_score = None, None, 0.0
+        for key_id, count in shared.items():
+            score = 2 * count / (len(grams) + self._keys[key_id][2])
+            if score > best_score:
+                best, best_key, best_score = self._keys[key_id][1], self._keys[key_id][0], score
+        if best is not None and _missing_words(name, best_key):
+            best_score = 0.0
+        return best, best_score
+
+_db: Optional[FoodDB] = None
+
+def get_food_db() -> FoodDB:
+    global _db
+    if _db is None:
+        _db = FoodDB()
+    return _db
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip(" .!")
+
+def _singular(name: str) -> str:
+    if name.endswith("ies"):
+        return name[:-3] + "y"
+    if name.endswith(("oes", "ches", "shes")):
+        return name[:-2]
+    if name.endswith("s") and not name.endswith("ss"):
+        return name[:-1]
+    return name
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _similarity(a: str, b: str) -> float:
+    grams_a, grams_b = _trigrams(a), _trigrams(b)
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+def _missing_words(query: str, key: str) -> List[str]:
+    """
+    Significant words of `query` with no close match (same word, singular or typo) in `key`.
+    """
+    key_words = [_singular(word) for word in key.split()]
+    return [
+        word for word in query.split()
+        if len(word) > 2 and word not in _MINOR_WORDS
+        and not any(_similarity(_singular(word), key_word) >= MIN_WORD_SIMILARITY for key_word in key_words)
+    ]
+
+def _quantity(text: str) -> float:
+    if text in WORD_NUMBERS:
+        return float(WORD_NUMBERS[text])
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return float(numerator) / float(denominator) if float(denominator) else 0.0
+    return float(text.replace(",", "."))
+
+def _grams(db: FoodDB, index: int, qty: float, unit: Optional[str]) -> Optional[float]:
+    if unit is None:
+        # A bare count only means whole pieces for foods counted in pieces: "a pizza" is not one
+        # slice, and "2 beers" says nothing about the glass size
+        if db.piece_units[index] != "piece" or not db.piece_g[index] or qty > MAX_ITEM_COUNT:
+            return None
+        return qty * db.piece_g[index]
+    if unit in MASS_UNITS:
+        return qty * MASS_UNITS[unit]
+    if unit in COUNT_UNITS and COUNT_UNITS[unit] in ("piece", db.piece_units[index]) and db.piece_g[index]:
+        return qty * db.piece_g[index] if qty <= MAX_ITEM_COUNT else None
+    if unit in SPOON_UNITS and db.tbsp_g[index]:
+        return qty * SPOON_UNITS[unit] * db.tbsp_g[index]
+    return None
+
+def _resolve_item(db: FoodDB, segment: str) -> Optional[Dict]:
+    match = _LEADING_QTY.match(segment) or _TRAILING_QTY.match(segment)
+    if match:
+        qty, unit, name = _quantity(match.group("qty")), match.group("unit"), match.group("name").strip()
+    else:
+        qty, unit, name = 1.0, None, segment
+
+    index, confidence = db.lookup(name)
+    if index is None or confidence < MIN_CONFIDENCE or qty <= 0:
+        return None
+    grams = _grams(db, index, qty, unit)
+    if grams is None or grams > MAX_ITEM_GRAMS:
+        return None
+
+    factor = grams / 100
+    return {
+        "item": db.names[index],
+        "calories": int(round(db.kcal[index] * factor)),
+        "protein": round(db.protein[index] * factor, 1),
+        "carbs": round(db.carbs[index] * factor, 1),
+        "fats": round(db.fat[index] * factor, 1),
+        "weight_g": round(grams),
+        "micronutrients": db.micronutrients[index],
+        "health_score": int(db.health[index])
+    }
+
+def resolve_text_log(text: str) -> Optional[Tuple[List[Dict], str]]:
+    """
+    Answers simple food logs ("200g chicken breast and 1 apple") from the bundled table.
+    Returns (log_data, reply) in the same shape as process_user_message, or None when any
+    part of the message is not confidently understood (the caller then asks the LLM).
+    """
+    text = _normalize(text or "")
+    if not text or "?" in text or len(text) > 200:
+        return None
+
+    meal_period = None
+    period = _PERIOD.search(text)
+    if period:
+        meal_period = period.group(1).capitalize()
+        text = text[:period.start()]
+    text = _FILLER.sub("", text)
+
+    db = get_food_db()
+    items = []
+    for segment in _SPLIT.split(text):
+        segment = segment.strip(" .!")
+        if not segment:
+            continue
+        item = _resolve_item(db, segment)
+        if item is None:
+            return None
+        items.append(item)
+    if not items:
+        return None
+
+    meal_period = meal_period if meal_period in MEAL_PERIODS else current_meal_period()
+    for item in items:
+        item["meal_period"] = meal_period
+    total = sum(item["calories"] for item in items)
+    listed = ", ".join(f"{item['item'].lower()} ({item['weight_g']}g)" for item in items)
+    return items, f"Got it: {listed}. That's about {total} kcal."
+
+if __name__ == "__main__":
+    # Resolution rate and latency on a sample corpus of text logs:
+    #   python -m src.services.food_resolver
+    import time
+
+    CORPUS = [
+        "200g chicken breast", "1 apple", "2 eggs", "an apple and a banana", "2 slices of bread",
+        "100g rice", "1 cup of milk", "Greek yogurt 170g", "a glass of orange juice", "3 eggs and 2 slices of toast",
+        "coffee", "1 latte", "I had 150g salmon with 200g broccoli", "half an avocado", "2 tbsp peanut butter",
+        "a handful of almonds", "30g almonds", "1 banana for breakfast", "chiken breast 200g", "2 bananas",
+        "oatmeal with blueberries", "50g oats, 250ml milk and 1 banana", "1 slice of pizza", "a can of coke",
+        "2 beers", "a bowl of pho", "chicken caesar salad", "big mac and fries", "spaghetti bolognese",
+        "how many calories are in an egg?", "hello", "thanks!", "I feel hungry today", "grandma's lasagna",
+        "1 croissant", "2 cookies", "200 g potatoes", "1 sweet potato", "tuna sandwich", "protein shake",
+        "1/2 cup oats", "3 strawberries and 1 kiwi", "100g tofu and 150g quinoa", "a burger", "6 shrimp",
+        "1 tbsp olive oil", "two boiled eggs", "1 tortilla with 100g chicken and 30g cheese", "ramen", "sushi",
+        "sweet potato fries", "apple pie", "peanut butter cookies", "chiken breast grilled", "200g brown rice",
+        "a pizza", "2 pizzas", "half a pizza", "2 slices of pizza", "100 eggs", "20 almonds", "3 kg rice"
+    ]
+
+    get_food_db()
+    resolved, timings = 0, []
+    for message in CORPUS:
+        start = time.perf_counter()
+        for _ in range(100):
+            result = resolve_text_log(message)
+        timings.append((time.perf_counter() - start) / 100 * 1e6)
+        resolved += result is not None
+        print(f"{'local' if result else 'LLM':>5}  {message}" + (f"  ->  {result[1]}" if result else ""))
+
+    timings.sort()
+    print(f"\n{resolved}/{len(CORPUS)} resolved locally ({resolved / len(CORPUS):.0%}); "
+          f"latency p50 {timings[len(timings) // 2]:.0f} us, p95 {timings[int(len(timings) * 0.95)]:.0f} us, "
+          f"max {timings[-1]:.0f} us")
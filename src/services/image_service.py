@@ -0,0 +1,184 @@
+import io
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+from src.config import VISION_JPEG_QUALITY
+
+# dHash grid: 9x8 pixels -> 8x8 = 64 horizontal gradient bits
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+# Colour histogram: 4 levels per channel = 64 bins, over the middle of a 64x64 thumbnail
+# (where the plate is). dHash is grayscale and dominated by the plate's outline, so two
+# different meals on the same plate and table can be a few bits apart; their colours are not.
+COLOR_THUMB = 64
+COLOR_MARGIN = 12
+
+def _open_small(image_path: str) -> Image.Image:
+    img = Image.open(image_path)
+    # Let the JPEG decoder downscale while decoding, much faster than a full decode
+    img.draft("RGB", (COLOR_THUMB * 2, COLOR_THUMB * 2))
+    return ImageOps.exif_transpose(img).convert("RGB")
+
+def _dhash(img: Image.Image) -> int:
+    pixels = img.convert("L").resize((HASH_WIDTH, HASH_HEIGHT), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for col in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + col]
+            right = pixels[row * HASH_WIDTH + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def _color_histogram(img: Image.Image) -> bytes:
+    thumb = img.resize((COLOR_THUMB, COLOR_THUMB), Image.BOX)
+    thumb = thumb.crop((COLOR_MARGIN, COLOR_MARGIN, COLOR_THUMB - COLOR_MARGIN, COLOR_THUMB - COLOR_MARGIN))
+    counts = [0] * 64
+    data = thumb.tobytes()
+    for i in range(0, len(data), 3):
+        counts[(data[i] >> 6) * 16 + (data[i + 1] >> 6) * 4 + (data[i + 2] >> 6)] += 1
+    total = len(data) // 3
+    return bytes(round(255 * count / total) for count in counts)
+
+def color_distance(a: bytes, b: bytes) -> float:
+    """
+    Share of pixels (0-1) whose colour bin differs between two histograms.
+    """
+    return sum(abs(x - y) for x, y in zip(a, b)) / (2 * 255)
+
+def compute_dhash(image_path: str) -> int:
+    """
+    Computes a 64-bit difference hash (dHash) of an image.
+    Robust to recompression, resizing and small crops; compare hashes by Hamming distance.
+    Blocking (decodes the image): run it in an executor from async code.
+    """
+    with _open_small(image_path) as img:
+        return _dhash(img)
+
+def compute_signature(image_path: str) -> Tuple[int, bytes]:
+    """
+    (dHash, colour histogram) of an image from a single decode; a near-duplicate is close in both.
+    Blocking: run it in an executor from async code.
+    """
+    with _open_small(image_path) as img:
+        return _dhash(img), _color_histogram(img)
+
+# GPT-4o vision tiling: "high" detail first fits the image in 2048x2048, then scales the
+# shortest side down to 768px and bills per 512px tile. Anything larger is wasted upload.
+VISION_MAX_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+# Images this small are read at 512px anyway, so "low" detail (fixed, cheapest) loses nothing
+VISION_LOW_DETAIL_SIDE = 512
+
+def _vision_scale(size) -> float:
+    width, height = size
+    return min(1.0, VISION_MAX_SIDE / max(width, height), VISION_MAX_SHORT_SIDE / min(width, height))
+
+def prepare_for_vision(image_path: str, quality: int = VISION_JPEG_QUALITY):
+    """
+    Fits a photo to the vision model's tile budget, strips metadata (EXIF, GPS) and re-encodes it as JPEG.
+    Blocking: run it in an executor from async code.
+    Returns (jpeg_bytes, detail) where detail is "low" or "high".
+    """
+    with Image.open(image_path) as img:
+        # Decode JPEGs at reduced size when possible (never below the target), then apply the camera orientation
+        scale = _vision_scale(img.size)
+        img.draft("RGB", (round(img.width * scale), round(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        scale = _vision_scale(img.size)
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+        detail = "low" if max(img.size) <= VISION_LOW_DETAIL_SIDE else "high"
+
+        # No exif= argument, so no metadata is written
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue(), detail
+
+if __name__ == "__main__":
+    # Near-duplicate check for the photo cache: recompressed, resized and cropped copies of a meal
+    # must hit the cache, other meals (even on the same plate) must not:
+    #   python -m src.services.image_service [photo.jpg] [other-meal.jpg]
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from PIL import ImageDraw, ImageFilter
+
+    from src.config import IMAGE_CACHE_MAX_DISTANCE, IMAGE_CACHE_MAX_COLOR_DISTANCE
+    from src.database import db
+
+    workdir = tempfile.mkdtemp()
+
+    def synthetic_meal(seed: int) -> str:
+        # A plate with a few food-like blobs on a textured table, at phone-camera size
+        rng = random.Random(seed)
+        img = Image.new("RGB", (1600, 1200), tuple(rng.randint(90, 160) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(400):
+            x, y = rng.randint(0, 1600), rng.randint(0, 1200)
+            draw.line((x, y, x + rng.randint(-80, 80), y + rng.randint(-80, 80)),
+                      fill=tuple(rng.randint(60, 200) for _ in range(3)), width=3)
+        draw.ellipse((250, 150, 1350, 1050), fill=(235, 235, 230))
+        for _ in range(rng.randint(3, 6)):
+            x, y, r = rng.randint(450, 1050), rng.randint(350, 750), rng.randint(80, 220)
+            draw.ellipse((x, y, x + r, y + int(r * rng.uniform(0.6, 1.2))), fill=tuple(rng.randint(20, 230) for _ in range(3)))
+        path = os.path.join(workdir, f"meal_{seed}.jpg")
+        img.filter(ImageFilter.GaussianBlur(2)).save(path, quality=92)
+        return path
+
+    original = sys.argv[1] if len(sys.argv) > 1 else synthetic_meal(1)
+    other = sys.argv[2] if len(sys.argv) > 2 else synthetic_meal(2)
+
+    def variant(name: str, transform) -> str:
+        path = os.path.join(workdir, f"{name}.jpg")
+        with Image.open(original) as img:
+            transform(img.convert("RGB")).save(path, quality=60 if name == "recompressed" else 85)
+        return path
+
+    variants = {
+        "recompressed": variant("recompressed", lambda img: img),
+        "resized": variant("resized", lambda img: img.resize((img.width // 2, img.height // 2), Image.LANCZOS)),
+        "cropped": variant("cropped", lambda img: img.crop((int(img.width * 0.04), int(img.height * 0.04),
+                                                           int(img.width * 0.96), int(img.height * 0.96)))),
+        "resent as thumbnail": variant("thumbnail", lambda img: img.resize((320, 240), Image.LANCZOS)),
+    }
+
+    start = time.perf_counter()
+    base, base_colors = compute_signature(original)
+    print(f"signature of the original in {(time.perf_counter() - start) * 1000:.1f} ms")
+    signatures = {name: compute_signature(path) for name, path in list(variants.items()) + [("different meal", other)]}
+    for name, (dhash, colors) in signatures.items():
+        print(f"{name:>20}: dHash {(dhash ^ base).bit_count():2d} bits, colours {color_distance(colors, base_colors):.3f}")
+
+    # Through the cache table, as analyze_food_image uses it
+    db.DB_PATH = os.path.join(workdir, "check.db")
+    db.init_db()
+    db.put_image_analysis(1, base, base_colors, "", '[{"item": "Dish"}]', "Looks tasty.", 200, 86400)
+    hits = {name: db.find_similar_image(1, dhash, colors, "", IMAGE_CACHE_MAX_DISTANCE, IMAGE_CACHE_MAX_COLOR_DISTANCE,
+                                        86400, 200) is not None
+            for name, (dhash, colors) in signatures.items()}
+    print("cache hits:", ", ".join(f"{name}={hit}" for name, hit in hits.items()))
+
+    assert all(hits[name] for name in variants), "a near-duplicate missed the cache"
+    assert not hits["different meal"], "a different meal was answered from the cache"
+
+    # Different meals photographed the same way (same plate, table and framing) are the hard case
+    others = [compute_signature(synthetic_meal(seed)) for seed in range(3, 33)]
+    false_hits = sum((dhash ^ base).bit_count() <= IMAGE_CACHE_MAX_DISTANCE
+                     and color_distance(colors, base_colors) <= IMAGE_CACHE_MAX_COLOR_DISTANCE for dhash, colors in others)
+    dhash_only = sum((dhash ^ base).bit_count() <= IMAGE_CACHE_MAX_DISTANCE for dhash, _ in others)
+    print(f"30 other meals on the same plate: {false_hits} cache hits ({dhash_only} with dHash alone)")
+    assert false_hits == 0, "different meals were answered from the cache"
+    print("OK")
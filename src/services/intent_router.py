@@ -0,0 +1,282 @@
+import csv
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from src.services.food_resolver import get_food_db, MASS_UNITS, SPOON_UNITS
+
+INTENTS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "intents.csv")
+# Labeled messages never used to write the rules or train the model, for evaluation only
+HOLDOUT_CSV = os.path.join(os.path.dirname(INTENTS_CSV), "intents_holdout.csv")
+
+FOOD_LOG = "food_log"
+CHAT = "chat"
+COMMAND = "command"
+LABELS = (FOOD_LOG, CHAT, COMMAND)
+
+# Below these probabilities the message goes to the full model instead
+CHAT_CONFIDENCE = 0.7
+COMMAND_CONFIDENCE = 0.8
+
+# Keyword rules for things the menu already does; the reply points the user to it.
+# Each pattern is anchored to the start (or the whole) of the message, so a meal that merely
+# mentions "summary", "progress" or "last meal" is not mistaken for a menu request.
+_END = r"[.!?]*$"
+_PLEASE = r"(?: please)?"
+COMMAND_RULES = [
+    (re.compile(rf"^(?:(?:show|open|see)(?: me)? )?(?:my |the )?(?:daily |today'?s )?(?:journal|summary){_PLEASE}{_END}"
+                rf"|^(?:what did i eat today|how many calories have i eaten today|what'?s left for today|how am i doing(?: today)?){_END}"),
+     "Tap 📊 Daily Journal to see today's totals and what's left of your goal."),
+    (re.compile(rf"^(?:(?:show|see)(?: me)? )?(?:my )?history(?: for (?:this|last) (?:week|month))?{_PLEASE}{_END}"
+                rf"|^(?:show (?:me )?)?(?:my )?(?:last \d+ days|this week|this month){_END}"),
+     "Send /history (or /history week, /history month) to see past days."),
+    (re.compile(rf"^(?:export|download|send me)(?: my| a)? (?:data|logs|csv|history){_PLEASE}{_END}|^export{_END}"),
+     "Send /export [days] and I'll send your logs as a CSV file."),
+    (re.compile(rf"^(?:delete|undo|remove|clear)(?: my| the| that| this)?(?: last)? (?:entry|log|logs|meal|today|today'?s logs){_END}"
+                rf"|^undo(?: last log)?{_END}|^reset my day{_END}"),
+     "Open 📊 Daily Journal → Manage logs to delete entries or clear the day."),
+    (re.compile(rf"^(?:set|change|update|edit)(?: my)?(?: daily| calorie)* (?:goal|goals|profile|weight|target)\b"
+                rf"|^(?:my )?(?:daily |calorie )*goal is\b"),
+     "Tap ⚙️ Set Goals to recalculate or enter your daily target."),
+    (re.compile(rf"^(?:(?:open|show)(?: me)? )?(?:the |my )?(?:dashboard|progress){_PLEASE}{_END}"),
+     "Tap 📱 Open Dashboard to see your charts."),
+    (re.compile(rf"^(?:i want to |how (?:do|can) i )?scan(?: a)? (?:barcode|product|code){_END}|^barcode{_END}"),
+     "Tap 🔍 Scan Barcode and send a photo of the code."),
+    (re.compile(rf"^(?:log a photo|log a meal|how (?:do|can) i log(?: a meal| food| a photo)?){_END}"),
+     "Send me a food photo or just type what you ate, e.g. \"2 eggs and toast\"."),
+    (re.compile(rf"^(?:cancel|start over|menu|show menu|settings){_END}"),
+     "Tap ❌ Cancel / Reset or send /start to get the menu back.")
+]
+DEFAULT_COMMAND_REPLY = "Use the menu buttons (or /start to show them) for the journal, goals, dashboard and barcode scanning."
+
+# Messages that are chat no matter what
+_SMALL_TALK = re.compile(
+    r"^(hi|hello|hey|hey there|yo|good (morning|evening|night)|thanks|thank you|thx|merci|gracias|bonjour|hola|"
+    r"ok|okay|cool|great|nice|wow|lol|haha|bye|yes|no)( [a-z]+)?[!. ]*$"
+)
+_QUANTITY = re.compile(rf"\b\d+(?:[.,]\d+)?\s*(?:{'|'.join(sorted(set(MASS_UNITS) | set(SPOON_UNITS), key=len, reverse=True))})\b")
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+@dataclass
+class Intent:
+    label: str
+    confidence: float
+    source: str # "keyword" or "model"
+    reply: Optional[str] = None # canned answer for commands
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+def features(text: str) -> List[str]:
+    """
+    Bag of words and bigrams plus a few shape markers (numbers, units, known foods, questions).
+    """
+    tokens = _TOKEN.findall(text)
+    food_db = get_food_db()
+    result = list(tokens)
+    result += [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    if tokens:
+        result.append(f"__first_{tokens[0]}")
+    if any(c.isdigit() for c in text):
+        result.append("__num")
+    if _QUANTITY.search(text):
+        result.append("__qty")
+    if "?" in text:
+        result.append("__question")
+    if len(tokens) <= 2:
+        result.append("__short")
+    result += ["__food"] * sum(1 for t in tokens if food_db.knows(t))
+    return result
+
+class NaiveBayes:
+    """
+    Multinomial naive Bayes over `features` (a linear model in log space), trained in memory.
+    """
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.log_prior: Dict[str, float] = {}
+        self.log_likelihood: Dict[str, Dict[str, float]] = {}
+        self.log_missing: Dict[str, float] = {} # vocabulary features never seen with the label
+        self.vocabulary: set = set()
+
+    def fit(self, texts: List[str], labels: List[str]) -> "NaiveBayes":
+        counts = defaultdict(Counter)
+        for text, label in zip(texts, labels):
+            counts[label].update(features(text))
+        self.vocabulary = set().union(*counts.values())
+        total = len(labels)
+        for label in counts:
+            denominator = sum(counts[label].values()) + self.alpha * len(self.vocabulary)
+            self.log_prior[label] = math.log(labels.count(label) / total)
+            self.log_likelihood[label] = {f: math.log((n + self.alpha) / denominator) for f, n in counts[label].items()}
+            self.log_missing[label] = math.log(self.alpha / denominator)
+        return self
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        Returns (label, probability).
+        """
+        # Words never seen in training carry no evidence; scoring them would favour the smallest class
+        feats = [f for f in features(text) if f in self.vocabulary]
+        scores = {}
+        for label, prior in self.log_prior.items():
+            table, missing = self.log_likelihood[label], self.log_missing[label]
+            scores[label] = prior + sum(table.get(f, missing) for f in feats)
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(s - scores[best]) for s in scores.values())
+        return best, 1.0 / norm
+
+def load_examples(path: str = INTENTS_CSV) -> Tuple[List[str], List[str]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    return [_normalize(r["text"]) for r in rows], [r["label"] for r in rows]
+
+_model: Optional[NaiveBayes] = None
+
+def get_model() -> NaiveBayes:
+    global _model
+    if _model is None:
+        _model = NaiveBayes().fit(*load_examples())
+    return _model
+
+def _mentions_food(text: str) -> bool:
+    food_db = get_food_db()
+    return any(food_db.knows(token) for token in _TOKEN.findall(text))
+
+def keyword_intent(text: str) -> Optional[Intent]:
+    """
+    Rule layer: menu commands, small talk and explicit quantities.
+    A message with a quantity or a known food is never taken for a menu command.
+    """
+    if not _QUANTITY.search(text) and not _mentions_food(text):
+        for pattern, reply in COMMAND_RULES:
+            if pattern.search(text):
+                return Intent(COMMAND, 1.0, "keyword", reply)
+    if _SMALL_TALK.match(text):
+        return Intent(CHAT, 1.0, "keyword")
+    if _QUANTITY.search(text) and "?" not in text:
+        return Intent(FOOD_LOG, 1.0, "keyword")
+    return None
+
+def classify(text: str, model: Optional[NaiveBayes] = None) -> Intent:
+    """
+    Decides whether a message is a food log, chat or a command: keyword rules first, then the model.
+    """
+    text = _normalize(text)
+    intent = keyword_intent(text)
+    if intent is not None:
+        return intent
+    label, confidence = (model or get_model()).predict(text)
+    if label == COMMAND and (_QUANTITY.search(text) or _mentions_food(text)):
+        # Menu requests never name a food or an amount ("remove the cheese from my last meal");
+        # let the full model read it rather than answering with a canned pointer
+        label = FOOD_LOG
+    reply = DEFAULT_COMMAND_REPLY if label == COMMAND else None
+    return Intent(label, confidence, "model", reply)
+
+# Model tiers: "local" answers without an LLM, "fast" is the cheap model, "full" the main one
+def tier_for(intent: Intent) -> str:
+    """
+    Confident commands are answered locally and confident chat goes to the fast model;
+    food logs and anything uncertain get the full model.
+    """
+    if intent.label == COMMAND and intent.confidence >= COMMAND_CONFIDENCE:
+        return "local"
+    if intent.label == CHAT and intent.confidence >= CHAT_CONFIDENCE:
+        return "fast"
+    return "full"
+
+class TierStats:
+    """
+    Rolling latency samples per model tier ("local", "fast", "full").
+    """
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self.counts: Counter = Counter()
+
+    def record(self, tier: str, seconds: float):
+        self._samples.setdefault(tier, deque(maxlen=self.window)).append(seconds)
+        self.counts[tier] += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for tier, samples in self._samples.items():
+            ordered = sorted(samples)
+            result[tier] = {
+                "count": self.counts[tier],
+                "p50_ms": ordered[len(ordered) // 2] * 1000,
+                "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000
+            }
+        return result
+
+tier_stats = TierStats()
+
+if __name__ == "__main__":
+    # Accuracy vs latency on the labeled set (5-fold cross-validation), then on the held-out set:
+    #   python -m src.services.intent_router
+    import random
+
+    texts, labels = load_examples()
+    order = list(range(len(texts)))
+    random.Random(0).shuffle(order)
+    folds = [order[i::5] for i in range(5)]
+
+    def evaluate(name, predict):
+        correct, timings = 0, []
+        confusion = Counter()
+        tiers = Counter()
+        for fold in folds:
+            held_out = set(fold)
+            train = [i for i in order if i not in held_out]
+            model = NaiveBayes().fit([texts[i] for i in train], [labels[i] for i in train])
+            for i in fold:
+                start = time.perf_counter()
+                intent = predict(texts[i], model)
+                timings.append(time.perf_counter() - start)
+                correct += intent.label == labels[i]
+                confusion[(labels[i], intent.label)] += 1
+                tiers[(labels[i], tier_for(intent))] += 1
+        timings.sort()
+        chats = labels.count(CHAT)
+        print(f"{name:>9}: accuracy {correct / len(texts):.1%}, latency p50 {timings[len(timings) // 2] * 1e6:.0f} us, "
+              f"p95 {timings[int(len(timings) * 0.95)] * 1e6:.0f} us")
+        # The costly mistakes are meals answered by a canned reply or by the cheap model
+        print(f"{'':>11}chat on fast tier {tiers[(CHAT, 'fast')]}/{chats}, meals answered locally "
+              f"{tiers[(FOOD_LOG, 'local')]}, meals on fast tier {tiers[(FOOD_LOG, 'fast')]}")
+        return confusion
+
+    def keywords_only(text, model):
+        # Without the model, anything unmatched goes to the full model as before
+        return keyword_intent(text) or Intent(FOOD_LOG, 0.0, "default")
+
+    def model_only(text, model):
+        label, confidence = model.predict(text)
+        return Intent(label, confidence, "model")
+
+    get_food_db()
+    evaluate("keywords", keywords_only)
+    evaluate("model", model_only)
+    confusion = evaluate("combined", classify)
+    print("\nconfusion (combined), rows = true label:")
+    print(" " * 10 + "".join(f"{label:>10}" for label in LABELS))
+    for true in LABELS:
+        print(f"{true:>10}" + "".join(f"{confusion[(true, predicted)]:>10}" for predicted in LABELS))
+
+    # The held-out set: trained on all of intents.csv, scored on messages the rules were not written for
+    holdout_texts, holdout_labels = load_examples(HOLDOUT_CSV)
+    model = NaiveBayes().fit(texts, labels)
+    results = [(text, label, classify(text, model)) for text, label in zip(holdout_texts, holdout_labels)]
+    correct = sum(intent.label == label for _, label, intent in results)
+    meals_local = sum(label == FOOD_LOG and tier_for(intent) == "local" for _, label, intent in results)
+    print(f"\nheld-out set: accuracy {correct / len(results):.1%} ({correct}/{len(results)}), "
+          f"meals answered locally {meals_local}")
+    for text, label, intent in results:
+        if intent.label != label:
+            print(f"  {text!r}: {label} -> {intent.label} ({intent.source}, {tier_for(intent)} tier)")
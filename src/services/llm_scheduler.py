@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional
+
+import openai
+
+from src.config import OPENAI_MAX_CONCURRENCY, OPENAI_RPM, OPENAI_TPM, OPENAI_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Priorities: lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Rough prompt-token cost of one image (OpenAI vision pricing: 85 base + 170 per 512px tile)
+IMAGE_TOKENS = {"low": 85, "high": 85 + 170 * 4}
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+def estimate_tokens(*texts: str, completion: int = 500, image_tokens: int = 0) -> int:
+    """
+    Cheap upper-ish estimate of a request's token cost (~4 characters per token),
+    used to reserve TPM budget before the real usage is known.
+    """
+    return sum(len(t) for t in texts) // 4 + completion + image_tokens
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Rate limits, timeouts, connection errors and 5xx are worth retrying; other client errors are not.
+    """
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds the server asked us to wait, from `retry-after-ms` or `retry-after` (seconds or HTTP date).
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """
+    Continuously refilling budget of `per_minute` units.
+    Callers reserve units up front and sleep off any deficit, so concurrent callers
+    line up behind each other instead of all firing once the budget comes back.
+    """
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` units and returns how many seconds to wait before using them.
+        """
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, delta: float):
+        """
+        Returns (delta > 0) or charges (delta < 0) units once the real cost is known.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+class LLMScheduler:
+    """
+    Shared gate in front of the OpenAI client:
+    - at most `max_concurrency` requests in flight, handed out by priority (interactive first)
+    - requests-per-minute and tokens-per-minute token buckets (0 disables a bucket)
+    - retries with full-jitter exponential backoff, honouring `Retry-After`;
+      a 429 with `Retry-After` pauses every caller, not just the one that got it.
+    """
+    def __init__(self, max_concurrency: int = OPENAI_MAX_CONCURRENCY, rpm: int = OPENAI_RPM,
+                 tpm: int = OPENAI_TPM, max_retries: int = OPENAI_MAX_RETRIES,
+                 base_delay: float = 0.5, max_delay: float = 20.0):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self._active = 0
+        self._waiters = [] # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "throttled": 0,
+            "failures": 0,
+            "tokens": 0
+        }
+
+    @property
+    def in_flight(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def _acquire(self, priority: int):
+        if self._active < self.max_concurrency and not self.queued:
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before we were cancelled
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        # Hand the slot straight to the best waiter so nobody can jump the queue
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    async def _wait_for_budget(self, tokens: int):
+        delay = max(0.0, self._paused_until - time.monotonic())
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and tokens:
+            delay = max(delay, self.token_bucket.reserve(tokens))
+        if delay > 0:
+            self.stats["throttled"] += 1
+            await asyncio.sleep(delay)
+
+    def _settle(self, result: Any, tokens: int):
+        usage = getattr(result, "usage", None)
+        total = getattr(usage, "total_tokens", None)
+        if not total:
+            return
+        self.stats["tokens"] += total
+        if self.token_bucket is not None:
+            self.token_bucket.adjust(tokens - total)
+
+    def _refund(self, tokens: int):
+        if self.token_bucket is not None and tokens:
+            self.token_bucket.adjust(tokens)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        wait = retry_after(error)
+        if wait is not None:
+            delay = max(delay, wait + random.uniform(0, self.base_delay))
+            if getattr(error, "status_code", None) == 429:
+                self._paused_until = max(self._paused_until, time.monotonic() + wait)
+        return delay
+
+    async def submit(self, call: Callable[[], Awaitable[Any]], tokens: int = 0, priority: int = INTERACTIVE) -> Any:
+        """
+        Runs `call()` (a fresh request per attempt) under the concurrency and rate limits.
+        `tokens` is the estimated cost reserved from the TPM budget; it is corrected from
+        `result.usage` afterwards. Raises the last error once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            # Wait for rate budget before taking a slot, so throttled requests don't hold
+            # slots that other requests could use right away
+            try:
+                await self._wait_for_budget(tokens)
+                await self._acquire(priority)
+            except asyncio.CancelledError:
+                self._refund(tokens)
+                raise
+            try:
+                self.stats["requests"] += 1
+                result = await call()
+            except BaseException as e:
+                # A failed attempt is billed nothing; its reservation goes back to the budget
+                self._refund(tokens)
+                if not isinstance(e, Exception):
+                    raise
+                error = e
+            else:
+                self._settle(result, tokens)
+                return result
+            finally:
+                self._release()
+
+            if getattr(error, "status_code", None) == 429:
+                self.stats["rate_limited"] += 1
+            if not is_retryable(error) or attempt >= self.max_retries:
+                self.stats["failures"] += 1
+                raise error
+            delay = self._backoff(attempt, error)
+            attempt += 1
+            self.stats["retries"] += 1
+            logger.warning("OpenAI request failed (%s), retry %d in %.2fs", error, attempt, delay)
+            await asyncio.sleep(delay)
+
+llm_scheduler = LLMScheduler()
+
+if __name__ == "__main__":
+    # Load simulation against a fake endpoint that injects latency and 429s:
+    #   python -m src.services.llm_scheduler [requests] [rpm] [429-probability]
+    import sys
+    from types import SimpleNamespace
+
+    class FakeRateLimitError(Exception):
+        status_code = 429
+        def __init__(self, wait: float):
+            super().__init__("429 Too Many Requests")
+            self.response = SimpleNamespace(headers={"retry-after-ms": str(int(wait * 1000))})
+
+    async def simulate(total: int, rpm: int, error_rate: float):
+        scheduler = LLMScheduler(max_concurrency=8, rpm=rpm, tpm=0, max_retries=5, base_delay=0.05, max_delay=1.0)
+        in_flight = peak = 0
+
+        async def fake_call():
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            try:
+                await asyncio.sleep(random.uniform(0.02, 0.2))
+                if random.random() < error_rate:
+                    raise FakeRateLimitError(random.uniform(0.05, 0.3))
+                return SimpleNamespace(usage=SimpleNamespace(total_tokens=600))
+            finally:
+                in_flight -= 1
+
+        latencies = {INTERACTIVE: [], BACKGROUND: []}
+        failed = 0
+
+        async def one(i: int):
+            nonlocal failed
+            priority = BACKGROUND if i % 3 == 0 else INTERACTIVE
+            start = time.perf_counter()
+            try:
+                await scheduler.submit(fake_call, tokens=700, priority=priority)
+            except FakeRateLimitError:
+                failed += 1
+            latencies[priority].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+        print(f"{total} requests in {elapsed:.2f}s, peak in flight {peak}, failed {failed}")
+        print(f"stats: {scheduler.stats}")
+        for priority, name in ((INTERACTIVE, "interactive"), (BACKGROUND, "background")):
+            values = sorted(latencies[priority])
+            if values:
+                print(f"{name:>11}: p50 {values[len(values) // 2] * 1000:.0f} ms, "
+                      f"p95 {values[int(len(values) * 0.95)] * 1000:.0f} ms")
+
+    args = sys.argv[1:]
+    asyncio.run(simulate(
+        int(args[0]) if len(args) > 0 else 300,
+        int(args[1]) if len(args) > 1 else 3000,
+        float(args[2]) if len(args) > 2 else 0.1
+    ))
@@ -0,0 +1,135 @@
+import logging
+import re
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Dict, Any
+
+from src.database.log_writer import log_writer
+
+MEAL_PERIODS = ("Breakfast", "Lunch", "Dinner", "Snack")
+
+@dataclass
+class MealItem:
+    """
+    A single validated food item, ready to be stored in `logs`.
+    """
+    name: str
+    calories: int
+    protein: float
+    carbs: float
+    fats: float
+    micronutrients: str = "N/A"
+    health_score: Optional[int] = 5
+    meal_period: str = "Snack"
+    weight_g: Optional[float] = None
+
+@dataclass
+class MealResult:
+    """
+    Outcome of logging a meal: the stored items, their totals and today's state after the insert.
+    """
+    group_id: str
+    items: List[MealItem]
+    total_calories: int
+    total_protein: float
+    total_carbs: float
+    total_fats: float
+    avg_health_score: float
+    day_snapshot: Dict[str, Any]
+
+def _to_number(value, default=0.0) -> float:
+    """
+    Coerces LLM/OFF values like 12, "12.5", "12 g" or None into a float.
+    """
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = re.search(r"-?\d+(?:[.,]\d+)?", value)
+        if match:
+            return float(match.group().replace(',', '.'))
+    return default
+
+def current_meal_period(now: Optional[datetime] = None) -> str:
+    """
+    Guesses the meal period from the time of day.
+    """
+    hour = (now or datetime.now()).hour
+    if 5 <= hour < 11:
+        return "Breakfast"
+    elif 11 <= hour < 15:
+        return "Lunch"
+    elif 18 <= hour < 22:
+        return "Dinner"
+    return "Snack"
+
+def parse_meal_item(raw: Dict[str, Any]) -> Optional[MealItem]:
+    """
+    Validates one item dict coming from the LLM or Open Food Facts.
+    Returns None if the item has no usable name.
+    """
+    if not isinstance(raw, dict):
+        return None
+
+    name = raw.get('item') or raw.get('name')
+    if not name or not str(name).strip():
+        return None
+
+    score = raw.get('health_score', 5)
+    if score is not None:
+        score = int(min(10, max(1, round(_to_number(score, 5)))))
+
+    meal_period = str(raw.get('meal_period') or 'Snack').strip().capitalize()
+    if meal_period not in MEAL_PERIODS:
+        meal_period = 'Snack'
+
+    weight = raw.get('weight_g')
+    weight = _to_number(weight, None) if weight is not None else None
+
+    return MealItem(
+        name=str(name).strip(),
+        calories=int(round(max(0.0, _to_number(raw.get('calories'))))),
+        protein=max(0.0, _to_number(raw.get('protein'))),
+        carbs=max(0.0, _to_number(raw.get('carbs'))),
+        fats=max(0.0, _to_number(raw.get('fats'))),
+        micronutrients=str(raw.get('micronutrients') or 'N/A'),
+        health_score=score,
+        meal_period=meal_period,
+        weight_g=weight
+    )
+
+async def log_meal(user_id: int, items: List[Dict[str, Any]], source: str) -> Optional[MealResult]:
+    """
+    Validates a meal's items and stores them as one meal group.
+    Rows are committed by the shared group-commit writer (one transaction per batch).
+    `source` is where the items came from ("photo", "text", "webapp", "barcode").
+    Returns None if no item was valid.
+    """
+    meal_items = [item for item in (parse_meal_item(raw) for raw in items or []) if item]
+    if not meal_items:
+        logging.warning(f"No valid items to log for user {user_id} (source: {source}).")
+        return None
+
+    group_id = str(uuid.uuid4())
+    rows = [
+        (item.name, item.calories, item.protein, item.carbs, item.fats,
+         item.micronutrients, item.health_score, group_id, item.meal_period)
+        for item in meal_items
+    ]
+    day_snapshot = await log_writer.write(user_id, rows)
+
+    scores = [item.health_score for item in meal_items if item.health_score is not None]
+    logging.info(f"Logged {len(meal_items)} item(s) for user {user_id} from {source}.")
+
+    return MealResult(
+        group_id=group_id,
+        items=meal_items,
+        total_calories=sum(item.calories for item in meal_items),
+        total_protein=sum(item.protein for item in meal_items),
+        total_carbs=sum(item.carbs for item in meal_items),
+        total_fats=sum(item.fats for item in meal_items),
+        avg_health_score=sum(scores) / len(scores) if scores else 0,
+        day_snapshot=day_snapshot
+    )
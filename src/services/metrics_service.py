@@ -0,0 +1,389 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.database.async_db import add_llm_usage
+from src.services.llm_scheduler import is_retryable
+
+# USD per 1M tokens (input, output); models are matched by longest name prefix
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+_PRICE_PREFIXES = sorted(PRICES, key=len, reverse=True)
+
+# Histogram bucket upper bounds
+LATENCY_BOUNDS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+TOKEN_BOUNDS = (250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# Per-user histograms are kept for the most recently active users only
+MAX_TRACKED_USERS = 1000
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Cost in USD of one call; 0 for models missing from PRICES.
+    """
+    for prefix in _PRICE_PREFIXES:
+        if model.startswith(prefix):
+            per_input, per_output = PRICES[prefix]
+            return (prompt_tokens * per_input + completion_tokens * per_output) / 1_000_000
+    return 0.0
+
+@dataclass
+class LLMCall:
+    """
+    One metered LLM call. The caller fills in attempts, token usage and (for refusals) the outcome.
+    """
+    endpoint: str
+    model: str
+    user_id: Optional[int] = None
+    image_bytes: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    attempts: int = 0
+    latency: float = 0.0
+    outcome: str = "ok" # ok, refusal, rate_limited, unavailable, error, cancelled
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    @property
+    def cost(self) -> float:
+        return price(self.model, self.prompt_tokens, self.completion_tokens)
+
+    def add_usage(self, usage):
+        if usage is not None:
+            self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+class RollingHistogram:
+    """
+    Bucketed histogram over the last `window` seconds, kept as a ring of `slots` sub-histograms;
+    a slot is cleared when time comes back around to it.
+    """
+    def __init__(self, bounds: Tuple[float, ...], window: float = 3600, slots: int = 60):
+        self.bounds = bounds
+        self.slot_seconds = window / slots
+        self._counts: List[Optional[List[int]]] = [None] * slots # allocated on first use
+        self._sums = [0.0] * slots
+        self._epochs = [-1] * slots
+
+    def record(self, value: float, now: Optional[float] = None):
+        epoch = int((now or time.time()) / self.slot_seconds)
+        slot = epoch % len(self._epochs)
+        if self._epochs[slot] != epoch:
+            self._epochs[slot] = epoch
+            self._counts[slot] = [0] * (len(self.bounds) + 1)
+            self._sums[slot] = 0.0
+        self._counts[slot][bisect.bisect_left(self.bounds, value)] += 1
+        self._sums[slot] += value
+
+    def snapshot(self, now: Optional[float] = None) -> Tuple[List[int], float]:
+        """
+        Returns (bucket counts, sum) over the window.
+        """
+        oldest = int((now or time.time()) / self.slot_seconds) - len(self._epochs) + 1
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        for slot, epoch in enumerate(self._epochs):
+            if epoch >= oldest and self._counts[slot] is not None:
+                counts = [a + b for a, b in zip(counts, self._counts[slot])]
+                total += self._sums[slot]
+        return counts, total
+
+    def quantile(self, q: float, now: Optional[float] = None) -> float:
+        """
+        Estimated quantile, interpolated inside its bucket (the overflow bucket reports the last bound).
+        """
+        counts, _ = self.snapshot(now)
+        rank = q * sum(counts)
+        if not rank:
+            return 0.0
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.bounds):
+                    return float(self.bounds[-1])
+                low = self.bounds[i - 1] if i else 0
+                return low + (self.bounds[i] - low) * (rank - seen) / count
+            seen += count
+        return float(self.bounds[-1])
+
+class _Series:
+    """
+    Rolling latency/token histograms plus windowed counters for one endpoint or user.
+    """
+    __slots__ = ("latency_ms", "tokens", "errors", "cost")
+
+    def __init__(self):
+        self.latency_ms = RollingHistogram(LATENCY_BOUNDS_MS)
+        self.tokens = RollingHistogram(TOKEN_BOUNDS)
+        # No bounds: a single bucket, i.e. a rolling count and sum
+        self.errors = RollingHistogram(())
+        self.cost = RollingHistogram(())
+
+    def record(self, call: LLMCall, now: float):
+        self.latency_ms.record(call.latency * 1000, now)
+        self.tokens.record(call.prompt_tokens + call.completion_tokens, now)
+        if call.outcome != "ok":
+            self.errors.record(1, now)
+        self.cost.record(call.cost, now)
+
+    def summary(self, now: Optional[float] = None) -> Dict[str, float]:
+        now = now or time.time()
+        return {
+            "calls": sum(self.latency_ms.snapshot(now)[0]),
+            "errors": self.errors.snapshot(now)[1],
+            "tokens": self.tokens.snapshot(now)[1],
+            "cost_usd": self.cost.snapshot(now)[1],
+            "p50_ms": self.latency_ms.quantile(0.5, now),
+            "p95_ms": self.latency_ms.quantile(0.95, now)
+        }
+
+class LLMMetrics:
+    """
+    Collects every LLM call: rolling per-endpoint and per-user histograms (last hour),
+    process-lifetime counters for /metrics, and a pending daily rollup flushed to SQLite.
+    """
+    def __init__(self, max_users: int = MAX_TRACKED_USERS):
+        self.max_users = max_users
+        self.endpoints: Dict[str, _Series] = {}
+        self.users: "OrderedDict[int, _Series]" = OrderedDict()
+        # Lifetime counters keyed by (endpoint, model, outcome) and cumulative latency buckets per endpoint
+        self.totals: Dict[tuple, List[float]] = defaultdict(lambda: [0, 0, 0, 0, 0, 0.0])
+        self.latency_buckets: Dict[str, List[int]] = {}
+        self.latency_sums: Dict[str, float] = defaultdict(float)
+        self._pending: Dict[tuple, List[float]] = {}
+
+    @contextmanager
+    def meter(self, endpoint: str, model: str, user_id: Optional[int] = None, image_bytes: int = 0) -> Iterator[LLMCall]:
+        """
+        Times the block and records it as one call; the outcome comes from the exception it raises, if any.
+        """
+        call = LLMCall(endpoint, model, user_id, image_bytes)
+        start = time.perf_counter()
+        try:
+            yield call
+        except asyncio.CancelledError:
+            call.outcome = "cancelled"
+            raise
+        except Exception as e:
+            if call.outcome == "ok":
+                if getattr(e, "status_code", None) == 429:
+                    call.outcome = "rate_limited"
+                elif is_retryable(e):
+                    call.outcome = "unavailable"
+                else:
+                    call.outcome = "error"
+            raise
+        finally:
+            call.latency = time.perf_counter() - start
+            self.record(call)
+
+    def record(self, call: LLMCall):
+        now = time.time()
+        series = self.endpoints.get(call.endpoint)
+        if series is None:
+            series = self.endpoints[call.endpoint] = _Series()
+        series.record(call, now)
+
+        if call.user_id is not None:
+            series = self.users.get(call.user_id)
+            if series is None:
+                series = self.users[call.user_id] = _Series()
+                if len(self.users) > self.max_users:
+                    self.users.popitem(last=False)
+            else:
+                self.users.move_to_end(call.user_id)
+            series.record(call, now)
+
+        cost = call.cost
+        totals = self.totals[(call.endpoint, call.model, call.outcome)]
+        totals[0] += 1
+        totals[1] += call.prompt_tokens
+        totals[2] += call.completion_tokens
+        totals[3] += call.image_bytes
+        totals[4] += call.retries
+        totals[5] += cost
+        latency_ms = call.latency * 1000
+        buckets = self.latency_buckets.get(call.endpoint)
+        if buckets is None:
+            buckets = self.latency_buckets[call.endpoint] = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+        buckets[bisect.bisect_left(LATENCY_BOUNDS_MS, latency_ms)] += 1
+        self.latency_sums[call.endpoint] += call.latency
+
+        day = datetime.now(timezone.utc).date().isoformat()
+        key = (day, call.endpoint, call.model, call.user_id or 0)
+        row = self._pending.get(key)
+        if row is None:
+            row = self._pending[key] = [0, 0, 0, 0, 0, 0, 0.0, 0.0]
+        row[0] += 1
+        row[1] += call.outcome != "ok"
+        row[2] += call.retries
+        row[3] += call.prompt_tokens
+        row[4] += call.completion_tokens
+        row[5] += call.image_bytes
+        row[6] += cost
+        row[7] += latency_ms
+
+    async def flush(self):
+        """
+        Adds the pending counters to the daily rollup table.
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [
+            {
+                "day": day, "endpoint": endpoint, "model": model, "user_id": user_id,
+                "calls": v[0], "errors": v[1], "retries": v[2], "prompt_tokens": v[3],
+                "completion_tokens": v[4], "image_bytes": v[5], "cost_usd": v[6], "latency_ms_sum": v[7]
+            }
+            for (day, endpoint, model, user_id), v in pending.items()
+        ]
+        try:
+            await add_llm_usage(rows)
+        except Exception as e:
+            logging.error(f"Error saving LLM usage: {e}")
+            # Keep the counters for the next flush
+            for key, values in pending.items():
+                row = self._pending.setdefault(key, [0, 0, 0, 0, 0, 0, 0.0, 0.0])
+                for i, value in enumerate(values):
+                    row[i] += value
+
+    async def flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def endpoint_summary(self) -> Dict[str, Dict[str, float]]:
+        now = time.time()
+        return {name: series.summary(now) for name, series in self.endpoints.items()}
+
+    def user_summary(self, user_id: int) -> Optional[Dict[str, float]]:
+        series = self.users.get(user_id)
+        return series.summary() if series is not None else None
+
+    def prometheus(self, counters: Optional[Dict[str, dict]] = None) -> str:
+        """
+        Lifetime counters and latency histograms in the Prometheus text format.
+        `counters` adds other components' stats dicts, e.g. {"llm_scheduler": llm_scheduler.stats}.
+        """
+        lines = [
+            "# TYPE nutrition_llm_calls_total counter",
+            "# TYPE nutrition_llm_tokens_total counter",
+            "# TYPE nutrition_llm_image_bytes_total counter",
+            "# TYPE nutrition_llm_retries_total counter",
+            "# TYPE nutrition_llm_cost_usd_total counter"
+        ]
+        for (endpoint, model, outcome), (calls, prompt, completion, image_bytes, retries, cost) in sorted(self.totals.items()):
+            labels = f'endpoint="{endpoint}",model="{model}",outcome="{outcome}"'
+            lines.append(f"nutrition_llm_calls_total{{{labels}}} {calls}")
+            lines.append(f'nutrition_llm_tokens_total{{{labels},kind="prompt"}} {prompt}')
+            lines.append(f'nutrition_llm_tokens_total{{{labels},kind="completion"}} {completion}')
+            lines.append(f"nutrition_llm_image_bytes_total{{{labels}}} {image_bytes}")
+            lines.append(f"nutrition_llm_retries_total{{{labels}}} {retries}")
+            lines.append(f"nutrition_llm_cost_usd_total{{{labels}}} {cost:.6f}")
+
+        lines.append("# TYPE nutrition_llm_latency_seconds histogram")
+        for endpoint, buckets in sorted(self.latency_buckets.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BOUNDS_MS + (None,), buckets):
+                cumulative += count
+                le = "+Inf" if bound is None else f"{bound / 1000:g}"
+                lines.append(f'nutrition_llm_latency_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+            lines.append(f'nutrition_llm_latency_seconds_sum{{endpoint="{endpoint}"}} {self.latency_sums[endpoint]:.6f}')
+            lines.append(f'nutrition_llm_latency_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+
+        for component, stats in sorted((counters or {}).items()):
+            for name, value in sorted(stats.items()):
+                lines.append(f"# TYPE nutrition_{component}_{name} counter")
+                lines.append(f"nutrition_{component}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+llm_metrics = LLMMetrics()
+
+async def start_metrics_server(port: int):
+    """
+    Serves GET /metrics on `port`. Returns the aiohttp runner (call `cleanup()` on shutdown).
+    """
+    from aiohttp import web
+    from src.services.llm_scheduler import llm_scheduler
+    from src.services.product_cache import product_cache
+
+    async def handle(request):
+        text = llm_metrics.prometheus({"llm_scheduler": llm_scheduler.stats, "product_cache": product_cache.stats})
+        text += f"# TYPE nutrition_product_cache_hit_ratio gauge\nnutrition_product_cache_hit_ratio {product_cache.hit_rate:.4f}\n"
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logging.info(f"Metrics served on :{port}/metrics")
+    return runner
+
+if __name__ == "__main__":
+    # Metering overhead relative to a (stubbed) LLM call:
+    #   python -m src.services.metrics_service [calls] [call-ms]
+    import random
+    import sys
+    from types import SimpleNamespace
+
+    async def benchmark(calls: int, call_ms: float):
+        metrics = LLMMetrics()
+        usage = SimpleNamespace(prompt_tokens=900, completion_tokens=250)
+
+        # Cost of the wrapper itself: meter + usage bookkeeping around a call that does nothing
+        start = time.perf_counter()
+        for i in range(calls):
+            with metrics.meter("process_user_message", "gpt-4o-2024-08-06", user_id=random.randrange(5000)) as call:
+                call.attempts += 1
+                call.add_usage(usage)
+        wrapper_us = (time.perf_counter() - start) / calls * 1e6
+
+        start = time.perf_counter()
+        summary = metrics.endpoint_summary()
+        text = metrics.prometheus()
+        read_ms = (time.perf_counter() - start) * 1000
+
+        # End to end against a stub call of realistic latency, with and without the wrapper
+        async def stub():
+            await asyncio.sleep(call_ms / 1000)
+            return SimpleNamespace(usage=usage)
+
+        async def bare():
+            return await stub()
+
+        async def metered():
+            with metrics.meter("analyze_food_image", "gpt-4o-2024-08-06", user_id=1, image_bytes=180_000) as call:
+                call.attempts += 1
+                result = await stub()
+                call.add_usage(result.usage)
+                return result
+
+        timings = {}
+        for name, func in (("bare", bare), ("metered", metered)):
+            start = time.perf_counter()
+            await asyncio.gather(*(func() for _ in range(200)))
+            timings[name] = (time.perf_counter() - start) * 1000
+
+        print(f"wrapper: {wrapper_us:.1f} us per call over {calls} calls "
+              f"({wrapper_us / (call_ms * 1000):.4%} of a {call_ms:.0f} ms call)")
+        print(f"summary + /metrics render: {read_ms:.2f} ms ({len(text.splitlines())} lines, {len(metrics.users)} users tracked)")
+        print(f"200 concurrent stub calls: bare {timings['bare']:.1f} ms, metered {timings['metered']:.1f} ms")
+        print(f"pending rollup rows: {len(metrics._pending)}, endpoints: {sorted(summary)}")
+
+    args = sys.argv[1:]
+    asyncio.run(benchmark(int(args[0]) if len(args) > 0 else 100000, float(args[1]) if len(args) > 1 else 800))
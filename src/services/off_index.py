@@ -0,0 +1,382 @@
+import csv
+import gzip
+import heapq
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+from src.config import OFF_INDEX_PATH
+
+# Optional faster JSON decoding (the dump is tens of GB of JSON)
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# File layout: a header, then fixed-width records sorted by key.
+# key = (code length << 58) | int(code), so "0123" and "123" stay distinct; codes up to 17 digits.
+HEADER = struct.Struct("<8sIIQd") # magic, version, record size, record count, built at (unix time)
+RECORD = struct.Struct("<Qffff48s") # key, kcal, protein, carbs, fat (per 100 g), UTF-8 name (truncated, NUL padded)
+MAGIC = b"OFFIDX\0\0"
+VERSION = 1
+MAX_CODE_DIGITS = 17
+NAME_BYTES = 48
+
+# Records held in memory per sorted run while importing (~72 bytes each on disk)
+RUN_RECORDS = 500_000
+
+def normalize_barcode(barcode: str) -> str:
+    """
+    Keeps the digits only and expands 12-digit UPC-A codes to their EAN-13 form.
+    """
+    digits = re.sub(r"\D", "", barcode or "")
+    return "0" + digits if len(digits) == 12 else digits
+
+def encode_key(code: str) -> Optional[int]:
+    """
+    Index key for a (normalized) barcode, or None if it cannot be indexed.
+    """
+    if not code or not code.isdigit() or len(code) > MAX_CODE_DIGITS:
+        return None
+    return (len(code) << 58) | int(code)
+
+def decode_key(key: int) -> str:
+    """
+    The barcode an index key was made from.
+    """
+    return str(key & ((1 << 58) - 1)).zfill(key >> 58)
+
+def _name_bytes(name: str) -> bytes:
+    raw = (name or "Unknown").encode("utf-8")[:NAME_BYTES]
+    # Do not cut a multi-byte character in half
+    return raw.decode("utf-8", "ignore").encode("utf-8")
+
+def _number(value) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+class OFFIndex:
+    """
+    Read-only view of an index file through mmap: lookups are a binary search over the
+    sorted fixed-width records, touching only a few pages.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.count, self.built_at = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} barcode index")
+        self.mtime = os.fstat(self._file.fileno()).st_mtime
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _key_at(self, i: int) -> int:
+        return struct.unpack_from("<Q", self._map, HEADER.size + i * RECORD.size)[0]
+
+    def lookup(self, code: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the product in off_service's format, or None if the barcode is not indexed.
+        """
+        key = encode_key(code)
+        if key is None:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self._key_at(low) != key:
+            return None
+        _, kcal, protein, carbs, fat, name = RECORD.unpack_from(self._map, HEADER.size + low * RECORD.size)
+        return {
+            "name": name.rstrip(b"\0").decode("utf-8", "ignore"),
+            "calories": round(kcal, 1),
+            "protein": round(protein, 2),
+            "carbs": round(carbs, 2),
+            "fats": round(fat, 2),
+            "unit": "100g"
+        }
+
+    def records(self) -> Iterator[Tuple]:
+        """
+        All records in key order (used when merging a delta).
+        """
+        for i in range(self.count):
+            yield RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size)
+
+_index: Optional[OFFIndex] = None
+_checked_at = 0.0
+
+def get_off_index(path: str = OFF_INDEX_PATH, recheck_seconds: float = 60) -> Optional[OFFIndex]:
+    """
+    The shared index, or None when no index file exists. A file replaced by a
+    (delta) import is picked up within `recheck_seconds`.
+    """
+    global _index, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < recheck_seconds and (_index is None or _index.path == path):
+        return _index
+    _checked_at = now
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return _index if _index is not None and _index.path == path else None
+    if _index is None or _index.path != path or _index.mtime != mtime:
+        try:
+            fresh = OFFIndex(path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cannot open barcode index {path}: {e}")
+            return _index
+        old, _index = _index, fresh
+        if old is not None:
+            old.close()
+        logging.info(f"Barcode index loaded: {len(fresh)} products from {path}")
+    return _index
+
+# --- Import ---
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+def _from_jsonl(lines: Iterable[str]) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+    for line in lines:
+        try:
+            product = _loads(line)
+        except ValueError:
+            continue
+        yield str(product.get("code") or ""), product.get("product_name") or "", product.get("nutriments") or {}
+
+def _from_csv(lines: Iterable[str]) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+    # The OFF CSV export is tab-separated with one column per nutriment
+    csv.field_size_limit(sys.maxsize)
+    reader = csv.reader(lines, delimiter="\t", quoting=csv.QUOTE_NONE)
+    header = next(reader, [])
+    columns = {name: i for i, name in enumerate(header)}
+    wanted = ("energy-kcal_100g", "proteins_100g", "carbohydrates_100g", "fat_100g")
+    code_at, name_at = columns.get("code"), columns.get("product_name")
+    if code_at is None:
+        raise ValueError("CSV export without a 'code' column")
+    for row in reader:
+        if len(row) < len(header):
+            continue
+        nutriments = {field: row[columns[field]] for field in wanted if field in columns and row[columns[field]]}
+        yield row[code_at], row[name_at] if name_at is not None else "", nutriments
+
+def read_products(path: str) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Streams (code, name, nutriments) from an OFF JSONL or CSV export, optionally gzipped.
+    """
+    with _open_text(path) as lines:
+        if ".csv" in os.path.basename(path):
+            yield from _from_csv(lines)
+        else:
+            yield from _from_jsonl(lines)
+
+def _to_record(code: str, name: str, nutriments: Dict[str, Any]) -> Optional[Tuple]:
+    """
+    The index record for a product; kcal is NaN when the product has no usable energy value
+    (in a delta that removes the barcode from the index).
+    """
+    key = encode_key(normalize_barcode(code))
+    if key is None:
+        return None
+    kcal = _number(nutriments.get("energy-kcal_100g"))
+    protein, carbs, fat = (_number(nutriments.get(field)) for field in ("proteins_100g", "carbohydrates_100g", "fat_100g"))
+    return (key, kcal, 0.0 if math.isnan(protein) else protein, 0.0 if math.isnan(carbs) else carbs,
+            0.0 if math.isnan(fat) else fat, _name_bytes(name))
+
+def _write_run(records: Dict[int, Tuple], directory: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="run-", suffix=".bin", dir=directory)
+    with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+        for key in sorted(records):
+            f.write(RECORD.pack(*records[key]))
+    return path
+
+def _read_run(path: str) -> Iterator[Tuple]:
+    with open(path, "rb", buffering=1 << 20) as f:
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                return
+            yield from RECORD.iter_unpack(chunk)
+
+def _merge(sources: List[Iterator[Tuple]]) -> Iterator[Tuple]:
+    """
+    Merges sorted record streams; for a key present in several, the latest source wins.
+    Records with a NaN kcal (deletions) are dropped.
+    """
+    def tag(order: int, source: Iterator[Tuple]):
+        for record in source:
+            yield record[0], order, record
+
+    pending = None
+    for key, _, record in heapq.merge(*(tag(order, source) for order, source in enumerate(sources))):
+        if pending is not None and pending[0] != key and not math.isnan(pending[1]):
+            yield pending
+        pending = record
+    if pending is not None and not math.isnan(pending[1]):
+        yield pending
+
+def build_index(dump_path: str, index_path: str = OFF_INDEX_PATH, delta: bool = False,
+                run_records: int = RUN_RECORDS) -> dict:
+    """
+    Streams an OFF export into sorted runs of at most `run_records` products, then merges
+    them (after the existing index when `delta` is set) into a new index file that atomically
+    replaces `index_path`. Memory stays bounded by the run size whatever the dump size.
+    """
+    directory = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(directory, exist_ok=True)
+    stats = {"read": 0, "skipped": 0, "runs": 0, "written": 0}
+    runs, current = [], {}
+    base, tmp_path = None, None
+    start = time.perf_counter()
+    try:
+        for code, name, nutriments in read_products(dump_path):
+            stats["read"] += 1
+            record = _to_record(code, name, nutriments)
+            # A full import skips products without energy; a delta keeps them as deletions
+            if record is None or (not delta and math.isnan(record[1])):
+                stats["skipped"] += 1
+                continue
+            current[record[0]] = record
+            if len(current) >= run_records:
+                runs.append(_write_run(current, directory))
+                current = {}
+        if current:
+            runs.append(_write_run(current, directory))
+        current = {}
+        stats["runs"] = len(runs)
+
+        sources = [_read_run(path) for path in runs]
+        if delta and os.path.exists(index_path):
+            base = OFFIndex(index_path)
+            sources.insert(0, base.records())
+
+        fd, tmp_path = tempfile.mkstemp(prefix="index-", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "wb", buffering=1 << 20) as out:
+            out.write(b"\0" * HEADER.size)
+            for record in _merge(sources):
+                out.write(RECORD.pack(*record))
+                stats["written"] += 1
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, RECORD.size, stats["written"], time.time()))
+        if base is not None:
+            base.close()
+            base = None
+        os.replace(tmp_path, index_path)
+        tmp_path = None
+    finally:
+        # A failed or interrupted build leaves neither runs nor a half-written index behind
+        if base is not None:
+            base.close()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+if __name__ == "__main__":
+    # Admin entry point:
+    #   python -m src.services.off_index import openfoodfacts-products.jsonl.gz   (or the .csv export)
+    #   python -m src.services.off_index import delta.jsonl.gz --delta
+    #   python -m src.services.off_index lookup 3017620422003
+    #   python -m src.services.off_index bench [products]      (synthetic dump, throughput and latency)
+    import argparse
+    import random
+    import resource
+
+    parser = argparse.ArgumentParser(description="Offline Open Food Facts barcode index")
+    parser.add_argument("command", choices=["import", "lookup", "bench"])
+    parser.add_argument("arg", nargs="?")
+    parser.add_argument("--delta", action="store_true", help="merge into the existing index instead of replacing it")
+    parser.add_argument("--index", default=OFF_INDEX_PATH)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        stats = build_index(args.arg, args.index, delta=args.delta)
+        print(f"{stats['read']} products read, {stats['skipped']} skipped, {stats['runs']} sorted runs, "
+              f"{stats['written']} in the index ({stats['read'] / stats['seconds']:.0f} products/s)")
+    elif args.command == "lookup":
+        index = get_off_index(args.index)
+        print(index.lookup(args.arg) if index else f"No index at {args.index}")
+    else:
+        products = int(args.arg or 2_000_000)
+        workdir = tempfile.mkdtemp()
+        dump, delta_dump, index_path = (os.path.join(workdir, name) for name in ("dump.jsonl.gz", "delta.jsonl.gz", "index.bin"))
+        rng = random.Random(0)
+        codes = [f"{rng.randrange(10 ** 12, 10 ** 13):013d}" for _ in range(products)]
+
+        def product_line(code: str, kcal: float) -> str:
+            # A trimmed but realistic product line (real ones are far larger, which only slows parsing)
+            return json.dumps({
+                "code": code, "product_name": f"Synthetic product {code}", "brands": "Brand",
+                "categories_tags": ["en:snacks", "en:sweet-snacks"], "image_url": f"https://images.example/{code}.jpg",
+                "nutriments": {"energy-kcal_100g": kcal, "energy_100g": kcal * 4.184, "proteins_100g": 7.5,
+                               "carbohydrates_100g": 55.1, "sugars_100g": 20.2, "fat_100g": 21.0, "salt_100g": 0.4}
+            }) + "\n"
+
+        start = time.perf_counter()
+        with gzip.open(dump, "wt", compresslevel=1) as f:
+            for i, code in enumerate(codes):
+                f.write(product_line(code, 100 + i % 400))
+        print(f"generated {products} products ({os.path.getsize(dump) / 2 ** 20:.0f} MiB gzipped) "
+              f"in {time.perf_counter() - start:.0f} s")
+
+        stats = build_index(dump, index_path)
+        print(f"full import: {stats['read'] / stats['seconds']:.0f} products/s ({stats['seconds']:.1f} s, "
+              f"{stats['runs']} runs), index {os.path.getsize(index_path) / 2 ** 20:.0f} MiB, "
+              f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+        # Delta: 1% changed, 0.1% removed (no energy value any more), 1% new
+        changed = rng.sample(codes, products // 100)
+        removed = rng.sample(codes, products // 1000)
+        added = [f"{rng.randrange(10 ** 12, 10 ** 13):013d}" for _ in range(products // 100)]
+        with gzip.open(delta_dump, "wt", compresslevel=1) as f:
+            for code in changed + added:
+                f.write(product_line(code, 999))
+            for code in removed:
+                f.write(json.dumps({"code": code, "product_name": "Removed", "nutriments": {}}) + "\n")
+        stats = build_index(delta_dump, index_path, delta=True)
+        print(f"delta import: {stats['read']} changes merged in {stats['seconds']:.1f} s, {stats['written']} products")
+
+        index = OFFIndex(index_path)
+        assert index.lookup(added[0])["calories"] == 999
+        assert index.lookup(changed[0])["calories"] == 999
+        assert removed[0] in changed or index.lookup(removed[0]) is None
+
+        probes = [rng.choice(codes) for _ in range(100_000)]
+        timings = []
+        for code in probes:
+            t = time.perf_counter()
+            index.lookup(code)
+            timings.append(time.perf_counter() - t)
+        timings.sort()
+        misses = sum(index.lookup(f"{rng.randrange(10 ** 12, 10 ** 13):013d}") is None for _ in range(10_000))
+        print(f"lookup over {len(index)} products: p50 {timings[len(timings) // 2] * 1e6:.1f} us, "
+              f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.1f} us; {misses}/10000 random codes not found")
@@ -1,54 +1,231 @@
+import asyncio
+import json
+import logging
 import aiohttp
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+from src.config import OFF_MAX_CONNECTIONS, OFF_TIMEOUT_SECONDS
+from src.database.async_db import upsert_products
+from src.services.single_flight import SingleFlight
+from src.services.product_cache import product_cache
+from src.services.off_index import get_off_index, normalize_barcode
 
-async def search_product(query: str) -> Optional[Dict[str, Any]]:
+# Optional faster JSON decoding
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+OFF_URL = "https://world.openfoodfacts.org"
+# Only what we read; a full product also carries every image URL, ingredient and tag
+PRODUCT_FIELDS = "product_name,nutriments"
+USER_AGENT = "AINutritionBot/1.0 (Telegram bot)" # OFF asks API clients to identify themselves
+
+# The same barcode scanned from the webapp and a photo at once only hits OFF once
+barcode_flight = SingleFlight("get_product_by_barcode")
+
+# One session for the bot's lifetime: pooled keep-alive connections and a DNS cache
+_session: Optional[aiohttp.ClientSession] = None
+
+async def init_session() -> aiohttp.ClientSession:
+    """
+    Creates the shared Open Food Facts session (called once at startup).
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=OFF_MAX_CONNECTIONS, ttl_dns_cache=300, keepalive_timeout=30)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=OFF_TIMEOUT_SECONDS, connect=min(3.0, OFF_TIMEOUT_SECONDS)),
+            headers={"User-Agent": USER_AGENT}
+        )
+    return _session
+
+async def close_session():
+    """
+    Closes the shared session (called on shutdown).
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+class OFFError(Exception):
+    """
+    Open Food Facts could not be reached or answered with an error (as opposed to "not found").
+    """
+
+async def _get_json(url: str, params: dict) -> Dict[str, Any]:
+    # Created on first use when nothing called init_session (scripts)
+    session = await init_session()
+    try:
+        async with session.get(url, params=params) as response:
+            if response.status == 404:
+                return {}
+            if response.status != 200:
+                raise OFFError(f"HTTP {response.status}")
+            return _loads(await response.read())
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise OFFError(repr(e)) from e
+
+def _to_product(product: Dict[str, Any]) -> Dict[str, Any]:
+    nutriments = product.get("nutriments") or {}
+    return {
+        "name": product.get("product_name", "Unknown"),
+        "calories": nutriments.get("energy-kcal_100g", 0),
+        "protein": nutriments.get("proteins_100g", 0),
+        "carbs": nutriments.get("carbohydrates_100g", 0),
+        "fats": nutriments.get("fat_100g", 0),
+        "unit": "100g"
+    }
+
+async def _remember_products(products: List[Dict[str, Any]]):
+    """
+    Makes fetched products findable by name in the local search index (see product_search).
+    """
+    rows = [(p["barcode"], p["name"], p["calories"], p["protein"], p["carbs"], p["fats"])
+            for p in products if p.get("barcode") and p["name"] not in ("", "Unknown")]
+    if not rows:
+        return
+    try:
+        await upsert_products(rows)
+    except Exception as e:
+        # Search indexing must never break a lookup
+        logging.error(f"Product search indexing failed: {e}")
+
+async def search_products(query: str, page_size: int = 10) -> List[Dict[str, Any]]:
     """
-    Searches Open Food Facts for a product by name.
+    Searches Open Food Facts by name; each product carries its "barcode".
+    Results are added to the local search index. Returns [] when OFF cannot be reached.
     """
-    url = "https://world.openfoodfacts.org/cgi/search.pl"
     params = {
         "search_terms": query,
         "search_simple": 1,
         "action": "process",
         "json": 1,
-        "page_size": 1
+        "page_size": page_size,
+        "fields": "code," + PRODUCT_FIELDS
     }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            if response.status == 200:
-                data = await response.json()
-                products = data.get("products", [])
-                if products:
-                    product = products[0]
-                    return {
-                        "name": product.get("product_name", "Unknown"),
-                        "calories": product.get("nutriments", {}).get("energy-kcal_100g", 0),
-                        "protein": product.get("nutriments", {}).get("proteins_100g", 0),
-                        "carbs": product.get("nutriments", {}).get("carbohydrates_100g", 0),
-                        "fats": product.get("nutriments", {}).get("fat_100g", 0),
-                        "unit": "100g"
-                    }
-    return None
+    try:
+        data = await _get_json(f"{OFF_URL}/cgi/search.pl", params)
+    except OFFError as e:
+        logging.warning(f"Open Food Facts search failed: {e}")
+        return []
+    products = [dict(_to_product(p), barcode=normalize_barcode(str(p.get("code") or ""))) for p in data.get("products", [])]
+    await _remember_products(products)
+    return products
 
 async def get_product_by_barcode(barcode: str) -> Optional[Dict[str, Any]]:
     """
     Fetches product details using a barcode.
+    The offline index (if one was imported) answers first, then the product cache;
+    concurrent lookups of the same code share one request.
+    """
+    code = normalize_barcode(barcode) or barcode
+    index = get_off_index()
+    if index is not None:
+        product = index.lookup(code)
+        if product is not None:
+            return product
+    return await product_cache.get(code, lambda: barcode_flight.do(code, lambda: _fetch_product(code)))
+
+async def _fetch_product(barcode: str) -> Optional[Dict[str, Any]]:
     """
-    url = f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json"
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
+    Returns the product, None if OFF does not know the barcode, or raises OFFError.
+    """
+    data = await _get_json(f"{OFF_URL}/api/v2/product/{barcode}", {"fields": PRODUCT_FIELDS})
+    if data.get("status") != 1:
+        return None
+    product = _to_product(data.get("product") or {})
+    await _remember_products([dict(product, barcode=barcode)])
+    return product
+
+if __name__ == "__main__":
+    # Per-lookup latency and bytes, old client (new session, full product, stdlib json) vs the
+    # shared session with field projection, against a local stand-in for the OFF API:
+    #   python -m src.services.off_service [lookups] [concurrency]
+    import random
+    import sys
+    import time
+    from aiohttp import web
+
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    def full_product(code: str) -> dict:
+        # Roughly the shape and size of a real OFF product: images, ingredients, tags, per-serving values
+        rng = random.Random(code)
+        nutriments = {f"{n}{suffix}": round(rng.uniform(0, 60), 2) for n in (
+            "energy-kcal", "energy", "fat", "saturated-fat", "carbohydrates", "sugars", "fiber", "proteins", "salt",
+            "sodium", "calcium", "iron", "vitamin-c", "potassium", "cholesterol", "trans-fat", "nova-group"
+        ) for suffix in ("", "_100g", "_serving", "_value", "_unit")}
+        images = {f"{kind}_{lang}": {"rev": str(rng.randint(1, 40)), "sizes": {s: {"h": 400, "w": 300} for s in ("100", "200", "400", "full")},
+                                     "url": f"https://images.openfoodfacts.org/images/products/{code}/{kind}_{lang}.{rng.randint(1, 40)}.400.jpg"}
+                  for kind in ("front", "ingredients", "nutrition", "packaging") for lang in ("en", "fr", "de", "es")}
+        ingredients = [{"id": f"en:ingredient-{i}", "text": f"ingredient {i}", "percent_estimate": rng.uniform(0, 30),
+                        "vegan": "maybe", "vegetarian": "yes"} for i in range(40)]
+        return {
+            "code": code, "product_name": f"Product {code}", "nutriments": nutriments, "images": images,
+            "selected_images": images, "ingredients": ingredients, "ingredients_text": ", ".join(i["text"] for i in ingredients),
+            "categories_tags": [f"en:category-{i}" for i in range(30)], "labels_tags": [f"en:label-{i}" for i in range(15)],
+            "nutrient_levels": {"fat": "high", "salt": "low"}, "states_tags": [f"en:state-{i}" for i in range(20)]
+        }
+
+    served = {"bytes": 0, "connections": set()}
+
+    async def product_handler(request):
+        code = request.match_info["code"].removesuffix(".json")
+        product = full_product(code)
+        fields = request.query.get("fields")
+        if fields:
+            product = {k: v for k, v in product.items() if k in fields.split(",")}
+        body = json.dumps({"code": code, "status": 1, "product": product}).encode("utf-8")
+        served["bytes"] += len(body)
+        served["connections"].add(request.transport.get_extra_info("peername"))
+        return web.Response(body=body, content_type="application/json")
+
+    async def old_fetch(base: str, code: str):
+        # The previous implementation: a new session per call, full product, stdlib json
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base}/api/v0/product/{code}.json") as response:
                 data = await response.json()
-                if data.get("status") == 1:
-                    product = data.get("product", {})
-                    return {
-                        "name": product.get("product_name", "Unknown"),
-                        "calories": product.get("nutriments", {}).get("energy-kcal_100g", 0),
-                        "protein": product.get("nutriments", {}).get("proteins_100g", 0),
-                        "carbs": product.get("nutriments", {}).get("carbohydrates_100g", 0),
-                        "fats": product.get("nutriments", {}).get("fat_100g", 0),
-                        "unit": "100g"
-                    }
-    return None
+                return _to_product(data["product"])
+
+    async def new_fetch(base: str, code: str):
+        data = await _get_json(f"{base}/api/v2/product/{code}", {"fields": PRODUCT_FIELDS})
+        return _to_product(data["product"])
+
+    async def measure():
+        app = web.Application()
+        app.router.add_get("/api/v0/product/{code}", product_handler)
+        app.router.add_get("/api/v2/product/{code}", product_handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 8765).start()
+        base = "http://127.0.0.1:8765"
+        codes = [f"{3000000000000 + i}" for i in range(lookups)]
+        limit = asyncio.Semaphore(concurrency)
+
+        for name, fetch in (("old", old_fetch), ("shared", new_fetch)):
+            served["bytes"], served["connections"] = 0, set()
+            timings = []
+
+            async def one(code):
+                async with limit:
+                    start = time.perf_counter()
+                    product = await fetch(base, code)
+                    timings.append(time.perf_counter() - start)
+                    assert product["name"] == f"Product {code}"
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(code) for code in codes))
+            elapsed = time.perf_counter() - start
+            timings.sort()
+            print(f"{name:>6}: p50 {timings[len(timings) // 2] * 1000:.2f} ms, p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms, "
+                  f"{served['bytes'] / lookups / 1024:.1f} KiB/lookup, {len(served['connections'])} TCP connections, "
+                  f"{lookups / elapsed:.0f} lookups/s")
+
+        await close_session()
+        await runner.cleanup()
+
+    asyncio.run(measure())
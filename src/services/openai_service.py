@@ -1,23 +1,194 @@
 from openai import AsyncOpenAI
+import asyncio
 import json
 import base64
-from src.config import OPENAI_API_KEY
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Literal, Optional
+from pydantic import BaseModel, ConfigDict
+from src.config import OPENAI_API_KEY, OPENAI_MODEL, OPENAI_FAST_MODEL, OPENAI_TIMEOUT_SECONDS, LOCAL_FOOD_RESOLVER, INTENT_ROUTER, IMAGE_CACHE_MAX_DISTANCE, IMAGE_CACHE_MAX_COLOR_DISTANCE, IMAGE_CACHE_TTL_DAYS, IMAGE_CACHE_PER_USER
+from src.database.async_db import find_similar_image, put_image_analysis
+from src.services.image_service import compute_signature, prepare_for_vision
+from src.services.response_cache import response_cache, make_cache_key
+from src.services.single_flight import SingleFlight
+from src.services.food_resolver import resolve_text_log
+from src.services.intent_router import classify, tier_for, tier_stats
+from src.services.llm_scheduler import llm_scheduler, estimate_tokens, is_retryable, IMAGE_TOKENS
+from src.services.metrics_service import llm_metrics
+from src.utils.json_stream import JSONStreamParser
 
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Retries are owned by llm_scheduler, so the client itself must not retry
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=OPENAI_TIMEOUT_SECONDS)
 
-async def analyze_food_image(image_path: str, caption: str = ""):
+MODEL = OPENAI_MODEL
+
+# Text messages are routed to a tier by intent_router; "local" tiers never reach this table
+MODEL_TIERS = {"fast": OPENAI_FAST_MODEL, "full": MODEL}
+
+BUSY_REPLY = "I'm getting a lot of requests right now. Please send that again in a minute."
+
+# Streaming callback: awaited with (reply_so_far, completed_log_items) as the answer arrives
+ProgressCallback = Callable[[str, list], Awaitable[Any]]
+
+# --- Response schemas (sent as strict JSON schemas, so the model cannot return malformed JSON).
+# "reply" comes first so it is the first thing streamed.
+
+class FoodItem(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    item: str
+    calories: int
+    protein: float
+    carbs: float
+    fats: float
+    weight_g: Optional[float]
+    micronutrients: str
+    health_score: int
+    meal_period: Literal["Breakfast", "Lunch", "Dinner", "Snack"]
+
+class PhotoAnalysis(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    reply: str
+    log_data: list[FoodItem]
+
+class TextAnalysis(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    reply: str
+    is_food_log: bool
+    log_data: list[FoodItem]
+
+class DailyGoals(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    calories: int
+    protein: int
+    carbs: int
+    fats: int
+    explanation: str
+
+class RefusalError(Exception):
+    """
+    The model declined to answer; the message is its explanation.
+    """
+
+def _response_format(schema: type[BaseModel]) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "strict": True, "schema": schema.model_json_schema()}
+    }
+
+def _log_items(analysis) -> list:
+    return [item.model_dump() for item in analysis.log_data]
+
+@dataclass
+class _StreamedCompletion:
+    content: str
+    usage: Any # read by llm_scheduler to settle the token budget
+
+async def _stream_completion(params: dict, on_progress: ProgressCallback) -> _StreamedCompletion:
+    stream = await client.chat.completions.create(**params, stream=True, stream_options={"include_usage": True})
+    parser = JSONStreamParser()
+    refusal = ""
+    usage = None
+    shown = ("", 0)
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if getattr(delta, "refusal", None):
+            refusal += delta.refusal
+        if delta.content:
+            parser.feed(delta.content)
+            if (parser.reply, len(parser.items)) != shown:
+                shown = (parser.reply, len(parser.items))
+                await on_progress(parser.reply, parser.items)
+    if refusal:
+        raise RefusalError(refusal)
+    return _StreamedCompletion(parser.text, usage)
+
+async def _complete(schema: type[BaseModel], messages: list, tokens: int,
+                    on_progress: Optional[ProgressCallback] = None, *, endpoint: str,
+                    user_id: Optional[int] = None, image_bytes: int = 0, **params):
+    """
+    Runs one schema-constrained completion through the scheduler and returns the parsed `schema` instance.
+    `params` go to the API as-is (`model` defaults to MODEL). With `on_progress` the answer is streamed and the callback sees the reply (and finished items) as they arrive.
+    Every call is metered (tokens, cost, latency, retries, outcome) under `endpoint` and `user_id`.
+    """
+    params = dict(params, messages=messages, response_format=_response_format(schema))
+    params.setdefault("model", MODEL)
+    with llm_metrics.meter(endpoint, params["model"], user_id, image_bytes) as call:
+        def attempt():
+            call.attempts += 1
+            if on_progress is not None:
+                return _stream_completion(params, on_progress)
+            return client.chat.completions.create(**params)
+
+        try:
+            result = await llm_scheduler.submit(attempt, tokens=tokens)
+        except RefusalError:
+            call.outcome = "refusal"
+            raise
+        call.add_usage(result.usage)
+        if on_progress is not None:
+            return schema.model_validate_json(result.content)
+
+        message = result.choices[0].message
+        if getattr(message, "refusal", None):
+            call.outcome = "refusal"
+            raise RefusalError(message.refusal)
+        return schema.model_validate_json(message.content)
+
+def _prepare_image(image_path: str) -> tuple:
+    """
+    Resized JPEG bytes and detail level for one photo; falls back to the original file if that fails.
+    """
+    try:
+        return prepare_for_vision(image_path)
+    except Exception as e:
+        print(f"Error preparing image: {e}")
+        with open(image_path, "rb") as image_file:
+            return image_file.read(), "auto"
+
+async def analyze_food_image(image_paths, caption: str = "", user_id: int = None,
+                             on_progress: Optional[ProgressCallback] = None):
     """
     Analyzes a food image using GPT-4o to identify items, estimate weight, and calculate macros.
+    `image_paths` is one path, or several photos of the same meal (a Telegram album), which are
+    sent together in a single request and analyzed as one meal.
+    If `user_id` is given, near-duplicates of that user's recent photos reuse the stored analysis
+    (single photos only).
+    If `on_progress` is given, the reply is streamed to it while the model is still answering.
     Returns a tuple: (structured_data, conversational_reply)
     """
-    
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+    loop = asyncio.get_running_loop()
 
-    base64_image = encode_image(image_path)
-    print(f"DEBUG: Sending image to OpenAI. Size: {len(base64_image)} bytes")
+    # Same (or nearly the same) photo as before? Answer from the perceptual-hash cache.
+    image_hash = image_colors = None
+    caption_key = caption.strip().lower()
+    if user_id is not None and len(image_paths) == 1:
+        try:
+            image_hash, image_colors = await loop.run_in_executor(None, compute_signature, image_paths[0])
+            cached = await find_similar_image(
+                user_id, image_hash, image_colors, caption_key, IMAGE_CACHE_MAX_DISTANCE,
+                IMAGE_CACHE_MAX_COLOR_DISTANCE, IMAGE_CACHE_TTL_DAYS * 86400, IMAGE_CACHE_PER_USER
+            )
+            if cached:
+                return json.loads(cached[0]), cached[1]
+        except Exception as e:
+            print(f"Error checking image cache: {e}")
+    
+    # Resize/recompress off the event loop, all photos at once
+    images = await asyncio.gather(*(loop.run_in_executor(None, _prepare_image, path) for path in image_paths))
 
+    album_note = ""
+    if len(images) > 1:
+        album_note = f"""
+    The {len(images)} images are ONE meal: the same plate from different angles, or several courses eaten together.
+    Count each food item only once, even if it appears in several images.
+    """
 
     prompt = f"""
     You are an expert AI Nutritionist. 
@@ -28,75 +199,66 @@ async def analyze_food_image(image_path: str, caption: str = ""):
     5. Give a health score from 1-10 based on nutritional value (10 is healthiest).
     6. Classify the meal period as one of: "Breakfast", "Lunch", "Dinner", "Snack".
     7. If the user provided a caption: "{caption}", use it to refine your analysis.
-    
+    {album_note}
     IMPORTANT: 
     - Analyze the ACTUAL image provided. Do NOT return example data.
     - If the image is not food, return an empty list for "log_data" and explain why in "reply".
     - Keep the "reply" SHORT and CONCISE (max 2 sentences). Do not list all macros in the reply, just a friendly summary.
     
-    Output Format:
-    Return a JSON object with two keys:
-    - "log_data": A list of objects, each containing: 
-        - "item" (name)
-        - "calories" (int)
-        - "protein" (float)
-        - "carbs" (float)
-        - "fats" (float)
-        - "weight_g" (estimated grams)
-        - "micronutrients" (string, e.g. "High in Vit C, Iron")
-        - "health_score" (int, 1-10)
-        - "meal_period" (string: "Breakfast", "Lunch", "Dinner", "Snack")
+    Fields:
     - "reply": A friendly, conversational message to the user in their language (detect from caption or default to English). Explain what you see, how you estimated the weight, and the total nutrition.
-    
-    Example JSON structure (DO NOT COPY VALUES):
-    {{
-        "log_data": [
-            {{"item": "Detected Food Name", "calories": 0, "protein": 0, "carbs": 0, "fats": 0, "weight_g": 0, "micronutrients": "...", "health_score": 5, "meal_period": "Lunch"}}
-        ],
-        "reply": "I see [Food Name]..."
-    }}
+    - "log_data": one entry per food item with "item" (name), "calories", "protein", "carbs", "fats",
+      "weight_g" (estimated grams), "micronutrients" (short string, e.g. "High in Vit C, Iron"),
+      "health_score" (1-10) and "meal_period".
     """
 
+    content = [{"type": "text", "text": prompt}]
+    for image_bytes, detail in images:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode('utf-8')}",
+                "detail": detail
+            },
+        })
+    image_tokens = sum(IMAGE_TOKENS.get(detail, IMAGE_TOKENS["high"]) for _, detail in images)
+
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=500
+        analysis = await _complete(
+            PhotoAnalysis,
+            [{"role": "user", "content": content}],
+            estimate_tokens(prompt, completion=500 + 150 * (len(images) - 1), image_tokens=image_tokens),
+            on_progress,
+            endpoint="analyze_food_image",
+            user_id=user_id,
+            image_bytes=sum(len(image_bytes) for image_bytes, _ in images),
+            max_tokens=500 + 150 * (len(images) - 1)
         )
+        log_data, reply = _log_items(analysis), analysis.reply or "I processed your image."
         
-        content = response.choices[0].message.content.strip()
-        # Clean up markdown
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-            
-        data = json.loads(content)
-        return data.get("log_data", []), data.get("reply", "I processed your image.")
-        
+    except RefusalError as e:
+        return [], str(e)
     except Exception as e:
         print(f"Error analyzing image: {e}")
+        if is_retryable(e):
+            return [], BUSY_REPLY
         return [], "Sorry, I had trouble analyzing that photo."
 
-async def process_user_message(text: str):
-    """
-    Handles text input. Decides if it's a food log or general conversation.
-    Returns: (structured_data, conversational_reply)
-    """
-    prompt = f"""
+    # Remember successful food analyses for near-duplicate photos
+    if image_hash is not None and log_data:
+        try:
+            await put_image_analysis(
+                user_id, image_hash, image_colors, caption_key, json.dumps(log_data), reply,
+                IMAGE_CACHE_PER_USER, IMAGE_CACHE_TTL_DAYS * 86400
+            )
+        except Exception as e:
+            print(f"Error storing image analysis: {e}")
+    return log_data, reply
+
+# Text-message prompt. Its hash (with the response schema) is part of the response cache key,
+# so editing either automatically invalidates previously cached answers.
+TEXT_SYSTEM_PROMPT = "You are a helpful nutrition assistant."
+TEXT_PROMPT = """
     You are a friendly AI Nutrition Assistant. The user sent: "{text}".
     
     Task:
@@ -108,49 +270,86 @@ async def process_user_message(text: str):
     IMPORTANT:
     - Keep the "reply" SHORT and CONCISE (max 2 sentences).
     
-    Output JSON:
-    {{
-        "is_food_log": boolean,
-        "log_data": [ 
-            {{
-                "item": "Food Name",
-                "calories": 0,
-                "protein": 0,
-                "carbs": 0,
-                "fats": 0,
-                "micronutrients": "Vitamin A, C",
-                "health_score": 8,
-                "meal_period": "Dinner"
-            }}
-        ],
-        "reply": "Your conversational response here. Adapt to the user's language and tone."
-    }}
+    Fields:
+    - "reply": your conversational response. Adapt to the user's language and tone.
+    - "is_food_log": whether the message logs food.
+    - "log_data": one entry per food item (empty when chatting); "weight_g" is null unless the user gave it.
+    """
+TEXT_PROMPT_VERSION = hashlib.sha256(
+    (TEXT_SYSTEM_PROMPT + TEXT_PROMPT + json.dumps(TextAnalysis.model_json_schema(), sort_keys=True)).encode("utf-8")
+).hexdigest()[:12]
+
+# Identical messages arriving at the same time (group chats, double taps) share one LLM call
+text_flight = SingleFlight("process_user_message")
+
+async def process_user_message(text: str, on_progress: Optional[ProgressCallback] = None, user_id: int = None):
     """
+    Handles text input. Decides if it's a food log or general conversation.
+    Simple logs made only of known foods ("200g chicken breast, 1 apple") are answered locally,
+    menu requests get a pointer to the right button, chat goes to the fast model and
+    everything else to the full model.
+    Repeated messages are answered from the response cache; identical messages already
+    being answered wait for that answer instead of starting another call.
+    If `on_progress` is given, the reply is streamed to it while the model is still answering
+    (only for the caller that started the call). LLM usage is metered against `user_id`.
+    Returns: (structured_data, conversational_reply)
+    """
+    start = time.perf_counter()
+    if LOCAL_FOOD_RESOLVER:
+        local = resolve_text_log(text)
+        if local is not None:
+            tier_stats.record("local", time.perf_counter() - start)
+            return local
+
+    tier = "full"
+    if INTENT_ROUTER:
+        intent = classify(text)
+        tier = tier_for(intent)
+        if tier == "local":
+            tier_stats.record("local", time.perf_counter() - start)
+            return [], intent.reply
+
+    model = MODEL_TIERS[tier]
+    cache_key = make_cache_key(text, TEXT_PROMPT_VERSION, model)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached["log_data"], cached["reply"]
+    return await text_flight.do(cache_key, lambda: _answer_text(text, cache_key, tier, on_progress, user_id))
+
+async def _answer_text(text: str, cache_key: str, tier: str, on_progress: Optional[ProgressCallback], user_id: Optional[int]):
+    start = time.perf_counter()
+    prompt = TEXT_PROMPT.format(text=text)
 
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that outputs raw JSON."},
+        analysis = await _complete(
+            TextAnalysis,
+            [
+                {"role": "system", "content": TEXT_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
+            estimate_tokens(TEXT_SYSTEM_PROMPT, prompt),
+            on_progress,
+            endpoint="process_user_message",
+            user_id=user_id,
+            model=MODEL_TIERS[tier],
             temperature=0.3
         )
+        log_data, reply = _log_items(analysis), analysis.reply or "I didn't understand that."
+        tier_stats.record(tier, time.perf_counter() - start)
         
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-            
-        data = json.loads(content)
-        return data.get("log_data", []), data.get("reply", "I didn't understand that.")
-        
+    except RefusalError as e:
+        return [], str(e)
     except Exception as e:
         print(f"Error calling OpenAI: {e}")
+        if is_retryable(e):
+            return [], BUSY_REPLY
         return [], "Sorry, I encountered an error."
 
-async def calculate_daily_goals(age, gender, weight, height, activity):
+    # Only successful answers are cached
+    await response_cache.set(cache_key, {"log_data": log_data, "reply": reply})
+    return log_data, reply
+
+async def calculate_daily_goals(age, gender, weight, height, activity, user_id: int = None):
     """
     Calculates daily calorie and macro goals using GPT-4o.
     """
@@ -165,34 +364,97 @@ async def calculate_daily_goals(age, gender, weight, height, activity):
     
     Goal: Maintain weight / General Health.
     
-    Output JSON ONLY:
-    {{
-        "calories": 2000,
-        "protein": 150,
-        "carbs": 200,
-        "fats": 65,
-        "explanation": "Brief explanation of the calculation."
-    }}
+    Return the daily calories, protein/carbs/fats in grams, and a brief explanation of the calculation.
     """
     
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that outputs raw JSON."},
+        goals = await _complete(
+            DailyGoals,
+            [
+                {"role": "system", "content": "You are an expert nutritionist."},
                 {"role": "user", "content": prompt}
             ],
+            estimate_tokens(prompt),
+            endpoint="calculate_daily_goals",
+            user_id=user_id,
             temperature=0.3
         )
-        
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-            
-        return json.loads(content)
+        return goals.model_dump()
     except Exception as e:
         print(f"Error calculating goals: {e}")
         return {"calories": 2000, "protein": 150, "carbs": 200, "fats": 65, "explanation": "Default values due to error."}
 
+
+if __name__ == "__main__":
+    # Time to first visible text, blocking vs streaming, against a local stub of the chat API:
+    #   python -m src.services.openai_service [runs] [first-token-ms] [ms-per-chunk]
+    import sys
+    import time
+    from types import SimpleNamespace
+
+    SAMPLE = TextAnalysis(
+        reply="Nice breakfast! Two eggs on toast with a latte is about 520 kcal with a good dose of protein.",
+        is_food_log=True,
+        log_data=[
+            FoodItem(item="Fried eggs", calories=180, protein=12, carbs=1, fats=14, weight_g=100,
+                     micronutrients="B12, Selenium", health_score=7, meal_period="Breakfast"),
+            FoodItem(item="Toast", calories=160, protein=5, carbs=30, fats=2, weight_g=60,
+                     micronutrients="Iron", health_score=5, meal_period="Breakfast"),
+            FoodItem(item="Latte", calories=180, protein=9, carbs=14, fats=9, weight_g=300,
+                     micronutrients="Calcium", health_score=5, meal_period="Breakfast")
+        ]
+    ).model_dump_json()
+
+    class StubCompletions:
+        def __init__(self, first_token: float, per_chunk: float):
+            self.first_token = first_token
+            self.per_chunk = per_chunk
+
+        def _chunks(self):
+            # ~4 characters per token, one token per chunk
+            return [SAMPLE[i:i + 4] for i in range(0, len(SAMPLE), 4)]
+
+        async def create(self, stream: bool = False, **params):
+            usage = SimpleNamespace(total_tokens=len(self._chunks()) + 200)
+            if not stream:
+                await asyncio.sleep(self.first_token + self.per_chunk * len(self._chunks()))
+                message = SimpleNamespace(content=SAMPLE, refusal=None)
+                return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+            async def events():
+                await asyncio.sleep(self.first_token)
+                for text in self._chunks():
+                    await asyncio.sleep(self.per_chunk)
+                    delta = SimpleNamespace(content=text, refusal=None)
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+                yield SimpleNamespace(choices=[], usage=usage)
+            return events()
+
+    async def measure(runs: int, first_token: float, per_chunk: float):
+        global client
+        client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions(first_token, per_chunk)))
+        messages = [{"role": "user", "content": "2 eggs, toast and a latte"}]
+
+        for name, streamed in (("blocking", False), ("streaming", True)):
+            first_text, total = [], []
+            for _ in range(runs):
+                start = time.perf_counter()
+                seen = []
+
+                async def on_progress(reply, items):
+                    if not seen:
+                        seen.append(time.perf_counter() - start)
+
+                analysis = await _complete(TextAnalysis, messages, 800, on_progress if streamed else None, endpoint="benchmark")
+                total.append(time.perf_counter() - start)
+                first_text.append(seen[0] if seen else total[-1])
+                assert len(analysis.log_data) == 3
+            print(f"{name:>9}: first text {sorted(first_text)[runs // 2] * 1000:.0f} ms, "
+                  f"complete {sorted(total)[runs // 2] * 1000:.0f} ms (median of {runs})")
+
+    args = sys.argv[1:]
+    asyncio.run(measure(
+        int(args[0]) if len(args) > 0 else 5,
+        (float(args[1]) if len(args) > 1 else 400) / 1000,
+        (float(args[2]) if len(args) > 2 else 15) / 1000
+    ))
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from src.config import PRODUCT_CACHE_TTL_DAYS, PRODUCT_CACHE_STALE_DAYS, PRODUCT_CACHE_NEGATIVE_TTL_HOURS, PRODUCT_CACHE_MEMORY_ENTRIES
+from src.database.async_db import get_cached_product, put_cached_product, evict_cached_products
+
+# Run an eviction pass on the SQLite table every N writes
+EVICT_EVERY_WRITES = 200
+
+Product = Optional[Dict[str, Any]]
+# Returns the product, None when the barcode is unknown, or raises when the lookup itself failed
+Fetch = Callable[[], Awaitable[Product]]
+
+class ProductCache:
+    """
+    Barcode lookups cached in an in-memory LRU in front of the SQLite `product_cache` table.
+    Products are fresh for `ttl`; after that they are still served for up to `stale` while one
+    background refresh runs (and kept if that refresh fails). Unknown barcodes are cached for
+    the shorter `negative_ttl`. Failed lookups are never cached.
+    """
+    def __init__(self, ttl_days: float = PRODUCT_CACHE_TTL_DAYS,
+                 stale_days: float = PRODUCT_CACHE_STALE_DAYS,
+                 negative_ttl_hours: float = PRODUCT_CACHE_NEGATIVE_TTL_HOURS,
+                 memory_entries: int = PRODUCT_CACHE_MEMORY_ENTRIES):
+        self.ttl = ttl_days * 86400
+        self.stale = max(stale_days * 86400, self.ttl)
+        self.negative_ttl = negative_ttl_hours * 3600
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, Tuple[Product, float]]" = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._writes = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "negative_hits": 0, # included in the hits above
+            "stale_hits": 0, # included in the hits above
+            "misses": 0,
+            "refreshes": 0,
+            "fetch_errors": 0,
+            "disk_evictions": 0,
+            "errors": 0
+        }
+
+    def _remember(self, barcode: str, entry: Tuple[Product, float]):
+        self._memory[barcode] = entry
+        self._memory.move_to_end(barcode)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def _load(self, barcode: str) -> Tuple[Optional[Tuple[Product, float]], str]:
+        """
+        Returns ((product, fetched_at) or None, "memory" or "disk").
+        """
+        entry = self._memory.get(barcode)
+        if entry is not None:
+            self._memory.move_to_end(barcode)
+            return entry, "memory"
+        try:
+            row = await get_cached_product(barcode)
+        except Exception as e:
+            # The cache must never break scanning
+            logging.error(f"Product cache read failed: {e}")
+            self.stats["errors"] += 1
+            return None, "disk"
+        if row is None:
+            return None, "disk"
+        entry = (json.loads(row[0]) if row[0] is not None else None, row[1])
+        self._remember(barcode, entry)
+        return entry, "disk"
+
+    async def get(self, barcode: str, fetch: Fetch) -> Product:
+        """
+        Returns the cached product for `barcode`, calling `fetch` on a miss or an expired entry.
+        """
+        now = time.time()
+        entry, source = await self._load(barcode)
+        if entry is not None:
+            product, fetched_at = entry
+            age = now - fetched_at
+            fresh = age < (self.ttl if product is not None else self.negative_ttl)
+            if fresh or (product is not None and age < self.stale):
+                self.stats[f"{source}_hits"] += 1
+                if product is None:
+                    self.stats["negative_hits"] += 1
+                if not fresh:
+                    self.stats["stale_hits"] += 1
+                    self._refresh_in_background(barcode, fetch)
+                return product
+
+        self.stats["misses"] += 1
+        try:
+            product = await fetch()
+        except Exception as e:
+            self.stats["fetch_errors"] += 1
+            logging.warning(f"Product lookup for {barcode} failed: {e!r}")
+            # Better an old answer than none
+            return entry[0] if entry is not None else None
+        await self._store(barcode, product)
+        return product
+
+    async def _store(self, barcode: str, product: Product):
+        self._remember(barcode, (product, time.time()))
+        try:
+            await put_cached_product(barcode, json.dumps(product) if product is not None else None)
+            self._writes += 1
+            if self._writes % EVICT_EVERY_WRITES == 0:
+                self.stats["disk_evictions"] += await evict_cached_products(self.stale, self.negative_ttl)
+        except Exception as e:
+            logging.error(f"Product cache write failed: {e}")
+            self.stats["errors"] += 1
+
+    def _refresh_in_background(self, barcode: str, fetch: Fetch):
+        if barcode in self._refreshing:
+            return
+        self.stats["refreshes"] += 1
+        task = asyncio.ensure_future(self._refresh(barcode, fetch))
+        self._refreshing[barcode] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(barcode, None))
+
+    async def _refresh(self, barcode: str, fetch: Fetch):
+        try:
+            product = await fetch()
+        except Exception as e:
+            # Keep serving the stale product
+            self.stats["fetch_errors"] += 1
+            logging.warning(f"Background refresh of {barcode} failed: {e!r}")
+            return
+        await self._store(barcode, product)
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+# Shared cache for get_product_by_barcode
+product_cache = ProductCache()
+
+if __name__ == "__main__":
+    # Hit rate and lookup latency on a skewed stream of scans, against a temporary database
+    # and a stub of Open Food Facts:
+    #   python -m src.services.product_cache [scans] [products] [off-ms]
+    import os
+    import random
+    import sys
+    import tempfile
+
+    from src.database import db
+
+    scans = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    off_latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 150) / 1000
+
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.init_db()
+
+    upstream = {"calls": 0}
+
+    async def stub_off(code: str) -> Product:
+        upstream["calls"] += 1
+        await asyncio.sleep(off_latency)
+        if int(code) % 7 == 0: # ~15% of scanned codes are not in OFF
+            return None
+        return {"name": f"Product {code}", "calories": 250, "protein": 8, "carbs": 30, "fats": 10, "unit": "100g"}
+
+    def percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+    async def scan_all(cache: ProductCache, codes):
+        timings = {"hit": [], "miss": []}
+        for code in codes:
+            misses = cache.stats["misses"]
+            start = time.perf_counter()
+            await cache.get(code, lambda: stub_off(code))
+            timings["miss" if cache.stats["misses"] > misses else "hit"].append(time.perf_counter() - start)
+        return timings
+
+    async def measure():
+        rng = random.Random(0)
+        # A few products are scanned every day, most rarely (Zipf-like)
+        weights = [1 / (rank + 1) for rank in range(products)]
+        codes = [str(3000000000000 + i) for i in rng.choices(range(products), weights, k=scans)]
+
+        cache = ProductCache()
+        timings = await scan_all(cache, codes)
+        print(f"cold start, {scans} scans over {products} products: hit rate {cache.hit_rate:.1%}, "
+              f"{upstream['calls']} OFF calls instead of {scans}")
+        print(f"  hit  p50 {percentile(timings['hit'], 0.5):.3f} ms, p95 {percentile(timings['hit'], 0.95):.3f} ms "
+              f"({cache.stats['negative_hits']} unknown-barcode hits)")
+        print(f"  miss p50 {percentile(timings['miss'], 0.5):.1f} ms")
+
+        # Without the memory tier (e.g. right after a restart) every hit is a SQLite read
+        cache = ProductCache(memory_entries=0)
+        timings = await scan_all(cache, codes[:1000])
+        print(f"SQLite only: {cache.stats['disk_hits']} hits, p50 {percentile(timings['hit'], 0.5):.3f} ms, "
+              f"p95 {percentile(timings['hit'], 0.95):.3f} ms")
+
+        # Everything past its TTL: answers stay immediate and refresh in the background
+        cache = ProductCache(ttl_days=0, stale_days=30, negative_ttl_hours=0)
+        before = upstream["calls"]
+        timings = await scan_all(cache, codes[:1000])
+        await asyncio.sleep(off_latency * 2)
+        print(f"all expired: {cache.stats['stale_hits']} stale hits at p50 {percentile(timings['hit'], 0.5):.3f} ms, "
+              f"{cache.stats['refreshes']} background refreshes, {cache.stats['misses']} misses (expired unknown codes), "
+              f"{upstream['calls'] - before} OFF calls")
+
+    asyncio.run(measure())
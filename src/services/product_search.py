@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from src.database.async_db import search_products as search_local, upsert_products, optimize_product_search
+from src.services import off_service
+from src.services.off_index import OFFIndex, decode_key, get_off_index
+
+# At most this many words of a query are matched; shorter words are ignored
+# (a one-letter prefix matches a large part of the index and is slow to rank)
+MAX_QUERY_TERMS = 8
+MIN_WORD_CHARS = 2
+# Products fetched from Open Food Facts when the local index has nothing
+OFF_FALLBACK_RESULTS = 20
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def to_match(query: str) -> Optional[str]:
+    """
+    FTS5 query for what a user typed: every word must match, the words as prefixes
+    ("nut choc" finds "Nutella chocolate spread"). None when there is nothing to search for.
+    """
+    words = [word for word in _WORD.findall(query.lower()) if len(word) >= MIN_WORD_CHARS][:MAX_QUERY_TERMS]
+    if not words:
+        return None
+    # \w+ never contains a double quote, so quoting each word is enough to escape FTS5 syntax
+    return " ".join(f'"{word}"*' for word in words)
+
+class ProductSearch:
+    """
+    Ranked name search over the local `products` FTS5 index (fed by barcode lookups,
+    Open Food Facts searches and the offline index import), falling back to Open Food Facts
+    only when nothing matches locally. One OFF search per query runs at a time and keeps
+    running in the background if the caller stops waiting, so a retry finds its results.
+    """
+    def __init__(self):
+        self._fallbacks: Dict[str, asyncio.Task] = {}
+        self.stats = {
+            "searches": 0,
+            "local_hits": 0,
+            "off_searches": 0,
+            "off_timeouts": 0,
+            "errors": 0
+        }
+
+    async def local(self, query: str, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        One page of local matches, best first.
+        """
+        match = to_match(query)
+        if match is None:
+            return []
+        try:
+            return await search_local(match, limit, offset)
+        except Exception as e:
+            # A broken index must not break /search; the OFF fallback still answers
+            logging.error(f"Product search failed: {e}")
+            self.stats["errors"] += 1
+            return []
+
+    async def search(self, query: str, limit: int = 10, offset: int = 0, wait: float = None) -> List[Dict[str, Any]]:
+        """
+        One page of results for `query`. When the first page is empty locally, Open Food Facts
+        is searched; `wait` bounds how long (in seconds) to wait for it (None waits until it answers).
+        """
+        self.stats["searches"] += 1
+        products = await self.local(query, limit, offset)
+        if products:
+            self.stats["local_hits"] += 1
+            return products
+        if offset > 0:
+            return []
+
+        key = to_match(query)
+        if key is None:
+            return []
+        task = self._fallbacks.get(key)
+        if task is None:
+            self.stats["off_searches"] += 1
+            task = asyncio.ensure_future(off_service.search_products(query, OFF_FALLBACK_RESULTS))
+            self._fallbacks[key] = task
+            task.add_done_callback(lambda _: self._fallbacks.pop(key, None))
+        try:
+            products = await asyncio.wait_for(asyncio.shield(task), wait)
+        except asyncio.TimeoutError:
+            self.stats["off_timeouts"] += 1
+            return []
+        return products[:limit]
+
+# Shared search for /search and inline queries
+product_search = ProductSearch()
+
+async def import_off_index(index: OFFIndex, batch_size: int = 20000) -> int:
+    """
+    Copies every product of an offline barcode index (see off_index) into the search index.
+    """
+    rows, imported = [], 0
+    for key, kcal, protein, carbs, fat, name in index.records():
+        name = name.rstrip(b"\0").decode("utf-8", "ignore")
+        if not name or name == "Unknown":
+            continue
+        rows.append((decode_key(key), name, round(kcal, 1), round(protein, 2), round(carbs, 2), round(fat, 2)))
+        if len(rows) >= batch_size:
+            imported += await upsert_products(rows)
+            rows = []
+    if rows:
+        imported += await upsert_products(rows)
+    await optimize_product_search()
+    return imported
+
+if __name__ == "__main__":
+    # Admin and benchmark entry point:
+    #   python -m src.services.product_search import-index           (make the offline OFF index searchable by name)
+    #   python -m src.services.product_search query nutella [page]
+    #   python -m src.services.product_search bench [products]       (temporary database, synthetic names)
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from src.database import db
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "bench"
+
+    async def import_index():
+        index = get_off_index()
+        if index is None:
+            print("No offline index; build one with python -m src.services.off_index import <dump>")
+            return
+        start = time.perf_counter()
+        count = await import_off_index(index)
+        print(f"{count} products searchable ({time.perf_counter() - start:.0f} s)")
+
+    async def query():
+        page = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        for product in await product_search.search(sys.argv[2], 10, page * 10):
+            print(f"{product['barcode']:>14}  {product['name']}  ({product['calories']} kcal/100g)")
+
+    async def bench():
+        products = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+        db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+        db.init_db()
+        rng = random.Random(0)
+        brands = ["Nutella", "Ferrero", "Danone", "Nestlé", "Milka", "Lindt", "Président", "Bonne Maman", "Lu", "Barilla"]
+        kinds = ["crème", "chocolat", "yaourt", "biscuits", "pâtes", "fromage", "céréales", "jus d'orange", "confiture", "lait"]
+        words = ["noir", "au lait", "nature", "bio", "light", "aux fruits", "fraise", "vanille", "noisettes", "complet"]
+
+        start = time.perf_counter()
+        rows = [(f"{3000000000000 + i}", f"{rng.choice(brands)} {rng.choice(kinds)} {rng.choice(words)} {i}",
+                 rng.uniform(30, 600), 5.0, 40.0, 10.0) for i in range(products)]
+        for i in range(0, products, 20000):
+            await upsert_products(rows[i:i + 20000])
+        await optimize_product_search()
+        print(f"indexed {products} products in {time.perf_counter() - start:.1f} s "
+              f"({os.path.getsize(db.DB_PATH) / 2 ** 20:.0f} MiB database)")
+
+        # As typed, letter by letter, plus accent-free and multi-word queries
+        queries = ["n", "nu", "nut", "nute", "nutel", "nutella", "creme", "yaourt fraise", "pres fromage bio",
+                   "bonne maman confiture", "nestle lait", "lindt noir", "zzz"]
+        for q in queries:
+            timings = []
+            for _ in range(20):
+                t = time.perf_counter()
+                found = await product_search.local(q, 10)
+                timings.append(time.perf_counter() - t)
+            timings.sort()
+            print(f"{q!r:>26}: {len(found)} results, p50 {timings[10] * 1000:.2f} ms, max {timings[-1] * 1000:.2f} ms"
+                  + (f"  top: {found[0]['name']}" if found else ""))
+
+        # Deep pages stay cheap enough for paging through /search
+        t = time.perf_counter()
+        page = await product_search.local("chocolat", 10, 500)
+        print(f"'chocolat' page 51: {len(page)} results in {(time.perf_counter() - t) * 1000:.2f} ms")
+
+    asyncio.run({"import-index": import_index, "query": query, "bench": bench}[command]())
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+from src.config import RESPONSE_CACHE_TTL_HOURS, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MEMORY_ENTRIES
+from src.database.async_db import get_cached_response, put_cached_response, evict_cached_responses
+
+# Run a size/TTL eviction pass on the SQLite store every N writes
+EVICT_EVERY_WRITES = 200
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def _normalize_number(match) -> str:
+    # "2.0" -> "2", "1,5" -> "1.5", "02" -> "2"
+    return f"{float(match.group().replace(',', '.')):g}"
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a user message so trivially different spellings share a cache entry:
+    unicode form, case, whitespace, trailing punctuation and number formatting.
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _NUMBER_RE.sub(_normalize_number, text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip(" .!?")
+
+def make_cache_key(text: str, prompt_version: str, model: str) -> str:
+    """
+    Builds a key from the normalized text plus prompt and model version,
+    so changing the prompt or model invalidates old entries automatically.
+    """
+    raw = f"{model}\0{prompt_version}\0{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM responses: an in-memory LRU in front of the SQLite `llm_cache` table.
+    Both tiers expire entries `ttl_hours` after they were first stored. Values must be JSON-serializable.
+    """
+    def __init__(self, ttl_hours: float = RESPONSE_CACHE_TTL_HOURS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES):
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._writes = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "errors": 0
+        }
+
+    def _remember(self, key: str, value: Any, created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, created_at = entry
+            if time.time() - created_at <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return value
+            # Expired: drop it; the SQLite row has expired too and is deleted below
+            del self._memory[key]
+            self.stats["memory_evictions"] += 1
+
+        try:
+            cached = await get_cached_response(key, self.ttl_seconds)
+        except Exception as e:
+            # The cache must never break logging
+            logging.error(f"Response cache read failed: {e}")
+            self.stats["errors"] += 1
+            cached = None
+
+        if cached is None:
+            self.stats["misses"] += 1
+            return None
+
+        raw, created_at = cached
+        value = json.loads(raw)
+        self.stats["disk_hits"] += 1
+        # Keep the row's age, so the memory copy expires together with it
+        self._remember(key, value, created_at)
+        return value
+
+    async def set(self, key: str, value: Any):
+        self._remember(key, value, time.time())
+        try:
+            await put_cached_response(key, json.dumps(value))
+            self._writes += 1
+            if self._writes % EVICT_EVERY_WRITES == 0:
+                self.stats["disk_evictions"] += await evict_cached_responses(self.max_entries, self.ttl_seconds)
+        except Exception as e:
+            logging.error(f"Response cache write failed: {e}")
+            self.stats["errors"] += 1
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+# Shared cache for process_user_message
+response_cache = ResponseCache()
+
+if __name__ == "__main__":
+    # Replay benchmark: python -m src.services.response_cache [messages] [upstream_ms]
+    # Messages are drawn Zipf-style from the bundled intent corpus with the spelling variants
+    # users actually type, and answered through the cache in front of a stubbed LLM call.
+    import asyncio
+    import csv
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from src.database import db
+    from src.services.intent_router import INTENTS_CSV, HOLDOUT_CSV
+
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    upstream_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+
+    phrases = []
+    for path in (INTENTS_CSV, HOLDOUT_CSV):
+        with open(path, newline="", encoding="utf-8") as f:
+            phrases += [row["text"] for row in csv.DictReader(f) if row["label"] != "command"]
+    phrases = list(dict.fromkeys(phrases))
+    rng = random.Random(0)
+    rng.shuffle(phrases)
+    weights = [1 / rank ** 1.1 for rank in range(1, len(phrases) + 1)]
+
+    def variant(text: str) -> str:
+        choice = rng.random()
+        if choice < 0.15:
+            text = text.capitalize()
+        elif choice < 0.25:
+            text = text.upper()
+        if rng.random() < 0.15:
+            text = text.replace(" ", "  ", 1)
+        if rng.random() < 0.2:
+            text += rng.choice(["!", ".", "!!", " "])
+        if rng.random() < 0.1:
+            text = re.sub(r"\b(\d+)\b", r"\1.0", text, count=1)
+        return text
+
+    corpus = [variant(text) for text in rng.choices(phrases, weights, k=messages)]
+
+    async def upstream(text: str) -> dict:
+        await asyncio.sleep(upstream_ms / 1000)
+        return {"log_data": [], "reply": f"answer to {normalize_text(text)}"}
+
+    async def replay(cache: ResponseCache, corpus: list):
+        calls, hit_times = 0, []
+        start = time.perf_counter()
+        for text in corpus:
+            t = time.perf_counter()
+            key = make_cache_key(text, "bench", "model")
+            if await cache.get(key) is None:
+                calls += 1
+                await cache.set(key, await upstream(text))
+            else:
+                hit_times.append(time.perf_counter() - t)
+        return calls, hit_times, time.perf_counter() - start
+
+    async def main():
+        db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+        db.init_db()
+        cache = ResponseCache()
+        calls, hit_times, elapsed = await replay(cache, corpus)
+        uncached = messages * upstream_ms / 1000
+        print(f"{messages} messages over {len(phrases)} phrases ({len(set(corpus))} distinct spellings), "
+              f"{upstream_ms:g} ms upstream")
+        print(f"  {calls} upstream calls, hit rate {cache.hit_rate:.1%} "
+              f"({cache.stats['memory_hits']} memory, {cache.stats['disk_hits']} SQLite)")
+        print(f"  {elapsed:.1f} s instead of {uncached:.1f} s uncached: {uncached - elapsed:.1f} s saved "
+              f"({(uncached - elapsed) / messages * 1000:.1f} ms per message)")
+        print(f"  memory hit {sum(hit_times) / len(hit_times) * 1000:.3f} ms on average")
+
+        # A restart empties the memory tier; the same traffic is then served from SQLite
+        cold = ResponseCache(memory_entries=0)
+        calls, hit_times, _ = await replay(cold, corpus)
+        print(f"  after a restart: {calls} upstream calls, SQLite hit {sum(hit_times) / len(hit_times) * 1000:.3f} ms "
+              f"on average")
+
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the work,
+    everyone who arrives while it is in flight awaits the same result (or exception).
+    Nothing is cached once the call finishes.
+
+    The work runs in its own task, so a caller being cancelled does not cancel it for the
+    others; it is only cancelled when every caller waiting on it has gone away.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, "_Call"] = {}
+        self.stats = {
+            "calls": 0,
+            "executions": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "abandoned": 0
+        }
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def coalesced_rate(self) -> float:
+        return self.stats["coalesced"] / self.stats["calls"] if self.stats["calls"] else 0.0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns `await func()`, sharing one execution among concurrent callers with the same key.
+        """
+        self.stats["calls"] += 1
+        call = self._calls.get(key)
+        if call is None:
+            self.stats["executions"] += 1
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._finished(key, call, task))
+        else:
+            self.stats["coalesced"] += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                # Last one waiting: nobody wants the result any more
+                self.stats["abandoned"] += 1
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _finished(self, key: Hashable, call: "_Call", task: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Reading the exception here also keeps asyncio from warning when no caller was left to see it
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+            logging.debug(f"{self.name}: shared call failed: {task.exception()}")
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+if __name__ == "__main__":
+    # Stress check: hundreds of concurrent duplicate requests must reach upstream once per key.
+    #   python -m src.services.single_flight [callers] [keys]
+    import random
+    import sys
+    import time
+
+    async def stress(callers: int, keys: int):
+        flight = SingleFlight("stress")
+        upstream = {}
+
+        async def fetch(key):
+            upstream[key] = upstream.get(key, 0) + 1
+            await asyncio.sleep(0.2)
+            if key == "fail":
+                raise RuntimeError("upstream error")
+            return f"value-{key}"
+
+        key_names = [f"k{i}" for i in range(keys)] + ["fail"]
+
+        async def caller(i):
+            key = key_names[i % len(key_names)]
+            await asyncio.sleep(random.uniform(0, 0.05))
+            try:
+                return key, await flight.do(key, lambda: fetch(key))
+            except RuntimeError as e:
+                return key, e
+
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(caller(i)) for i in range(callers)]
+        # Cancel a few callers mid-flight; the others must still get their result
+        await asyncio.sleep(0.1)
+        for task in tasks[:10]:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+        for result in results:
+            if isinstance(result, asyncio.CancelledError):
+                continue
+            key, value = result
+            assert (isinstance(value, RuntimeError) if key == "fail" else value == f"value-{key}"), result
+        assert all(count == 1 for count in upstream.values()), upstream
+        assert flight.in_flight == 0
+        print(f"{callers} callers over {len(key_names)} keys in {elapsed * 1000:.0f} ms: "
+              f"{sum(upstream.values())} upstream calls")
+        print(f"stats: {flight.stats}, coalesced {flight.coalesced_rate():.1%}")
+
+    args = sys.argv[1:]
+    asyncio.run(stress(int(args[0]) if len(args) > 0 else 500, int(args[1]) if len(args) > 1 else 3))
@@ -0,0 +1,96 @@
+import json
+
+class JSONStreamParser:
+    """
+    Incremental reader for a streamed JSON object shaped like {"reply": "...", "log_data": [{...}, ...]}.
+    Feed it text chunks as they arrive; `reply` holds the decoded reply string so far
+    and `items` every log_data object that has been fully received.
+    Only tracks structure, so it never re-scans earlier chunks.
+    """
+    def __init__(self, text_key: str = "reply", list_key: str = "log_data"):
+        self.text_key = text_key
+        self.list_key = list_key
+        self.text = ""
+        self.reply = ""
+        self.items = []
+        self._pos = 0
+        self._stack = [] # open containers: '{' or '['
+        self._keys = [] # last key seen in each open object
+        self._expect_key = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._string_is_key = False
+        self._reply_start = None
+        self._reply_done = False
+        self._item_start = None
+
+    def feed(self, chunk: str) -> list:
+        """
+        Consumes a chunk and returns the log_data items completed by it.
+        """
+        self.text += chunk
+        text = self.text
+        completed = []
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._keys[-1] = json.loads(text[self._string_start:i + 1])
+                    elif self._reply_start is not None and not self._reply_done:
+                        self._reply_done = True
+                        self.reply = json.loads(text[self._reply_start - 1:i + 1])
+                continue
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+                self._string_is_key = bool(self._stack) and self._stack[-1] == "{" and self._expect_key
+                if (not self._string_is_key and self._reply_start is None
+                        and len(self._stack) == 1 and self._keys[0] == self.text_key):
+                    self._reply_start = i + 1
+            elif c in "{[":
+                if c == "{" and self._stack == ["{", "["] and self._keys[0] == self.list_key:
+                    self._item_start = i
+                self._stack.append(c)
+                self._keys.append(None)
+                self._expect_key = c == "{"
+            elif c in "}]":
+                if self._stack:
+                    self._stack.pop()
+                    self._keys.pop()
+                if c == "}" and self._item_start is not None and self._stack == ["{", "["]:
+                    try:
+                        completed.append(json.loads(text[self._item_start:i + 1]))
+                    except ValueError:
+                        pass
+                    self._item_start = None
+                self._expect_key = False
+            elif c == ":":
+                self._expect_key = False
+            elif c == ",":
+                self._expect_key = bool(self._stack) and self._stack[-1] == "{"
+        self._pos = len(text)
+
+        if self._reply_start is not None and not self._reply_done:
+            self.reply = _decode_partial(text[self._reply_start:])
+        self.items.extend(completed)
+        return completed
+
+def _decode_partial(raw: str) -> str:
+    # The chunk may end inside an escape sequence (e.g. "\u00e") or between the two
+    # halves of a surrogate pair; hold those characters back until they are complete
+    for cut in range(min(len(raw), 6) + 1):
+        try:
+            decoded = json.loads('"' + raw[:len(raw) - cut] + '"')
+        except ValueError:
+            continue
+        if decoded and "\ud800" <= decoded[-1] <= "\udbff":
+            decoded = decoded[:-1]
+        return decoded
+    return ""
@@ -0,0 +1,60 @@
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from src.config import TELEGRAM_EDIT_INTERVAL_MS
+
+class LiveMessage:
+    """
+    One Telegram message that is progressively edited while an answer streams in.
+    The first text is sent right away; later updates are throttled to one edit per
+    `interval_ms` (Telegram rate-limits edits), and `finish` always shows the final text.
+    """
+    def __init__(self, message: Message, interval_ms: int = TELEGRAM_EDIT_INTERVAL_MS):
+        self.message = message
+        self.interval = interval_ms / 1000
+        self.sent = None
+        self.shown = ""
+        self.edits = 0
+        self._next_edit = 0.0
+
+    async def update(self, reply: str, items: list = None):
+        """
+        Streaming callback: shows the reply so far plus the names of items parsed so far.
+        """
+        text = reply
+        if items:
+            text += "\n\n🔎 " + ", ".join(str(item.get("item", "?")) for item in items)
+        if text.strip() and time.monotonic() >= self._next_edit:
+            await self._show(text)
+
+    async def finish(self, text: str):
+        """
+        Shows the final text, sending a new message if nothing was streamed.
+        """
+        await self._show(text, final=True)
+
+    async def _show(self, text: str, final: bool = False):
+        if text == self.shown:
+            return
+        self._next_edit = time.monotonic() + self.interval
+        try:
+            if self.sent is None:
+                self.sent = await self.message.answer(text)
+            else:
+                await self.sent.edit_text(text)
+                self.edits += 1
+            self.shown = text
+        except TelegramRetryAfter as e:
+            # Back off; the final text is sent as a fresh message if editing is still blocked
+            self._next_edit = time.monotonic() + e.retry_after
+            if final:
+                self.sent = await self.message.answer(text)
+                self.shown = text
+        except TelegramBadRequest as e:
+            logging.warning(f"Could not edit streamed message: {e}")
+            if final:
+                self.sent = await self.message.answer(text)
+                self.shown = text
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram.types import Message
+
+from src.config import MEDIA_GROUP_WAIT_MS
+
+# Called with [(message, prefetch task), ...] in message order
+AlbumHandler = Callable[[List[Tuple[Message, asyncio.Future]]], Awaitable[None]]
+
+class MediaGroupCollector:
+    """
+    Telegram delivers an album as separate updates sharing a `media_group_id`.
+    This collects them and calls the handler once with all of the album's messages,
+    `wait_ms` after the last one arrived (the timer restarts with every photo).
+    Each message's `prefetch` (e.g. its download) starts right away, so that work overlaps the wait.
+    """
+    def __init__(self, wait_ms: int = MEDIA_GROUP_WAIT_MS):
+        self.wait = wait_ms / 1000
+        self._albums: Dict[Tuple[int, str], List[Tuple[Message, asyncio.Future]]] = {}
+        self._handlers: Dict[Tuple[int, str], AlbumHandler] = {}
+        self._timers: Dict[Tuple[int, str], asyncio.TimerHandle] = {}
+        self._tasks = set() # running handlers (the loop only keeps weak references)
+
+    def add(self, message: Message, prefetch: Callable[[Message], Awaitable[Any]], handler: AlbumHandler):
+        """
+        Adds an album message; the handler of the album's first message is the one that runs.
+        """
+        key = (message.chat.id, message.media_group_id)
+        if key not in self._albums:
+            self._albums[key] = []
+            self._handlers[key] = handler
+        self._albums[key].append((message, asyncio.ensure_future(prefetch(message))))
+
+        timer = self._timers.get(key)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(self.wait, self._flush, key)
+
+    def _flush(self, key: Tuple[int, str]):
+        messages = sorted(self._albums.pop(key), key=lambda pair: pair[0].message_id)
+        handler = self._handlers.pop(key)
+        del self._timers[key]
+        task = asyncio.ensure_future(handler(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Future):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Error handling album: {task.exception()}")
+
+if __name__ == "__main__":
+    # A 4-photo album, per-photo handling vs one batched call, against a stub vision API:
+    #   python -m src.utils.media_group [photos] [base-ms] [ms-per-image]
+    import os
+    import sys
+    import tempfile
+    import time
+    from types import SimpleNamespace
+
+    from PIL import Image
+
+    from src.services import openai_service
+    from src.services.metrics_service import llm_metrics
+
+    photos = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    base = (float(sys.argv[2]) if len(sys.argv) > 2 else 2000) / 1000
+    per_image = (float(sys.argv[3]) if len(sys.argv) > 3 else 350) / 1000
+    DOWNLOAD, ARRIVAL_GAP = 0.15, 0.03
+
+    answer = openai_service.PhotoAnalysis(reply="Looks like a full meal.", log_data=[
+        openai_service.FoodItem(item="Dish", calories=450, protein=25, carbs=40, fats=18, weight_g=350,
+                                micronutrients="Iron", health_score=6, meal_period="Dinner")
+    ]).model_dump_json()
+
+    class StubCompletions:
+        async def create(self, **params):
+            images = sum(1 for part in params["messages"][0]["content"] if part["type"] == "image_url")
+            await asyncio.sleep(base + per_image * images)
+            usage = SimpleNamespace(prompt_tokens=400 + 765 * images, completion_tokens=120 * images, total_tokens=0)
+            message = SimpleNamespace(content=answer, refusal=None)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    openai_service.client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions()))
+    workdir = tempfile.mkdtemp()
+
+    def make_photo(i: int) -> str:
+        path = os.path.join(workdir, f"photo_{i}.jpg")
+        Image.new("RGB", (1280, 960), (40 * i, 120, 80)).save(path, quality=90)
+        return path
+
+    async def download(i: int) -> str:
+        await asyncio.sleep(DOWNLOAD)
+        return make_photo(i)
+
+    async def per_photo():
+        # Before: every album photo is its own update, download and vision call
+        async def one(i):
+            await asyncio.sleep(i * ARRIVAL_GAP)
+            return await openai_service.analyze_food_image(await download(i))
+        results = await asyncio.gather(*(one(i) for i in range(photos)))
+        return sum(len(log_data) for log_data, _ in results)
+
+    async def batched():
+        done = asyncio.get_running_loop().create_future()
+
+        async def handler(album):
+            paths = await asyncio.gather(*(task for _, task in album))
+            log_data, _ = await openai_service.analyze_food_image(list(paths))
+            done.set_result(len(log_data))
+
+        collector = MediaGroupCollector()
+        for i in range(photos):
+            message = SimpleNamespace(chat=SimpleNamespace(id=1), media_group_id="album", message_id=i)
+            collector.add(message, lambda m: download(m.message_id), handler)
+            await asyncio.sleep(ARRIVAL_GAP)
+        return await done
+
+    async def measure():
+        for name, run in (("per photo", per_photo), ("album", batched)):
+            llm_metrics.__init__()
+            start = time.perf_counter()
+            meals = await run()
+            elapsed = time.perf_counter() - start
+            totals = list(llm_metrics.totals.values())
+            calls = sum(t[0] for t in totals)
+            tokens = sum(t[1] + t[2] for t in totals)
+            print(f"{name:>9}: {elapsed * 1000:.0f} ms to the last reply, {calls} vision call(s), "
+                  f"{tokens} tokens, {meals} item(s) logged in {photos if name == 'per photo' else 1} meal group(s)")
+
+    asyncio.run(measure())